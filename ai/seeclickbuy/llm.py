@@ -0,0 +1,112 @@
+'''OpenAI helpers used for captioning.
+:note: this module must not import torch or transformers; the API process only needs these
+'''
+from openai import OpenAI
+from typing import List, Optional, Callable
+from .prompts import summarize_captions_prompt, edit_caption_prompt
+
+def init_openai(api_key: str) -> 'OpenAI':
+  '''Initialize OpenAI client.
+  '''
+  return OpenAI(api_key=api_key)
+
+def call_openai(
+  client: 'OpenAI',
+  system_prompt: str,
+  user_prompt: str,
+  model: str = "gpt-3.5-turbo",
+  max_tokens: int = 10,
+) -> Optional[str]:
+  '''Call OpenAI API to generate a response.
+  :param system_prompt: system prompt
+  :param user_prompt: user prompt
+  :param model: OpenAI model name
+  :param max_tokens: maximum number of tokens in the response
+  '''
+  messages = [
+    {"role": "system", "content": system_prompt},
+    {"role": "user", "content": user_prompt}
+  ]
+  try:
+    response = client.chat.completions.create(
+      model=model,
+      messages=messages,
+      max_tokens=max_tokens,
+    )
+    output = response.choices[0].message.content.strip()
+  except Exception as e:
+    print(f'Error calling OpenAI: {e}')
+    return None
+  return output
+
+def stream_openai(
+  client: 'OpenAI',
+  system_prompt: str,
+  user_prompt: str,
+  on_text: Callable[[str], None],
+  model: str = "gpt-3.5-turbo",
+  max_tokens: int = 10,
+) -> Optional[str]:
+  '''Call OpenAI API and report the response as it is generated.
+  :param on_text: called with the text generated so far after every chunk
+  :param model: OpenAI model name
+  :param max_tokens: maximum number of tokens in the response
+  :return: the full response, None if the call failed
+  '''
+  messages = [
+    {"role": "system", "content": system_prompt},
+    {"role": "user", "content": user_prompt}
+  ]
+  output = ''
+  try:
+    stream = client.chat.completions.create(
+      model=model,
+      messages=messages,
+      max_tokens=max_tokens,
+      stream=True,
+    )
+    for chunk in stream:
+      if len(chunk.choices) == 0 or chunk.choices[0].delta.content is None:
+        continue
+      output += chunk.choices[0].delta.content
+      on_text(output)
+  except Exception as e:
+    print(f'Error calling OpenAI: {e}')
+    return None
+  return output.strip()
+
+def summarize_captions(client: 'OpenAI', captions: List[str], model: str = "gpt-3.5-turbo") -> Optional[str]:
+  '''Summarize a list of captions.
+  :param captions: list of captions to summarize
+  :param model: OpenAI model name
+  :return: summarized caption
+  '''
+  system_prompt, user_prompt = summarize_captions_prompt(captions)
+  return call_openai(client, system_prompt, user_prompt, model)
+
+def edit_caption(client: 'OpenAI', caption: str, instruction: str, model: str = "gpt-3.5-turbo") -> Optional[str]:
+  '''Edit a caption with additional instructions.
+  :param caption: original caption
+  :param instruction: additional instruction
+  :param model: OpenAI model name
+  :return: edited caption
+  '''
+  system_prompt, user_prompt = edit_caption_prompt(caption, instruction)
+  return call_openai(client, system_prompt, user_prompt, model)
+
+def edit_caption_stream(
+  client: 'OpenAI',
+  caption: str,
+  instruction: str,
+  on_text: Callable[[str], None],
+  model: str = "gpt-3.5-turbo",
+) -> Optional[str]:
+  '''Edit a caption with additional instructions, streaming the edited caption.
+  :param caption: original caption
+  :param instruction: additional instruction
+  :param on_text: called with the caption generated so far
+  :param model: OpenAI model name
+  :return: edited caption
+  '''
+  system_prompt, user_prompt = edit_caption_prompt(caption, instruction)
+  return stream_openai(client, system_prompt, user_prompt, on_text, model)
@@ -1,76 +1,345 @@
-import torch
-import transformers
+'''Model backends (SAM2, Huggingface LLMs).
+:note: torch, transformers and sam2 are imported lazily on first use so that importing 
+  this module (or the OpenAI helpers in `seeclickbuy.llm`) stays cheap
+'''
 import numpy as np
 import numpy.typing as npt
-from openai import OpenAI
-from os.path import join
-from typing import List, Dict, Tuple, Optional
+from os import replace
+from os.path import join, exists
+from typing import List, Dict, Tuple, Optional, Union, Any
 from .utils import get_checkpoints_dir
-from .prompts import summarize_captions_prompt, edit_caption_prompt
+from .profiling import torch_profile
+# Re-exported for backwards compatibility; these only depend on `openai`
+from .llm import init_openai, call_openai, summarize_captions, edit_caption
 
-if torch.cuda.is_available():
-  from sam2.build_sam import build_sam2
-  from sam2.sam2_image_predictor import SAM2ImagePredictor
-else:
-  print(f"No CUDA found. Cannot import SAM2.")
+def convert_checkpoint_to_safetensors(ckpt_path: str, out_path: Optional[str] = None) -> str:
+  '''Convert a SAM2 `.pt` checkpoint into a memory-mappable safetensors file.
+  :note: the conversion only happens once; later calls return the existing file
+  :param ckpt_path: path to the `.pt` checkpoint
+  :param out_path: path to write the safetensors file (defaults to next to the checkpoint)
+  :return: path to the safetensors file
+  '''
+  import torch
+  from safetensors.torch import save_file
+  if out_path is None:
+    out_path = ckpt_path.rsplit('.', 1)[0] + '.safetensors'
+  if exists(out_path):
+    return out_path
+  state_dict = torch.load(ckpt_path, map_location='cpu', weights_only=True)['model']
+  state_dict = {k: v.detach().clone().contiguous() for k, v in state_dict.items()}
+  # Write to a temporary file first so concurrent workers never see a partial file
+  tmp_path = f'{out_path}.tmp'
+  save_file(state_dict, tmp_path)
+  replace(tmp_path, out_path)
+  return out_path
 
-def load_sam2(model_cfg: str = 'sam2.1_hiera_large', device_name: str = 'cuda') -> 'SAM2ImagePredictor':
+def load_sam2(
+  model_cfg: str = 'sam2.1_hiera_large', 
+  device_name: str = 'cuda',
+  weights_format: str = 'safetensors',
+) -> 'SAM2ImagePredictor':
   '''Load all the models needed to do inference.
+  :param model_cfg: name of the checkpoint in the checkpoints directory
+  :param device_name: torch device to load the model on
+  :param weights_format: `safetensors` to memory-map weights or `pt` to unpickle the checkpoint in every process
+  :note: memory-mapped weights are only shared between processes on `cpu`, where the model keeps the
+    file-backed tensors and every worker maps the same page cache (e.g. the prefork pool of `start_celery.sh`).
+    On `cuda`, `.to(device)` copies them to the GPU, so `safetensors` only saves the unpickling and the
+    transient CPU copy of the checkpoint; the default single `--pool solo` worker shares nothing
   '''
+  import torch
+  from sam2.build_sam import build_sam2
+  from sam2.sam2_image_predictor import SAM2ImagePredictor
   device = torch.device(device_name)
   ckpt_path = join(get_checkpoints_dir(), f'{model_cfg}.pt')
   config_path = 'configs/sam2.1/sam2.1_hiera_l.yaml'
-  sam2_model = build_sam2(config_path, ckpt_path, device=device)
+  if weights_format == 'pt':
+    sam2_model = build_sam2(config_path, ckpt_path, device=device)
+  elif weights_format == 'safetensors':
+    from safetensors.torch import load_file
+    weights_path = convert_checkpoint_to_safetensors(ckpt_path)
+    # Build the architecture without weights, then attach the memory-mapped tensors
+    sam2_model = build_sam2(config_path, None, device='cpu')
+    state_dict = load_file(weights_path, device='cpu')
+    # `assign=True` keeps the mmap-backed storage instead of copying into fresh tensors
+    missing_keys, unexpected_keys = sam2_model.load_state_dict(state_dict, strict=False, assign=True)
+    if missing_keys or unexpected_keys:
+      raise RuntimeError(f'Bad SAM2 weights {weights_path}: missing={missing_keys}, unexpected={unexpected_keys}')
+    sam2_model = sam2_model.to(device)
+    sam2_model.eval()
+  else:
+    raise ValueError(f'Unknown weights format {weights_format}')
   predictor = SAM2ImagePredictor(sam2_model)
   return predictor
 
-def infer_click(sam2: 'SAM2ImagePredictor', image: npt.NDArray, click: Tuple[int, int]) -> npt.NDArray:
+def load_sam2_video(
+  model_cfg: str = 'sam2.1_hiera_large',
+  device_name: str = 'cuda',
+  weights_format: str = 'safetensors',
+  image_predictor: Optional['SAM2ImagePredictor'] = None,
+) -> 'SAM2VideoPredictor':
+  '''Load the SAM2 video predictor (memory attention + memory bank) for tracking.
+  :param image_predictor: if given, its weights are shared instead of loading a second copy
+  :param weights_format: see `load_sam2`, used when no image predictor is given
+  '''
+  import torch
+  from sam2.build_sam import build_sam2_video_predictor
+  ckpt_path = join(get_checkpoints_dir(), f'{model_cfg}.pt')
+  config_path = 'configs/sam2.1/sam2.1_hiera_l.yaml'
+  if image_predictor is None and weights_format == 'pt':
+    return build_sam2_video_predictor(config_path, ckpt_path, device=torch.device(device_name))
+  video_model = build_sam2_video_predictor(config_path, None, device='cpu')
+  if image_predictor is not None:
+    state_dict = image_predictor.model.state_dict()
+  else:
+    from safetensors.torch import load_file
+    state_dict = load_file(convert_checkpoint_to_safetensors(ckpt_path), device='cpu')
+  # Both predictors are built from the same SAM2Base config, so the keys match one to one
+  missing_keys, unexpected_keys = video_model.load_state_dict(state_dict, strict=False, assign=True)
+  if missing_keys or unexpected_keys:
+    raise RuntimeError(f'Bad SAM2 video weights: missing={missing_keys}, unexpected={unexpected_keys}')
+  video_model = video_model.to(torch.device(device_name))
+  video_model.eval()
+  return video_model
+
+def preprocess_video_frame(video_predictor: 'SAM2VideoPredictor', image: npt.NDArray) -> 'torch.Tensor':
+  '''Resize and normalize a frame the way `init_state` loads video frames (3 x S x S, on CPU).'''
+  import torch
+  from PIL import Image
+  size = video_predictor.image_size
+  frame = np.asarray(Image.fromarray(image).convert('RGB').resize((size, size))) / 255.
+  frame = torch.from_numpy(frame).permute(2, 0, 1).float()
+  mean = torch.tensor([0.485, 0.456, 0.406])[:, None, None]
+  std = torch.tensor([0.229, 0.224, 0.225])[:, None, None]
+  return (frame - mean) / std
+
+def init_video_tracking(
+  video_predictor: 'SAM2VideoPredictor',
+  image: npt.NDArray,
+  click: Optional[Tuple[int, int]] = None,
+  selection: Optional[Tuple[int, int, int, int]] = None,
+) -> Dict[str, Any]:
+  '''Start tracking an object from a click or selection on a first frame.
+  :note: frames are kept on CPU; only the memory of the last few frames is kept (see `trim_video_state`)
+  :param image: first frame (H, W, 3)
+  :param click: click coordinates
+  :param selection: selection coordinates (x1, y1, x2, y2), preferred over the click
+  :return: inference state to pass to `track_frame`
+  '''
+  import tempfile
+  from PIL import Image
+  # `init_state` only reads videos from disk, so write the first frame as a one-frame video
+  with tempfile.TemporaryDirectory() as video_dir:
+    Image.fromarray(image).convert('RGB').save(join(video_dir, '0.jpg'), quality=95)
+    state = video_predictor.init_state(video_dir, offload_video_to_cpu=True)
+  # Frames are appended one at a time as they stream in
+  state['images'] = [frame for frame in state['images']]
+  if selection is not None:
+    prompt = {'box': np.array(selection, dtype=np.float32)}
+  elif click is not None:
+    prompt = {'points': np.array([click], dtype=np.float32), 'labels': np.array([1], dtype=np.int32)}
+  else:
+    raise ValueError('Need a click or a selection to start tracking')
+  video_predictor.add_new_points_or_box(state, frame_idx=0, obj_id=1, **prompt)
+  return state
+
+def trim_video_state(state: Dict[str, Any], before_frame: int):
+  '''Drop frames and memories older than `before_frame`, keeping the prompted frame.
+  :note: SAM2 only attends to the last `num_maskmem` frames and the conditioning frames
+  '''
+  for obj_output_dict in state['output_dict_per_obj'].values():
+    non_cond_outputs = obj_output_dict['non_cond_frame_outputs']
+    for frame_idx in [i for i in non_cond_outputs if i < before_frame]:
+      non_cond_outputs.pop(frame_idx)
+  for frames_tracked in state['frames_tracked_per_obj'].values():
+    for frame_idx in [i for i in frames_tracked if 0 < i < before_frame]:
+      frames_tracked.pop(frame_idx)
+  for frame_idx in range(1, min(before_frame, len(state['images']))):
+    state['images'][frame_idx] = None
+
+def track_frame(
+  video_predictor: 'SAM2VideoPredictor', 
+  state: Dict[str, Any], 
+  image: npt.NDArray,
+  memory_frames: Optional[int] = None,
+) -> npt.NDArray:
+  '''Propagate the tracked mask to a new frame, without new prompts.
+  :param state: inference state from `init_video_tracking`
+  :param image: new frame, resized to the size of the first frame if it differs
+  :param memory_frames: recent frames to keep in memory (defaults to the model's `num_maskmem`)
+  :return: binary mask in the coordinates of the first frame
+  '''
+  frame_idx = state['num_frames']
+  state['images'].append(preprocess_video_frame(video_predictor, image))
+  state['num_frames'] += 1
+  mask = None
+  with torch_profile('track_frame'):
+    for _, _, mask_logits in video_predictor.propagate_in_video(state, start_frame_idx=frame_idx, max_frame_num_to_track=0):
+      mask = (mask_logits[0, 0] > 0).cpu().numpy()
+  if memory_frames is None:
+    memory_frames = video_predictor.num_maskmem
+  trim_video_state(state, frame_idx - memory_frames)
+  if mask is None:
+    raise ValueError(f'No mask found for frame {frame_idx}')
+  return mask
+
+def infer_click(
+  sam2: 'SAM2ImagePredictor', 
+  image: npt.NDArray, 
+  click: Tuple[int, int],
+  return_logits: bool = False,
+  embedding: Optional[Dict[str, Any]] = None,
+) -> Union[npt.NDArray, Tuple[npt.NDArray, npt.NDArray]]:
   '''Infer a click for an image.
   :param sam2: SAM2 predictor
   :param image: loaded image to infer click on
   :param click: click coordinates
+  :param return_logits: also return the low-res logits of the mask (1 x 256 x 256), 
+    which can be passed back as `mask_input` to refine it
+  :param embedding: embedding of `image` from `get_image_embedding`, to skip the image encoder
   :return: binary mask of clicked object
   '''
-  sam2.set_image(image)
+  set_image_or_embedding(sam2, image, embedding)
   input_point = np.array([[click[0], click[1]]])
   input_label = np.array([1])
   # We may want to do something with the scores
-  masks, _, _ = sam2.predict(
-    point_coords=input_point, 
-    point_labels=input_label,
-    multimask_output=True,
-  )
+  with torch_profile('predict'):
+    masks, _, logits = sam2.predict(
+      point_coords=input_point, 
+      point_labels=input_label,
+      multimask_output=True,
+    )
   if len(masks) == 0:
     raise ValueError(f'No mask found for click {click}')
+  if return_logits:
+    return masks[0], logits[0:1]
   return masks[0]
 
-def infer_selection(sam2: 'SAM2ImagePredictor', image: npt.NDArray, selection: Tuple[int, int, int, int]) -> npt.NDArray:
+def infer_selection(
+  sam2: 'SAM2ImagePredictor', 
+  image: npt.NDArray, 
+  selection: Tuple[int, int, int, int],
+  return_logits: bool = False,
+  embedding: Optional[Dict[str, Any]] = None,
+) -> Union[npt.NDArray, Tuple[npt.NDArray, npt.NDArray]]:
   '''Infer a bounding box for an image.
   :param sam2: SAM2 predictor
   :param image: loaded image to infer bbox on
   :param selection: selection coordinates (x1, y1, x2, y2)
+  :param return_logits: also return the low-res logits of the mask (1 x 256 x 256)
+  :param embedding: embedding of `image` from `get_image_embedding`, to skip the image encoder
   :return: binary mask of clicked object
   '''
-  sam2.set_image(image)
+  set_image_or_embedding(sam2, image, embedding)
   input_selection = np.array([[selection[0], selection[1], selection[2], selection[3]]])
   input_label = np.array([1])
   # We may want to do something with the scores
-  masks, _, _ = sam2.predict(
-    point_coords=None, 
-    point_labels=input_label,
-    box=input_selection,
-    multimask_output=True,
-  )
+  with torch_profile('predict'):
+    masks, _, logits = sam2.predict(
+      point_coords=None, 
+      point_labels=input_label,
+      box=input_selection,
+      multimask_output=True,
+    )
   if len(masks) == 0:
     raise ValueError(f'No mask found for selection {selection}')
+  if return_logits:
+    return masks[0], logits[0:1]
   return masks[0]
 
-def init_huggingface_llm(model: str = 'meta-llama/Meta-Llama-3.1-8B-Instruct') -> transformers.Pipeline:
+def infer_batch(
+  sam2: 'SAM2ImagePredictor',
+  images: List[npt.NDArray],
+  clicks: List[Optional[Tuple[int, int]]],
+  selections: List[Optional[Tuple[int, int, int, int]]],
+) -> List[npt.NDArray]:
+  '''Infer masks for a batch of images, encoding all images in one forward pass.
+  :param sam2: SAM2 predictor
+  :param images: loaded images
+  :param clicks: click coordinates per image (ignored if the image has a selection)
+  :param selections: selection coordinates (x1, y1, x2, y2) per image, or None to use the click
+  :return: binary mask of the clicked or selected object per image
+  '''
+  with torch_profile('set_image_batch'):
+    sam2.set_image_batch(images)
+  point_coords = [np.array([[c[0], c[1]]]) if s is None else None for c, s in zip(clicks, selections)]
+  point_labels = [np.array([1]) if s is None else None for s in selections]
+  boxes = [np.array([s[0], s[1], s[2], s[3]]) if s is not None else None for s in selections]
+  with torch_profile('predict_batch'):
+    all_masks, _, _ = sam2.predict_batch(
+      point_coords_batch=point_coords,
+      point_labels_batch=point_labels,
+      box_batch=boxes,
+      multimask_output=True,
+    )
+  for masks, click, selection in zip(all_masks, clicks, selections):
+    if len(masks) == 0:
+      raise ValueError(f'No mask found for click {click} / selection {selection}')
+  return [masks[0] for masks in all_masks]
+
+def get_image_embedding(sam2: 'SAM2ImagePredictor') -> Dict[str, Any]:
+  '''Snapshot the image embedding computed by the last `set_image` call.
+  :note: the embedding stays on the model device; it can be restored with `set_image_embedding`
+  :return: embedding state of the predictor
+  '''
+  if not sam2._is_image_set:
+    raise ValueError('No image set on the SAM2 predictor')
+  return {'features': sam2._features, 'orig_hw': sam2._orig_hw}
+
+def set_image_embedding(sam2: 'SAM2ImagePredictor', embedding: Dict[str, Any]):
+  '''Restore an embedding from `get_image_embedding`, skipping the image encoder.'''
+  sam2.reset_predictor()
+  sam2._features = embedding['features']
+  sam2._orig_hw = embedding['orig_hw']
+  sam2._is_batch = False
+  sam2._is_image_set = True
+
+def set_image_or_embedding(sam2: 'SAM2ImagePredictor', image: npt.NDArray, embedding: Optional[Dict[str, Any]] = None):
+  '''Encode an image, or restore its embedding if it was encoded before.'''
+  if embedding is not None and tuple(embedding['orig_hw'][0]) == tuple(image.shape[:2]):
+    set_image_embedding(sam2, embedding)
+    return
+  with torch_profile('set_image'):
+    sam2.set_image(image)
+
+def refine_mask(
+  sam2: 'SAM2ImagePredictor',
+  embedding: Dict[str, Any],
+  points: List[Tuple[int, int]],
+  labels: List[int],
+  selection: Optional[Tuple[int, int, int, int]] = None,
+  mask_input: Optional[npt.NDArray] = None,
+) -> Tuple[npt.NDArray, npt.NDArray]:
+  '''Refine a mask with positive and negative points, only running the mask decoder.
+  :param sam2: SAM2 predictor
+  :param embedding: image embedding from `get_image_embedding`
+  :param points: all points so far (x, y)
+  :param labels: 1 for a positive point, 0 for a negative point
+  :param selection: optional box prompt (x1, y1, x2, y2)
+  :param mask_input: low-res logits of the previous mask (1 x 256 x 256)
+  :return: binary mask, low-res logits of the mask
+  '''
+  set_image_embedding(sam2, embedding)
+  with torch_profile('predict'):
+    masks, _, logits = sam2.predict(
+      point_coords=np.array(points) if len(points) > 0 else None,
+      point_labels=np.array(labels) if len(labels) > 0 else None,
+      box=np.array([selection]) if selection is not None else None,
+      mask_input=mask_input,
+      multimask_output=False,  # a single mask is best when prompts are unambiguous
+    )
+  if len(masks) == 0:
+    raise ValueError(f'No mask found for points {points}')
+  return masks[0], logits[0:1]
+
+def init_huggingface_llm(model: str = 'meta-llama/Meta-Llama-3.1-8B-Instruct') -> 'transformers.Pipeline':
   '''Load a Huggingface LLM model.
   - meta-llama/Meta-Llama-3.1-8B-Instruct
   - meta-llama/Meta-Llama-3.1-70B-Instruct
   :param model: model name
   '''
+  import torch
+  import transformers
   pipeline = transformers.pipeline(
     "text-generation",
     model=model,
@@ -86,7 +355,7 @@ def craft_llm_messages(system_prompt: str, user_prompt: str) -> List[Dict]:
   ]
 
 def call_llm(
-  pipeline: transformers.pipeline, 
+  pipeline: 'transformers.Pipeline', 
   system_prompt: str, 
   user_prompt: str, 
   max_new_tokens: int = 256,
@@ -104,56 +373,3 @@ def call_llm(
   )
   generation = outputs[0]["generated_text"][-1]
   return generation
-
-def init_openai(api_key: str) -> 'OpenAI':
-  '''Initialize OpenAI client.
-  '''
-  return OpenAI(api_key=api_key)
-
-def call_openai(
-  client: 'OpenAI',
-  system_prompt: str,
-  user_prompt: str,
-  model: str = "gpt-3.5-turbo",
-  max_tokens: int = 10,
-) -> Optional[str]:
-  '''Call OpenAI API to generate a response.
-  :param system_prompt: system prompt
-  :param user_prompt: user prompt
-  :param model: OpenAI model name
-  :param max_tokens: maximum number of tokens in the response
-  '''
-  messages = [
-    {"role": "system", "content": system_prompt},
-    {"role": "user", "content": user_prompt}
-  ]
-  try:
-    response = client.chat.completions.create(
-      model=model,
-      messages=messages,
-      max_tokens=max_tokens,
-    )
-    output = response.choices[0].message.content.strip()
-  except Exception as e:
-    print(f'Error calling OpenAI: {e}')
-    return None
-  return output
-
-def summarize_captions(client: 'OpenAI', captions: List[str], model: str = "gpt-3.5-turbo") -> Optional[str]:
-  '''Summarize a list of captions.
-  :param captions: list of captions to summarize
-  :param model: OpenAI model name
-  :return: summarized caption
-  '''
-  system_prompt, user_prompt = summarize_captions_prompt(captions)
-  return call_openai(client, system_prompt, user_prompt, model)
-
-def edit_caption(client: 'OpenAI', caption: str, instruction: str, model: str = "gpt-3.5-turbo") -> Optional[str]:
-  '''Edit a caption with additional instructions.
-  :param caption: original caption
-  :param instruction: additional instruction
-  :param model: OpenAI model name
-  :return: edited caption
-  '''
-  system_prompt, user_prompt = edit_caption_prompt(caption, instruction)
-  return call_openai(client, system_prompt, user_prompt, model)
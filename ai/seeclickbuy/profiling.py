@@ -0,0 +1,57 @@
+'''Opt-in torch.profiler hooks around model inference.
+:note: profiling is off unless enabled with `enable_torch_profiling`, so `torch_profile` is free otherwise
+'''
+import os
+import time
+from os.path import join
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Optional, Iterator, List
+
+_profile_dir: ContextVar[Optional[str]] = ContextVar('torch_profile_dir', default=None)
+_profile_outputs: ContextVar[Optional[List[str]]] = ContextVar('torch_profile_outputs', default=None)
+
+@contextmanager
+def enable_torch_profiling(out_dir: str) -> Iterator[List[str]]:
+  '''Profile model calls made within this block.
+  :param out_dir: directory to write traces and summaries to
+  :return: list that collects the paths of the summaries written
+  '''
+  os.makedirs(out_dir, exist_ok=True)
+  outputs: List[str] = []
+  dir_token = _profile_dir.set(out_dir)
+  outputs_token = _profile_outputs.set(outputs)
+  try:
+    yield outputs
+  finally:
+    _profile_dir.reset(dir_token)
+    _profile_outputs.reset(outputs_token)
+
+@contextmanager
+def torch_profile(name: str, row_limit: int = 20) -> Iterator[None]:
+  '''Run a block under `torch.profiler` if profiling is enabled.
+  Writes a chrome trace (`{name}-{ts}.json`) and a table of the top ops (`{name}-{ts}.txt`).
+  :param name: name of the profiled call, e.g. `set_image`
+  :param row_limit: number of ops in the summary table
+  '''
+  out_dir = _profile_dir.get()
+  if out_dir is None:
+    yield
+    return
+  import torch
+  from torch.profiler import profile, ProfilerActivity
+  activities = [ProfilerActivity.CPU]
+  if torch.cuda.is_available():
+    activities.append(ProfilerActivity.CUDA)
+  with profile(activities=activities) as prof:
+    yield
+  if torch.cuda.is_available():
+    torch.cuda.synchronize()
+  prefix = join(out_dir, f'{name}-{int(time.time() * 1000)}')
+  prof.export_chrome_trace(f'{prefix}.json')
+  sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+  with open(f'{prefix}.txt', 'w') as f:
+    f.write(prof.key_averages().table(sort_by=sort_by, row_limit=row_limit))
+  outputs = _profile_outputs.get()
+  if outputs is not None:
+    outputs.append(f'{prefix}.txt')
@@ -0,0 +1,230 @@
+'''Compact CPU image embeddings and a memory-mapped vector index for local retrieval.
+:note: only numpy and PIL are needed, so this runs next to the API or on any worker
+'''
+import os
+import json
+import fcntl
+import numpy as np
+import numpy.typing as npt
+from PIL import Image
+from os.path import join, exists
+from contextlib import contextmanager
+from typing import List, Tuple, Union, Iterator
+
+EMBEDDING_DIM = 256
+# Number of hue, saturation and value bins in the color histogram (8 * 4 * 4 = 128)
+HSV_BINS = (8, 4, 4)
+
+def dct_matrix(n: int) -> npt.NDArray:
+  '''Orthonormal DCT-II matrix.'''
+  k = np.arange(n)[:, None]
+  i = np.arange(n)[None, :]
+  mat = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2. / n)
+  mat[0] /= np.sqrt(2.)
+  return mat.astype(np.float32)
+
+DCT_32 = dct_matrix(32)
+
+def l2_normalize(x: npt.NDArray) -> npt.NDArray:
+  norm = np.linalg.norm(x, axis=-1, keepdims=True)
+  return x / np.maximum(norm, 1e-8)
+
+def embed_image(image: Union[str, 'Image.Image']) -> npt.NDArray:
+  '''Embed an image into a compact L2-normalized vector.
+  The embedding concatenates a color histogram, low-frequency DCT coefficients (layout) and
+  gradient orientation histograms (texture/shape). Transparent pixels of masked crops are ignored.
+  :param image: path to an image or a PIL image
+  :return: float32 vector of size `EMBEDDING_DIM`
+  '''
+  if isinstance(image, str):
+    image = Image.open(image)
+  image = image.convert('RGBA').resize((32, 32), Image.BILINEAR)
+  rgba = np.asarray(image).astype(np.float32) / 255.
+  alpha = rgba[..., 3]
+  weight = alpha / max(alpha.sum(), 1e-8)
+  # Color: weighted HSV histogram, square-rooted (Hellinger) so large regions do not dominate
+  hsv = np.asarray(image.convert('RGB').convert('HSV')).astype(np.float32) / 256.
+  bins = [np.minimum((hsv[..., c] * HSV_BINS[c]).astype(int), HSV_BINS[c] - 1) for c in range(3)]
+  flat = (bins[0] * HSV_BINS[1] + bins[1]) * HSV_BINS[2] + bins[2]
+  color = np.bincount(flat.ravel(), weights=weight.ravel(), minlength=int(np.prod(HSV_BINS)))
+  color = l2_normalize(np.sqrt(color))
+  # Layout: 8x8 low-frequency DCT of the grayscale image on a neutral background
+  gray = rgba[..., :3].mean(axis=-1) * alpha + 0.5 * (1. - alpha)
+  coeffs = (DCT_32 @ gray @ DCT_32.T)[:8, :8].ravel()
+  coeffs[0] = 0.  # drop brightness
+  layout = l2_normalize(coeffs)
+  # Texture: 4x4 cells of 4-bin gradient orientation histograms
+  gy, gx = np.gradient(gray)
+  magnitude = np.hypot(gx, gy) * alpha
+  orientation = np.minimum(((np.arctan2(gy, gx) % np.pi) / np.pi * 4).astype(int), 3)
+  cells = np.zeros((4, 4, 4), dtype=np.float32)
+  for y in range(4):
+    for x in range(4):
+      cell = (slice(8 * y, 8 * y + 8), slice(8 * x, 8 * x + 8))
+      cells[y, x] = np.bincount(orientation[cell].ravel(), weights=magnitude[cell].ravel(), minlength=4)
+  texture = l2_normalize(np.sqrt(cells.ravel()))
+  embedding = np.concatenate([color, layout, texture]).astype(np.float32)
+  return l2_normalize(embedding)
+
+class VectorIndex:
+  '''Brute-force cosine index persisted to memory-mapped files.
+  Vectors are appended incrementally; the file doubles in capacity when full.
+  Multiple processes can share an index: writes take a file lock and readers pick up new rows.
+  :param directory: directory holding `vectors.f16`, `ids.txt` and `meta.json`
+  :param dim: dimension of the vectors
+  '''
+  def __init__(self, directory: str, dim: int = EMBEDDING_DIM, initial_capacity: int = 1024):
+    self.directory = directory
+    self.dim = dim
+    os.makedirs(directory, exist_ok=True)
+    with self.locked():
+      if not exists(self.meta_path):
+        self.create(initial_capacity)
+    self.count = 0
+    self.capacity = 0
+    # Bumped when rows are removed, so readers reload rows that moved
+    self.generation = 0
+    self.vectors = None
+    self.ids: List[str] = []
+    self.refresh()
+
+  @property
+  def meta_path(self) -> str:
+    return join(self.directory, 'meta.json')
+
+  @property
+  def vectors_path(self) -> str:
+    return join(self.directory, 'vectors.f16')
+
+  @property
+  def ids_path(self) -> str:
+    return join(self.directory, 'ids.txt')
+
+  @contextmanager
+  def locked(self) -> Iterator[None]:
+    with open(join(self.directory, '.lock'), 'w') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def read_meta(self) -> dict:
+    with open(self.meta_path) as f:
+      return json.load(f)
+
+  def write_meta(self, count: int, capacity: int):
+    tmp_path = f'{self.meta_path}.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump({'count': count, 'capacity': capacity, 'dim': self.dim, 'generation': self.generation}, f)
+    os.replace(tmp_path, self.meta_path)
+
+  def create(self, capacity: int):
+    self.generation = 0
+    np.memmap(self.vectors_path, dtype=np.float16, mode='w+', shape=(capacity, self.dim)).flush()
+    open(self.ids_path, 'w').close()
+    self.write_meta(0, capacity)
+
+  def refresh(self):
+    '''Pick up rows appended by other processes.'''
+    meta = self.read_meta()
+    if meta['dim'] != self.dim:
+      raise ValueError(f'Index {self.directory} has dim {meta["dim"]}, expected {self.dim}')
+    generation = meta.get('generation', 0)
+    if meta['capacity'] != self.capacity or generation != self.generation:
+      self.capacity = meta['capacity']
+      self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r+', shape=(self.capacity, self.dim))
+    if meta['count'] != self.count or generation != self.generation:
+      with open(self.ids_path) as f:
+        self.ids = f.read().splitlines()[:meta['count']]
+      # Shorter if rows were being removed while the ids were read; the next refresh catches up
+      self.count = len(self.ids)
+    self.generation = generation
+
+  def grow(self, min_capacity: int):
+    '''Double the capacity until `min_capacity` rows fit.
+    :note: the caller must hold the lock
+    '''
+    capacity = self.capacity
+    while capacity < min_capacity:
+      capacity *= 2
+    tmp_path = f'{self.vectors_path}.tmp'
+    grown = np.memmap(tmp_path, dtype=np.float16, mode='w+', shape=(capacity, self.dim))
+    grown[:self.count] = self.vectors[:self.count]
+    grown.flush()
+    os.replace(tmp_path, self.vectors_path)
+    self.capacity = capacity
+    self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r+', shape=(capacity, self.dim))
+
+  def add(self, ids: List[str], vectors: npt.NDArray):
+    '''Append vectors to the index.
+    :param ids: ids of the vectors (e.g. item ids)
+    :param vectors: N x dim array, L2-normalized
+    '''
+    if len(ids) == 0:
+      return
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+    with self.locked():
+      self.refresh()
+      if self.count + len(ids) > self.capacity:
+        self.grow(self.count + len(ids))
+      self.vectors[self.count:self.count + len(ids)] = vectors.astype(np.float16)
+      self.vectors.flush()
+      with open(self.ids_path, 'a') as f:
+        f.write(''.join(f'{id_}\n' for id_ in ids))
+      self.count += len(ids)
+      self.ids.extend(ids)
+      self.write_meta(self.count, self.capacity)
+
+  def remove(self, ids: List[str]) -> int:
+    '''Remove vectors from the index, e.g. of deleted items.
+    :note: the remaining rows are written to new files, so readers keep a consistent view until they refresh
+    :param ids: ids of the vectors to remove; unknown ids are ignored
+    :return: number of rows removed
+    '''
+    removed = set(ids)
+    with self.locked():
+      self.refresh()
+      keep = [i for i, id_ in enumerate(self.ids) if id_ not in removed]
+      if len(keep) == self.count:
+        return 0
+      tmp_path = f'{self.vectors_path}.tmp'
+      compacted = np.memmap(tmp_path, dtype=np.float16, mode='w+', shape=(self.capacity, self.dim))
+      compacted[:len(keep)] = self.vectors[keep]
+      compacted.flush()
+      tmp_ids_path = f'{self.ids_path}.tmp'
+      with open(tmp_ids_path, 'w') as f:
+        f.write(''.join(f'{self.ids[i]}\n' for i in keep))
+      os.replace(tmp_path, self.vectors_path)
+      os.replace(tmp_ids_path, self.ids_path)
+      num_removed = self.count - len(keep)
+      self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r+', shape=(self.capacity, self.dim))
+      self.ids = [self.ids[i] for i in keep]
+      self.count = len(keep)
+      self.generation += 1
+      self.write_meta(self.count, self.capacity)
+    return num_removed
+
+  def search(self, query: npt.NDArray, k: int = 10) -> List[Tuple[str, float]]:
+    '''Find the most similar vectors.
+    :param query: L2-normalized query vector
+    :param k: number of results
+    :return: (id, cosine similarity) pairs, most similar first
+    '''
+    self.refresh()
+    if self.count == 0:
+      return []
+    query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+    # Score in chunks so the float32 copy of the memmap stays small
+    scores = np.empty(self.count, dtype=np.float32)
+    chunk = 65536
+    for start in range(0, self.count, chunk):
+      end = min(start + chunk, self.count)
+      scores[start:end] = self.vectors[start:end].astype(np.float32) @ query
+    k = min(k, self.count)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(self.ids[i], float(scores[i])) for i in top]
+
+  def __len__(self) -> int:
+    return self.count
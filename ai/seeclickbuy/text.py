@@ -0,0 +1,117 @@
+'''Local preprocessing of product titles before captioning.
+:note: scikit-learn is imported lazily so importing this module stays cheap for the API process
+'''
+import re
+import unicodedata
+import numpy as np
+import numpy.typing as npt
+from collections import Counter
+from typing import List, Tuple, Optional
+
+# Titles in the same cluster have at least this (average) cosine similarity;
+# related product titles score 0.3-0.7 while unrelated ones are close to 0
+CLUSTER_SIMILARITY = 0.3
+# Skip the LLM if the largest cluster holds at least this share of the titles
+DOMINANT_SHARE = 0.6
+DOMINANT_MIN_TITLES = 3
+# A word is part of the consensus caption if this share of the cluster's titles contain it
+CONSENSUS_SHARE = 0.6
+CONSENSUS_MIN_WORDS = 2
+CONSENSUS_MAX_WORDS = 6
+
+def normalize_title(title: str) -> str:
+  '''Lowercase a title and strip the noise shopping sites add to it.
+  Drops store suffixes (`... | Amazon.com`), bracketed text and punctuation.
+  '''
+  title = unicodedata.normalize('NFKC', title).lower()
+  title = title.split(' | ')[0]
+  title = re.sub(r'\([^)]*\)|\[[^\]]*\]', ' ', title)
+  title = re.sub(r"[^\w\s&'-]", ' ', title)
+  return ' '.join(title.split())
+
+def dedupe_titles(titles: List[str]) -> Tuple[List[str], List[int]]:
+  '''Drop empty titles and merge titles that normalize to the same text.
+  :return: (unique titles, number of times each was seen), in order of first appearance
+  '''
+  counts: 'Counter[str]' = Counter()
+  unique = {}
+  for title in titles:
+    key = normalize_title(title)
+    if len(key) == 0:
+      continue
+    counts[key] += 1
+    unique.setdefault(key, title)
+  return list(unique.values()), [counts[key] for key in unique]
+
+def title_similarity(titles: List[str]) -> npt.NDArray:
+  '''Cosine similarity between titles using TF-IDF over character n-grams.
+  Character n-grams match `t-shirt` with `tshirt` and plurals with singulars.
+  '''
+  from sklearn.feature_extraction.text import TfidfVectorizer
+  vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 5), sublinear_tf=True)
+  features = vectorizer.fit_transform([normalize_title(title) for title in titles])
+  # Rows are L2 normalized, so the dot product is the cosine similarity
+  return (features @ features.T).toarray()
+
+def cluster_titles(titles: List[str], similarity: float = CLUSTER_SIMILARITY) -> List[List[int]]:
+  '''Group near-duplicate titles.
+  :param titles: titles to cluster
+  :param similarity: minimum average cosine similarity within a cluster
+  :return: clusters as indices into `titles`, largest first; each cluster starts with its most central title
+  '''
+  if len(titles) == 0:
+    return []
+  if len(titles) == 1:
+    return [[0]]
+  from sklearn.cluster import AgglomerativeClustering
+  sim = title_similarity(titles)
+  model = AgglomerativeClustering(
+    n_clusters=None,
+    metric='precomputed',
+    linkage='average',
+    distance_threshold=1. - similarity,
+  )
+  labels = model.fit_predict(np.clip(1. - sim, 0., None))
+  clusters = []
+  for label in np.unique(labels):
+    members = np.where(labels == label)[0]
+    centrality = sim[np.ix_(members, members)].mean(axis=1)
+    clusters.append([int(i) for i in members[np.argsort(-centrality, kind='stable')]])
+  return sorted(clusters, key=lambda cluster: (-len(cluster), cluster[0]))
+
+def consensus_caption(titles: List[str], share: float = CONSENSUS_SHARE) -> Optional[str]:
+  '''Words shared by most titles, in the order they appear in the first title.
+  :param titles: titles of one cluster, most central first
+  :return: caption, None if too few or too many words are shared to make a short description
+  '''
+  words = [normalize_title(title).split() for title in titles]
+  counts = Counter(word for title_words in words for word in set(title_words))
+  shared = [word for word in dict.fromkeys(words[0]) if counts[word] >= share * len(titles)]
+  if not (CONSENSUS_MIN_WORDS <= len(shared) <= CONSENSUS_MAX_WORDS):
+    return None
+  return ' '.join(shared)
+
+def prepare_captions(
+  titles: List[str],
+  max_titles: int = 5,
+  dominant_share: float = DOMINANT_SHARE,
+) -> Tuple[Optional[str], List[str]]:
+  '''Pick what to send to `summarize_captions`.
+  :param titles: raw titles of the retrieved items
+  :param max_titles: maximum number of titles to put in the prompt
+  :param dominant_share: share of titles the largest cluster needs to skip the LLM
+  :return: (caption, representatives); caption is set when one cluster dominates and the LLM can be skipped,
+    otherwise representatives holds one title per cluster, largest clusters first
+  '''
+  titles, counts = dedupe_titles(titles)
+  clusters = cluster_titles(titles)
+  if len(clusters) == 0:
+    return None, []
+  # Duplicates are merged before clustering but still count towards cluster size
+  clusters = sorted(clusters, key=lambda cluster: -sum(counts[i] for i in cluster))
+  largest = [title for i in clusters[0] for title in [titles[i]] * counts[i]]
+  if len(largest) >= DOMINANT_MIN_TITLES and len(largest) >= dominant_share * sum(counts):
+    caption = consensus_caption(largest)
+    if caption is not None:
+      return caption, []
+  return None, [titles[cluster[0]] for cluster in clusters[:max_titles]]
@@ -1,3 +1,5 @@
+import sys
+import resource
 import numpy as np
 import numpy.typing as npt
 from PIL import Image
@@ -16,3 +18,18 @@ def load_image(image: str) -> npt.NDArray:
   im_pil = Image.open(image).convert('RGB')
   im = np.asarray(im_pil)
   return im
+
+def get_rss_mb() -> float:
+  '''Resident set size of the current process in megabytes.
+  :note: falls back to peak RSS when /proc is not available (e.g. macOS), which `getrusage` reports in bytes on
+    macOS and in kilobytes elsewhere
+  '''
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024.
+  except OSError:
+    pass
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss / 1024. / 1024. if sys.platform == 'darwin' else max_rss / 1024.
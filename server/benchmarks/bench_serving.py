@@ -0,0 +1,147 @@
+'''Compare request throughput of the dev server (one reloading process) and the production server.
+Each server is started in turn, loaded by keep-alive clients for a fixed time, then stopped with SIGTERM.
+
+  python benchmarks/bench_serving.py
+  python benchmarks/bench_serving.py --path /item/ITEM_ID/thumbnail --method GET --clients 128 --workers 8
+  python benchmarks/bench_serving.py --modes prod --duration 30
+
+:note: the default route (`POST /`) does no I/O, so results measure serving overhead; point `--path`
+  at a route backed by Firestore or Redis to include the client pools
+'''
+import sys
+import time
+import signal
+import argparse
+import threading
+import subprocess
+from os.path import dirname, realpath, join
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional
+import requests
+
+SERVER_DIR = realpath(join(dirname(__file__), '..'))
+
+def server_command(mode: str, app: str, port: int, workers: int) -> List[str]:
+  if mode == 'dev':
+    # What `fastapi dev` runs
+    return [sys.executable, '-m', 'uvicorn', app, '--reload', '--port', str(port)]
+  return [
+    sys.executable, '-m', 'gunicorn', app,
+    '-c', 'gunicorn.conf.py',
+    '--bind', f'127.0.0.1:{port}',
+    '--workers', str(workers),
+  ]
+
+def wait_until_ready(url: str, method: str, timeout: float = 60.):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    try:
+      requests.request(method, url, timeout=1)
+      return
+    except requests.ConnectionError:
+      time.sleep(0.2)
+  raise TimeoutError(f'Server at {url} did not start within {timeout}s')
+
+def run_clients(url: str, method: str, threads: int, duration: float) -> Dict[str, Any]:
+  '''Send requests from `threads` keep-alive sessions until `duration` seconds have passed.
+  :return: latencies (seconds) of successful requests and the number of failed ones
+  '''
+  latencies: List[float] = []
+  errors = [0]
+  lock = threading.Lock()
+  deadline = time.perf_counter() + duration
+
+  def loop():
+    session = requests.Session()
+    local_latencies, local_errors = [], 0
+    while time.perf_counter() < deadline:
+      start = time.perf_counter()
+      try:
+        response = session.request(method, url, timeout=30)
+        if response.status_code < 500:
+          local_latencies.append(time.perf_counter() - start)
+        else:
+          local_errors += 1
+      except requests.RequestException:
+        local_errors += 1
+    with lock:
+      latencies.extend(local_latencies)
+      errors[0] += local_errors
+
+  pool = [threading.Thread(target=loop) for _ in range(threads)]
+  for thread in pool:
+    thread.start()
+  for thread in pool:
+    thread.join()
+  return {'latencies': latencies, 'errors': errors[0]}
+
+def percentile(values: List[float], q: float) -> float:
+  if len(values) == 0:
+    return float('nan')
+  return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+def bench_mode(mode: str, args: argparse.Namespace) -> Optional[Dict[str, Any]]:
+  '''Start a server, load it, and stop it.
+  :return: throughput, latency percentiles, errors and seconds the server took to exit after SIGTERM
+  '''
+  url = f'http://127.0.0.1:{args.port}{args.path}'
+  proc = subprocess.Popen(
+    server_command(mode, args.app, args.port, args.workers),
+    cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+  )
+  try:
+    wait_until_ready(url, args.method)
+    # Clients run in several processes so the load generator is not limited by one GIL
+    num_processes = min(args.processes, args.clients)
+    threads = [args.clients // num_processes + (1 if i < args.clients % num_processes else 0) for i in range(num_processes)]
+    with ProcessPoolExecutor(num_processes) as executor:
+      list(executor.map(run_clients, [url] * num_processes, [args.method] * num_processes, threads, [args.warmup] * num_processes))
+      start = time.perf_counter()
+      results = list(executor.map(run_clients, [url] * num_processes, [args.method] * num_processes, threads, [args.duration] * num_processes))
+      elapsed = time.perf_counter() - start
+  except Exception as e:
+    print(f'{mode}: {e}')
+    proc.kill()
+    return None
+  stop_start = time.perf_counter()
+  proc.send_signal(signal.SIGTERM)
+  try:
+    proc.wait(timeout=60)
+  except subprocess.TimeoutExpired:
+    proc.kill()
+  latencies = sorted(latency for result in results for latency in result['latencies'])
+  return {
+    'rps': len(latencies) / elapsed,
+    'p50': 1000 * percentile(latencies, 50),
+    'p90': 1000 * percentile(latencies, 90),
+    'p99': 1000 * percentile(latencies, 99),
+    'errors': sum(result['errors'] for result in results),
+    'shutdown': time.perf_counter() - stop_start,
+  }
+
+def main(args: argparse.Namespace):
+  print(f'{args.method} {args.path} with {args.clients} clients for {args.duration}s')
+  print(f'{"mode":<8}{"req/s":>10}{"p50 (ms)":>10}{"p90 (ms)":>10}{"p99 (ms)":>10}{"errors":>8}{"exit (s)":>10}')
+  for mode in args.modes:
+    stats = bench_mode(mode, args)
+    if stats is None:
+      continue
+    label = mode if mode == 'dev' else f'prod x{args.workers}'
+    print(
+      f'{label:<8}{stats["rps"]:>10.0f}{stats["p50"]:>10.1f}{stats["p90"]:>10.1f}{stats["p99"]:>10.1f}'
+      f'{stats["errors"]:>8}{stats["shutdown"]:>10.2f}'
+    )
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--modes', nargs='+', default=['dev', 'prod'], choices=['dev', 'prod'])
+  parser.add_argument('--app', type=str, default='main:app')
+  parser.add_argument('--path', type=str, default='/')
+  parser.add_argument('--method', type=str, default='POST')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--workers', type=int, default=4, help='gunicorn workers in prod mode')
+  parser.add_argument('--clients', type=int, default=64, help='concurrent keep-alive connections')
+  parser.add_argument('--processes', type=int, default=4, help='processes generating load')
+  parser.add_argument('--duration', type=float, default=10.)
+  parser.add_argument('--warmup', type=float, default=2.)
+  main(parser.parse_args())
@@ -0,0 +1,67 @@
+'''Measure import time and RSS of the API process.
+Each module is imported in a fresh interpreter so results are not polluted by earlier imports.
+
+  python benchmarks/bench_startup.py
+  python benchmarks/bench_startup.py --modules main --repeats 5
+'''
+import sys
+import json
+import argparse
+import subprocess
+from os.path import dirname, realpath, join
+from statistics import median
+from typing import List, Dict, Any
+
+SERVER_DIR = realpath(join(dirname(__file__), '..'))
+DEFAULT_MODULES = ['seeclickbuy.llm', 'seeclickbuy.models', 'server.crud', 'server.tasks', 'main']
+HEAVY_MODULES = ['torch', 'transformers', 'sam2']
+
+PROBE = '''
+import sys, time, json, resource
+start = time.perf_counter()
+import importlib
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+rss = None
+with open('/proc/self/status') as f:
+  for line in f:
+    if line.startswith('VmRSS:'):
+      rss = int(line.split()[1]) / 1024.
+if rss is None:
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+heavy = [m for m in json.loads(sys.argv[2]) if m in sys.modules]
+print(json.dumps({'seconds': elapsed, 'rss_mb': rss, 'heavy': heavy}))
+'''
+
+def probe_module(module: str) -> Dict[str, Any]:
+  '''Import a module in a fresh interpreter.
+  :param module: dotted module name
+  :return: import time, rss and heavy modules that were pulled in
+  '''
+  proc = subprocess.run(
+    [sys.executable, '-c', PROBE, module, json.dumps(HEAVY_MODULES)],
+    cwd=SERVER_DIR, capture_output=True, text=True,
+  )
+  if proc.returncode != 0:
+    return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'failed'}
+  return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def main(modules: List[str], repeats: int):
+  print(f'{"module":<24}{"import (s)":>12}{"rss (MB)":>12}  heavy imports')
+  for module in modules:
+    runs = [probe_module(module) for _ in range(repeats)]
+    errors = [run['error'] for run in runs if 'error' in run]
+    if errors:
+      print(f'{module:<24}{"error":>12}{"":>12}  {errors[0]}')
+      continue
+    seconds = median(run['seconds'] for run in runs)
+    rss_mb = median(run['rss_mb'] for run in runs)
+    heavy = ','.join(runs[0]['heavy']) or '-'
+    print(f'{module:<24}{seconds:>12.3f}{rss_mb:>12.1f}  {heavy}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES)
+  parser.add_argument('--repeats', type=int, default=3)
+  args = parser.parse_args()
+  main(args.modules, args.repeats)
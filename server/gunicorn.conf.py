@@ -0,0 +1,34 @@
+'''Production server settings, see `start_server.sh`.
+
+  gunicorn main:app -c gunicorn.conf.py
+  WEB_CONCURRENCY=8 KEEPALIVE=120 gunicorn main:app -c gunicorn.conf.py
+
+The app is imported once in the master and workers are forked from it, so restarts are fast and
+workers share the imported modules' memory. Clients are opened per worker in `main.lifespan`.
+On SIGTERM each worker stops accepting connections, finishes in-flight requests for up to
+`graceful_timeout` seconds, then closes its clients.
+'''
+import multiprocessing
+from os import environ as env
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = env.get('BIND', '0.0.0.0:8000')
+# Processes serving the API, each with `API_THREADS` threads for the sync routes
+workers = int(env.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'uvicorn_worker.UvicornWorker'
+preload_app = env.get('PRELOAD_APP', 'true').lower() == 'true'
+# Seconds an idle connection is kept open; keep it above the load balancer's idle timeout,
+# otherwise the balancer may send a request on a connection the server is closing
+keepalive = int(env.get('KEEPALIVE', 75))
+graceful_timeout = int(env.get('GRACEFUL_TIMEOUT', 30))
+# Workers that have not checked in for this long are killed and replaced
+timeout = int(env.get('WORKER_TIMEOUT', 60))
+backlog = int(env.get('BACKLOG', 2048))
+# Replace workers after this many requests (0 never) to bound memory growth; jittered so they do not restart together
+max_requests = int(env.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+# Heartbeat files on tmpfs, so a slow disk does not get workers killed
+worker_tmp_dir = env.get('WORKER_TMP_DIR', '/dev/shm')
+accesslog = env.get('ACCESS_LOG')  # `-` for stdout
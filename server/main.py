@@ -1,85 +1,305 @@
 from os.path import dirname
 from os import environ as env
 import sys; sys.path.append(dirname(__file__))  # need to add path
-from typing import List, Tuple
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from typing import List, Tuple, Dict, Any, Optional
+import anyio.to_thread
+from fastapi import FastAPI, HTTPException, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, FileResponse
+from pydantic import TypeAdapter
 from dotenv import load_dotenv
-from seeclickbuy.models import edit_caption, init_openai
+from celery.utils import worker_direct
 from server.database import get_firebase_client
 from server.crud import (
   create_click, 
-  create_chat,
+  create_pending_chat,
   favorite_item,
   unfavorite_item,
   fetch_item_by_id, 
+  fetch_items_by_ids,
+  set_favorite_for_items,
   fetch_click_by_id,
   fetch_items_for_click,
   fetch_favorite_items_for_click,
   fetch_recent_clicks_by_user,
+  fetch_item_summaries_for_click,
+  fetch_recent_click_summaries_by_user,
+  next_cursor,
   search_items_for_click,
-  upgrade_click_description_version,
   update_is_processed_for_click,
 )
-from server.schemas import ClickCreate, Click, Item, ChatCreate, Chat
-from server.tasks import click_task, chat_task
+from server.thumbnails import get_thumbnail_path, prefetch_thumbnails, close_http_clients
+from server.tracing import span, inject_headers, attach_remote_parent, detach_remote_parent
+from server.admission import admit, retry_after_header, fetch_latency_summary, close_redis
+from server.dedup import image_digest, click_fingerprint, claim_fingerprint, copy_click_result, fetch_dedup_stats
+from server.compaction import fetch_compaction_stats
+from server.deadlines import click_deadline, fetch_degradation_stats
+from server.views import fetch_feed, fetch_view_stats
+from server.capture import CaptureMiddleware, CAPTURE_SAMPLE_RATE
+from server.scheduling import task_queue, PRIORITY_QUEUES
+from server.preparation import record_preparation, fetch_preparation, cancel_preparation, record_preparation_event, fetch_preparation_stats, PREPARE_TTL
+from server.schemas import ClickCreate, Click, Item, ChatCreate, Chat, ClickSummaryPage, ItemSummaryPage, Feed, RefineCreate, TrackCreate, ItemIds
+from server.schemas import PrepareCreate, Preparation
+from server.schemas import ClickListAdapter, ItemListAdapter
+from server.tasks import click_task, chat_task, refine_task, track_task, prepare_task, drop_preparation_task
 
 # Load environment variables
 load_dotenv()
 assert env.get('SERP_API_KEY') is not None, 'SERP_API_KEY is not defined'
-assert env.get('OPENAI_API_KEY') is not None, 'OPENAI_API_KEY is not defined'
-# Initialize firebase client
-db = get_firebase_client()
+# Threads serving the sync routes in each process; size the client pools (e.g. `REDIS_POOL_SIZE`) to match
+API_THREADS = int(env.get('API_THREADS', 40))
+# Firebase client, created per process in `lifespan`
+db = None
+
+@asynccontextmanager
+async def lifespan(app: 'FastAPI'):
+  '''Create clients when a server process starts and close them once it has drained.
+  :note: gRPC channels do not survive a fork, so with `preload_app` (see `gunicorn.conf.py`) no client
+    may be created at import time; each worker opens its own after it is forked
+  '''
+  global db
+  anyio.to_thread.current_default_thread_limiter().total_tokens = API_THREADS
+  db = get_firebase_client()
+  yield
+  # In-flight requests have finished; release connections so the broker and Firestore see a clean close
+  close_http_clients()
+  close_redis()
+  try:
+    db.close()
+  except Exception as e:
+    print(f'Error closing firebase client: {e}')
+
 # Initialize FastAPI
-app = FastAPI(title="See Click Buy API")
+app = FastAPI(title="See Click Buy API", default_response_class=ORJSONResponse, lifespan=lifespan)
 # Add CORS to site
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-# Initialize OpenAI client
-openai = init_openai(env['OPENAI_API_KEY'])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "traceparent"])
+# Record sampled requests for `scripts/replay.py` (set `CAPTURE_SAMPLE_RATE` to enable)
+if CAPTURE_SAMPLE_RATE > 0:
+  app.add_middleware(CaptureMiddleware, sample_rate=CAPTURE_SAMPLE_RATE)
+
+@app.middleware("http")
+async def trace_request(request: 'Request', call_next):
+  '''Start a span per request, continuing the caller's trace if it sent a `traceparent`.
+  The span is propagated to celery tasks enqueued by the route.
+  '''
+  parent_token = attach_remote_parent(request.headers.get('traceparent'))
+  try:
+    with span('http.request', method=request.method, path=request.url.path) as current:
+      response = await call_next(request)
+      current.set_attribute('status_code', response.status_code)
+      inject_headers(response.headers)
+      return response
+  finally:
+    detach_remote_parent(parent_token)
+
+def trusted_list_response(adapter: 'TypeAdapter', values: List[Any], cursor: Optional[str] = None) -> Response:
+  '''Serialize a list of models built by this server in one pass.
+  :note: returning a response directly skips FastAPI re-validating the return value
+  :param adapter: adapter for the list type, see `server.schemas`
+  :param cursor: cursor of the next page, exposed in the `X-Next-Cursor` header
+  '''
+  headers = {'X-Next-Cursor': cursor} if cursor is not None else None
+  return Response(content=adapter.dump_json(values), media_type='application/json', headers=headers)
 
 @app.post("/")
 def read_root():
   return {"message": "Welcome to the See Click Buy API"}
 
 @app.post("/click")
-def click(body: 'ClickCreate') -> Click:
+def click(
+  body: 'ClickCreate', 
+  profile: bool = Header(False, alias='X-Profile'),
+  timeout: Optional[float] = Header(None, alias='X-Timeout'),
+) -> Click:
   '''User clicks on an image. This endpoint will create a click document in firebase.
   It also triggers a celery task to process the click.
+  :note: identical requests (same image, nearby click, same model) share one pipeline run
+  :param profile: set the `X-Profile` header to profile the click task on the worker
+  :param timeout: seconds (`X-Timeout` header) until the click should have a first result; 
+    stages that do not fit are finished later and listed in `degradations`
   :return: the created click document
   '''
+  # Reject early (before any writes) when rate limited or the queue is over its SLO
+  decision = admit(body.user_id, priority='interactive', queue=task_queue('seeclickbuy:click_task', body.channel), task='click_task')
+  if not decision.admitted:
+    raise HTTPException(status_code=429, detail=decision.reason, headers=retry_after_header(decision))
+  # Start the clock before any work so queue time counts against the deadline
+  deadline = click_deadline(timeout)
   # Create the click document
   click = create_click(db, body)
-  # Trigger the click task
+  image_hash = image_digest(body.base64_image)
+  fingerprint = click_fingerprint(image_hash, body.click, body.selection)
+  claim = claim_fingerprint(db, fingerprint, click.click_id)
+  if claim is not None and claim['status'] == 'done':
+    # Reuse a completed result
+    return copy_click_result(db, claim, click.click_id)
+  elif claim is not None:
+    # Same work is in flight; the leader fills this click in when it completes
+    return click
+  # Send the click to the worker holding the image embedding if it was prepared
+  try:
+    preparation = fetch_preparation(image_hash)
+  except Exception as e:
+    print(f'Error fetching preparation {image_hash}: {e}')
+    preparation = None
+  kwargs = {'fingerprint': fingerprint, 'deadline': deadline}
+  if preparation is not None:
+    kwargs['image_hash'] = image_hash
+  queue = worker_direct(preparation['hostname']) if preparation is not None and 'hostname' in preparation else None
+  headers = {'channel': body.channel}
+  if profile:
+    headers['profile'] = True
+  # Trigger the click task; it is routed by channel, see `server.scheduling`
   try:
-    click_task.delay(click.click_id, body.base64_image)
+    click_task.apply_async(
+      (click.click_id, body.base64_image), 
+      kwargs,
+      headers=headers,
+      queue=queue,
+    )
   except Exception as e:
     print(f'Error processing click {click.click_id}: {e}')
   return click
 
+@app.post("/prepare")
+def prepare(body: 'PrepareCreate') -> Preparation:
+  '''Start encoding an image the user is likely to click (hovered or opened), so the click only runs the mask decoder.
+  :note: preparations are speculative: they are skipped when the queue is busy and expire after `PREPARE_TTL` seconds
+  :return: the preparation, keyed by `image_hash`
+  '''
+  image_hash = image_digest(body.base64_image)
+  try:
+    preparation = fetch_preparation(image_hash)
+  except Exception as e:
+    print(f'Error fetching preparation {image_hash}: {e}')
+    return Preparation(image_hash=image_hash, status='skipped')
+  if preparation is not None:
+    return Preparation(image_hash=image_hash, status=preparation['status'], task_id=preparation.get('task_id'))
+  # A preparation that would start after the click is wasted work. Hovers draw from their own
+  # per-user bucket so they never use up the burst of the user's clicks
+  decision = admit(
+    f'prepare:{body.user_id}' if body.user_id is not None else None,
+    priority='background',
+    queue=task_queue('seeclickbuy:prepare_task'),
+    task='prepare_task',
+  )
+  if not decision.admitted or decision.defer_seconds > 0:
+    record_preparation_event(db, 'skipped')
+    return Preparation(image_hash=image_hash, status='skipped')
+  try:
+    task = prepare_task.apply_async((image_hash, body.base64_image), expires=PREPARE_TTL)
+    record_preparation(image_hash, task.id)
+  except Exception as e:
+    print(f'Error preparing image {image_hash}: {e}')
+    return Preparation(image_hash=image_hash, status='skipped')
+  return Preparation(image_hash=image_hash, status='queued', task_id=task.id)
+
+@app.post("/prepare/{image_hash}/cancel")
+def cancel_prepare(image_hash: str) -> Preparation:
+  '''Drop a preparation the user did not click (e.g. the pointer left the image).
+  A queued task is revoked and an embedding already computed is freed on its worker.
+  :param image_hash: `image_hash` returned by `/prepare`
+  :return: the cancelled preparation
+  '''
+  try:
+    preparation = cancel_preparation(image_hash)
+  except Exception as e:
+    raise HTTPException(status_code=503, detail=f'Failed to cancel preparation: {e}')
+  if preparation is None:
+    raise HTTPException(status_code=404, detail=f"Preparation {image_hash} does not exist")
+  try:
+    if 'hostname' in preparation:
+      drop_preparation_task.apply_async((image_hash,), queue=worker_direct(preparation['hostname']), expires=PREPARE_TTL)
+    else:
+      prepare_task.AsyncResult(preparation['task_id']).revoke()
+  except Exception as e:
+    print(f'Error cancelling preparation {image_hash}: {e}')
+  record_preparation_event(db, 'cancelled')
+  return Preparation(image_hash=image_hash, status='cancelled', task_id=preparation.get('task_id'))
+
 @app.post("/chat")
 def chat(body: 'ChatCreate') -> Tuple[Click, Chat]:
   '''Create a chat document in firebase.
-  :return: click, chat
+  The worker edits the description, streaming it into the chat's `post_description`, then searches again.
+  Only the latest chat of a click is applied; chats it replaces become `superseded`.
+  :return: click, chat (with `status` set to `pending`)
   '''
   # Fetch the click document and make sure its valid
   click = fetch_click_by_id(db, body.click_id)
   if click.description is None:
     raise HTTPException(status_code=400, detail=f"Click {body.click_id} description is not available")
-  # Update the click to not be processed
-  click = update_is_processed_for_click(db, body.click_id, False)
-  # Call OpenAI to get the new description, factoring in user's instruction
-  new_description = edit_caption(openai, click.description, body.text, model="gpt-4o-mini")
-  # Create a chat document for a record
-  chat = create_chat(db, body, click.description, new_description, click.version)
-  # Upgrade the click version
-  click = upgrade_click_description_version(db, body.click_id, new_description)
-  # Trigger the click task
-  try:
-    chat_task.delay(click.click_id)
+  # Re-searches are low priority: defer them when the queue is busy, shed them when overloaded
+  decision = admit(click.user_id, priority='background', queue=task_queue('seeclickbuy:chat_task', click.channel), task='chat_task')
+  if not decision.admitted:
+    raise HTTPException(status_code=429, detail=decision.reason, headers=retry_after_header(decision))
+  try:
+    click, chat, created = create_pending_chat(db, body)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  if not created:
+    # Same edit is already in flight
+    return click, chat
+  # Trigger the chat task
+  try:
+    chat_task.apply_async(
+      (click.click_id, chat.chat_id),
+      countdown=decision.defer_seconds or None,
+      headers={'channel': click.channel},
+    )
   except Exception as e:
-    print(f'Error processing click {click.click_id}: {e}')
+    print(f'Error processing chat {chat.chat_id}: {e}')
   return click, chat
 
+@app.post("/click/{click_id}/refine")
+def refine(click_id: str, body: 'RefineCreate') -> Click:
+  '''Refine the mask of a click with extra positive and negative points.
+  Points accumulate across calls; the worker reuses the image embedding and the last mask.
+  :param click_id: id of the click
+  :return: the click, with `is_processed` unset until the new mask is ready
+  '''
+  if len(body.points) == 0 or len(body.points) != len(body.labels):
+    raise HTTPException(status_code=400, detail="points and labels must be non-empty and the same length")
+  if any(label not in (0, 1) for label in body.labels):
+    raise HTTPException(status_code=400, detail="labels must be 0 (negative) or 1 (positive)")
+  click = fetch_click_by_id(db, click_id)
+  if click.masked_url is None:
+    raise HTTPException(status_code=400, detail=f"Click {click_id} has not been processed")
+  click = update_is_processed_for_click(db, click_id, False)
+  try:
+    refine_task.apply_async(
+      (click_id, [list(point) for point in body.points], body.labels),
+      headers={'channel': click.channel},
+    )
+  except Exception as e:
+    print(f'Error refining click {click_id}: {e}')
+  return click
+
+MAX_TRACK_FRAMES = 30
+
+@app.post("/click/{click_id}/track")
+def track(click_id: str, body: 'TrackCreate') -> Click:
+  '''Follow the clicked object through new frames of a video or a page being scrolled.
+  The worker propagates the mask with SAM2's video memory instead of segmenting from scratch,
+  and only searches again when the object's crop changes materially.
+  :param click_id: id of the click
+  :return: the click, with `is_processed` unset until the mask of the last frame is ready
+  '''
+  if not 0 < len(body.frames) <= MAX_TRACK_FRAMES:
+    raise HTTPException(status_code=400, detail=f"Send between 1 and {MAX_TRACK_FRAMES} frames")
+  click = fetch_click_by_id(db, click_id)
+  if click.masked_url is None:
+    raise HTTPException(status_code=400, detail=f"Click {click_id} has not been processed")
+  decision = admit(click.user_id, priority='interactive', queue=task_queue('seeclickbuy:track_task', click.channel), task='track_task')
+  if not decision.admitted:
+    raise HTTPException(status_code=429, detail=decision.reason, headers=retry_after_header(decision))
+  click = update_is_processed_for_click(db, click_id, False)
+  try:
+    track_task.apply_async((click_id, body.frames), headers={'channel': click.channel})
+  except Exception as e:
+    print(f'Error tracking click {click_id}: {e}')
+  return click
+
 @app.post("/click/{click_id}/search")
 def search_click_items(click_id: str) -> List[Item]:
   '''Search for items in the click.
@@ -87,7 +307,7 @@ def search_click_items(click_id: str) -> List[Item]:
   :return: list of items
   '''
   items = search_items_for_click(db, env['SERP_API_KEY'], click_id)
-  return items
+  return trusted_list_response(ItemListAdapter, items)
 
 @app.post("/item/{item_id}/favorite")
 def favorite(item_id: str) -> Item:
@@ -106,6 +326,45 @@ def unfavorite(item_id: str) -> Item:
   item = unfavorite_item(db, item_id)
   return item
 
+MAX_BULK_ITEMS = 100
+
+def check_bulk_item_ids(body: 'ItemIds'):
+  if len(body.item_ids) == 0 or len(body.item_ids) > MAX_BULK_ITEMS:
+    raise HTTPException(status_code=400, detail=f"Expected between 1 and {MAX_BULK_ITEMS} item ids")
+
+@app.post("/items")
+def fetch_items(body: 'ItemIds') -> List[Item]:
+  '''Fetch many items by id in one request.
+  :return: items in the requested order; missing ids are skipped
+  '''
+  check_bulk_item_ids(body)
+  items = fetch_items_by_ids(db, body.item_ids)
+  return trusted_list_response(ItemListAdapter, items)
+
+@app.post("/items/favorite")
+def favorite_items(body: 'ItemIds') -> List[Item]:
+  '''Favorite many items in one request.
+  :return: the updated items
+  '''
+  check_bulk_item_ids(body)
+  try:
+    items = set_favorite_for_items(db, body.item_ids, True)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  return trusted_list_response(ItemListAdapter, items)
+
+@app.post("/items/unfavorite")
+def unfavorite_items(body: 'ItemIds') -> List[Item]:
+  '''Unfavorite many items in one request.
+  :return: the updated items
+  '''
+  check_bulk_item_ids(body)
+  try:
+    items = set_favorite_for_items(db, body.item_ids, False)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  return trusted_list_response(ItemListAdapter, items)
+
 @app.post("/item/{item_id}")
 def fetch_item(item_id: str) -> Item:
   '''Fetch a item by id.
@@ -125,32 +384,160 @@ def fetch_click(click_id: str) -> Click:
   return click
 
 @app.post("/click/{click_id}/items")
-def fetch_click_items(click_id: str, limit: int = 10) -> List[Item]:
+def fetch_click_items(click_id: str, limit: int = 10, cursor: Optional[str] = None) -> List[Item]:
   '''Fetch items for a given click.
+  :note: the cursor for the next page is returned in the `X-Next-Cursor` header
   :param click_id: id of the click
   :param limit: maximum number of items to return
+  :param cursor: cursor of the previous page
   :return: list of items
   '''
   click = fetch_click_by_id(db, click_id)
-  items = fetch_items_for_click(db, click_id, click.version, limit)
-  return items
+  try:
+    items = fetch_items_for_click(db, click_id, click.version, limit, start_after=cursor)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  # Warm this server's thumbnail cache before the grid requests them
+  prefetch_thumbnails([item.thumbnail for item in items] + [item.source_icon for item in items])
+  cursor = next_cursor([item.created_at for item in items], [item.item_id for item in items], limit)
+  return trusted_list_response(ItemListAdapter, items, cursor)
+
+@app.post("/click/{click_id}/items/summaries")
+def fetch_click_item_summaries(click_id: str, limit: int = 10, cursor: Optional[str] = None) -> ItemSummaryPage:
+  '''Fetch a page of item summaries for a given click.
+  :param click_id: id of the click
+  :param limit: maximum number of items to return
+  :param cursor: `next_cursor` of the previous page
+  :return: page of item summaries
+  '''
+  click = fetch_click_by_id(db, click_id)
+  try:
+    page = fetch_item_summaries_for_click(db, click_id, click.version, limit, start_after=cursor)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  # Warm this server's thumbnail cache before the grid requests them
+  prefetch_thumbnails([item.thumbnail for item in page.items])
+  return page
 
 @app.post("/click/{click_id}/items/favorites")
-def fetch_click_favorite_items(click_id: str, limit: int = 10) -> List[Item]:
+def fetch_click_favorite_items(click_id: str, limit: int = 10, cursor: Optional[str] = None) -> List[Item]:
   '''Fetch favorited items for a given click.
+  :note: the cursor for the next page is returned in the `X-Next-Cursor` header
   :param click_id: id of the click
   :param limit: maximum number of favorites to return
+  :param cursor: cursor of the previous page
   :return: list of favorite items
   '''
-  items = fetch_favorite_items_for_click(db, click_id, limit)
-  return items
+  try:
+    items = fetch_favorite_items_for_click(db, click_id, limit, start_after=cursor)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  # Warm this server's thumbnail cache before the grid requests them
+  prefetch_thumbnails([item.thumbnail for item in items] + [item.source_icon for item in items])
+  cursor = next_cursor([item.created_at for item in items], [item.item_id for item in items], limit)
+  return trusted_list_response(ItemListAdapter, items, cursor)
 
 @app.post("/user/{user_id}/clicks")
-def fetch_recent_clicks(user_id: str, limit: int = 10) -> List[Click]:
+def fetch_recent_clicks(user_id: str, limit: int = 10, cursor: Optional[str] = None) -> List[Click]:
   '''Fetch recent clicks for a given user.
+  :note: the cursor for the next page is returned in the `X-Next-Cursor` header
   :param user_id: id of the user
   :param limit: maximum number of clicks to return
+  :param cursor: cursor of the previous page
   :return: list of clicks
   '''
-  clicks = fetch_recent_clicks_by_user(db, user_id, limit)
-  return clicks
+  try:
+    clicks = fetch_recent_clicks_by_user(db, user_id, limit, start_after=cursor)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  cursor = next_cursor([click.created_at for click in clicks], [click.click_id for click in clicks], limit)
+  return trusted_list_response(ClickListAdapter, clicks, cursor)
+
+@app.post("/user/{user_id}/clicks/summaries")
+def fetch_recent_click_summaries(user_id: str, limit: int = 10, cursor: Optional[str] = None) -> ClickSummaryPage:
+  '''Fetch a page of click summaries for a given user.
+  :param user_id: id of the user
+  :param limit: maximum number of clicks to return
+  :param cursor: `next_cursor` of the previous page
+  :return: page of click summaries
+  '''
+  try:
+    return fetch_recent_click_summaries_by_user(db, user_id, limit, start_after=cursor)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/user/{user_id}/feed")
+def fetch_user_feed(user_id: str) -> Feed:
+  '''Fetch the most recent clicks of a user with their top items in one read.
+  :note: older clicks are paged with `/user/{user_id}/clicks/summaries`
+  :param user_id: id of the user
+  :return: feed of the user
+  '''
+  try:
+    return fetch_feed(db, user_id)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/stats/dedup")
+def fetch_dedup_hit_rate() -> Dict[str, Any]:
+  '''Fetch hit rates of click deduplication.
+  :return: counts of reused, coalesced and missed requests with the hit rate
+  '''
+  return fetch_dedup_stats(db)
+
+@app.post("/stats/degradations")
+def fetch_degradation_counts() -> Dict[str, int]:
+  '''Fetch how often click stages ran out of time or failed.
+  :return: counts keyed by `{stage}_{action}`, e.g. `search_background`
+  '''
+  return fetch_degradation_stats(db)
+
+@app.post("/stats/compaction")
+def fetch_compaction_totals() -> Dict[str, Any]:
+  '''Fetch what the nightly compaction job has reclaimed so far.
+  :return: documents, files and blobs deleted with their bytes, and the time of the last run
+  '''
+  return fetch_compaction_stats(db)
+
+@app.post("/stats/preparations")
+def fetch_preparation_counts() -> Dict[str, int]:
+  '''Fetch how speculative preparations ended.
+  :return: counts of `hit`, `miss`, `cancelled` and `skipped` preparations
+  '''
+  return fetch_preparation_stats(db)
+
+@app.post("/stats/views")
+def fetch_view_counts() -> Dict[str, int]:
+  '''Fetch how often maintaining top items and feeds failed.
+  :return: count of `failed` view updates
+  '''
+  return fetch_view_stats(db)
+
+@app.get("/item/{item_id}/thumbnail")
+def fetch_item_thumbnail(item_id: str, size: int = 128, icon: bool = False) -> FileResponse:
+  '''Serve a resized WebP copy of an item's image.
+  :note: only urls stored on items are fetched, the caller never picks the url
+  :param item_id: id of the item
+  :param size: longest side in pixels, rounded up to a cached size
+  :param icon: serve `source_icon` instead of `thumbnail`
+  :return: the thumbnail
+  '''
+  try:
+    item = fetch_item_by_id(db, item_id)
+  except ValueError as e:
+    raise HTTPException(status_code=404, detail=str(e))
+  url = item.source_icon if icon else item.thumbnail
+  path = get_thumbnail_path(url, size) if url is not None else None
+  if path is None:
+    raise HTTPException(status_code=404, detail=f"Thumbnail of item {item_id} is not available")
+  return FileResponse(path, media_type='image/webp', headers={'Cache-Control': 'public, max-age=604800, immutable'})
+
+@app.post("/stats/latency")
+def fetch_task_latencies() -> Dict[str, Dict[str, float]]:
+  '''Fetch recent worker latencies used by admission control.
+  :return: count, mean and p90 (seconds) per task and stage, and time spent in each priority queue (`queue_wait.*`)
+  '''
+  stages = ['click_task', 'chat_task', 'prepare_task', 'prepare_task.encode']
+  stages += [f'click_task.{stage}' for stage in ['upload', 'segmentation', 'search', 'caption']]
+  stages += [f'queue_wait.{queue}' for queue in PRIORITY_QUEUES + ['direct']]
+  return fetch_latency_summary(stages)
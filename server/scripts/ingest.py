@@ -0,0 +1,291 @@
+'''Segment and search a collection of images offline, without going through `/click` and the broker.
+
+The manifest is a JSONL file with one image per line:
+  {"id": "sku-123", "image": "catalog/sku-123.jpg", "click": [320, 240], "user_id": "merch"}
+  {"image": "https://cdn.example.com/b.png", "selection": [10, 20, 200, 300]}
+
+  python scripts/ingest.py manifest.jsonl --out-dir ./ingest
+  python scripts/ingest.py manifest.jsonl --out-dir ./ingest --batch-size 16 --num-workers 8 --caption
+
+Images are decoded in a process pool while SAM2 encodes the previous batch; uploads and
+Google Lens searches run in a thread pool. Every batch is written to Firestore with a
+`BulkWriter`, to `{out_dir}/part-XXXXX.parquet`, and then to `{out_dir}/checkpoint.txt`,
+so an interrupted run picks up after the last completed batch and retries failed images.
+Click and item ids are derived from the record key, so a batch written again after a crash
+overwrites its documents instead of duplicating them.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from os.path import dirname, realpath, join, exists
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Set
+sys.path.append(realpath(join(dirname(__file__), '..')))
+import requests
+import numpy.typing as npt
+from seeclickbuy.utils import load_image
+
+# Note: `server` modules are imported in `main` since spawned pool workers re-import this file
+# and only need `load_record_image`
+
+def record_key(record: Dict[str, Any], line: str) -> str:
+  '''Key of a manifest record, used to resume; the `id` field or a hash of the line.'''
+  return str(record['id']) if 'id' in record else hashlib.sha1(line.encode()).hexdigest()
+
+def record_document_id(key: str, *parts: Any) -> str:
+  '''Firestore id of a document written for a record, the same on every run.
+  :param parts: e.g. the index of an item of the record
+  '''
+  return hashlib.sha256(':'.join(['ingest', key, *[str(part) for part in parts]]).encode()).hexdigest()[:20]
+
+def read_checkpoint(out_dir: str) -> Set[str]:
+  '''Keys of records completed by earlier runs.'''
+  path = join(out_dir, 'checkpoint.txt')
+  if not exists(path):
+    return set()
+  with open(path) as f:
+    return set(line.strip() for line in f if line.strip())
+
+def append_checkpoint(out_dir: str, keys: List[str]):
+  with open(join(out_dir, 'checkpoint.txt'), 'a') as f:
+    f.write(''.join(f'{key}\n' for key in keys))
+    f.flush()
+    os.fsync(f.fileno())
+
+def read_manifest(path: str, done: Set[str]) -> Iterator[Dict[str, Any]]:
+  '''Records of the manifest that have not been completed yet.'''
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if len(line) == 0:
+        continue
+      record = json.loads(line)
+      record['key'] = record_key(record, line)
+      if record['key'] in done:
+        continue
+      if record.get('click') is None and record.get('selection') is None:
+        print(f"Skipping {record['key']}: no click or selection")
+        continue
+      yield record
+
+def load_record_image(record: Dict[str, Any], cache_dir: str) -> Tuple[Dict[str, Any], Optional[str], Optional[npt.NDArray], Optional[str]]:
+  '''Download (if needed) and decode the image of a record; runs in a pool worker.
+  :return: (record, local path, image, error)
+  '''
+  try:
+    path = record['image']
+    if path.startswith('http://') or path.startswith('https://'):
+      response = requests.get(path, timeout=30)
+      response.raise_for_status()
+      path = join(cache_dir, f"{record['key']}.source")
+      with open(path, 'wb') as f:
+        f.write(response.content)
+    return record, path, load_image(path), None
+  except Exception as e:
+    return record, None, None, f'{type(e).__name__}: {e}'
+
+def chunked(records: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+  batch = []
+  for record in records:
+    batch.append(record)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if len(batch) > 0:
+    yield batch
+
+def main(args: argparse.Namespace):
+  from dotenv import load_dotenv
+  import pandas as pd
+  from seeclickbuy.models import load_sam2, infer_batch, infer_click, infer_selection
+  from seeclickbuy.llm import init_openai, summarize_captions
+  from seeclickbuy.text import prepare_captions
+  from server.database import get_firebase_client
+  from server.crud import fetch_lens_items
+  from server.schemas import Click, Item, ItemSummary
+  from server.views import rank_top_items, to_item_summary, refresh_feeds
+  from server.similarity import index_items
+  from server.thumbnails import prefetch_thumbnails
+  from server.utils import (
+    upload_content_addressed,
+    create_masked_image,
+    binary_mask_to_bbox,
+    binary_mask_to_coco_format,
+    round_bbox,
+  )
+  load_dotenv()
+  os.makedirs(args.out_dir, exist_ok=True)
+  os.makedirs(args.cache_dir, exist_ok=True)
+  done = read_checkpoint(args.out_dir)
+  print(f'Resuming after {len(done)} completed records' if len(done) > 0 else 'Starting a new run')
+  db = get_firebase_client()
+  sam2 = load_sam2(args.model_cfg, args.device, args.weights_format)
+  openai = init_openai(os.environ['OPENAI_API_KEY']) if args.caption else None
+  num_parts = len([name for name in os.listdir(args.out_dir) if name.startswith('part-')])
+
+  def segment(images: List[npt.NDArray], records: List[Dict[str, Any]]) -> List[Any]:
+    '''Masks (or exceptions) per image; falls back to one image at a time if the batch fails.'''
+    clicks = [record.get('click') for record in records]
+    selections = [record.get('selection') for record in records]
+    try:
+      return infer_batch(sam2, images, clicks, selections)
+    except Exception as e:
+      print(f'Batch inference failed ({e}), retrying images one at a time')
+    masks = []
+    for image, click, selection in zip(images, clicks, selections):
+      try:
+        masks.append(infer_selection(sam2, image, selection) if selection is not None else infer_click(sam2, image, click))
+      except Exception as e:
+        masks.append(e)
+    return masks
+
+  def finish(record: Dict[str, Any], path: str, image: npt.NDArray, segm: npt.NDArray, click_id: str) -> Dict[str, Any]:
+    '''Upload, search and caption one segmented image; runs in a thread.'''
+    now = int(time.time())
+    image_url = upload_content_addressed(path, 'images/')
+    masked_path = create_masked_image(image, segm, join(args.cache_dir, f"{record['key']}.masked.png"))
+    masked = load_image(masked_path)
+    masked_url = upload_content_addressed(masked_path, 'masks/')
+    items: List[Item] = []
+    if not args.no_search:
+      items = fetch_lens_items(os.environ['SERP_API_KEY'], click_id, masked_url, 1, limit=args.max_items)
+    description, captions = prepare_captions([item.title for item in items])
+    if description is None and openai is not None and len(captions) > 0:
+      description = summarize_captions(openai, captions, model='gpt-4o-mini')
+    click = Click(
+      click_id=click_id,
+      image_url=image_url,
+      image_size=[int(image.shape[1]), int(image.shape[0])],
+      click=record.get('click'),
+      selection=record.get('selection'),
+      user_id=record.get('user_id'),
+      channel=record.get('channel', 'ingest'),
+      masked_url=masked_url,
+      masked_size=[int(x) for x in list(masked.shape)[:2]],
+      bbox=round_bbox(binary_mask_to_bbox(segm)),
+      segm=[int(x) for x in binary_mask_to_coco_format(segm)[0]],
+      description=description,
+      version=1,
+      is_processed=True,
+      created_at=now,
+      updated_at=now,
+    )
+    return {'click': click, 'items': items}
+
+  def write_batch(results: List[Dict[str, Any]]):
+    '''Write clicks and items with one bulk writer flush, then the parquet part and the checkpoint.
+    :note: records with a write that failed after the writer's retries are marked failed and left out of the checkpoint
+    '''
+    nonlocal num_parts
+    writer = db.bulk_writer()
+    # Document path -> result it belongs to, to attribute failed writes
+    writes: Dict[str, Dict[str, Any]] = {}
+    failed: Dict[str, str] = {}
+
+    def on_write_error(error: 'BulkWriteFailure', _: 'BulkWriter') -> bool:
+      if error.attempts < args.write_attempts:
+        return True
+      failed[error.operation.reference.path] = f'{error.code}: {error.message}'
+      return False
+
+    writer.on_write_error(on_write_error)
+    for result in results:
+      click: Optional[Click] = result.get('click')
+      if click is None:
+        continue
+      for i, item in enumerate(result['items']):
+        item_ref = db.collection('Items').document(record_document_id(result['key'], i))
+        item.item_id = item_ref.id
+        writer.set(item_ref, item.model_dump())
+        writes[item_ref.path] = result
+      # Embed the top items the way `server.views` does for clicks written by the API
+      click.top_items = [ItemSummary.model_validate(s) for s in rank_top_items([to_item_summary(item) for item in result['items']])]
+      click.top_items_version = click.version
+      click_ref = db.collection('Clicks').document(click.click_id)
+      writer.set(click_ref, click.model_dump())
+      writes[click_ref.path] = result
+    writer.close()  # flushes and waits for every write, including retries
+    for path, error in failed.items():
+      writes[path]['error'] = f'write {path} failed: {error}'
+    all_items: List[Item] = [item for result in results if 'click' in result and result.get('error') is None for item in result['items']]
+    refresh_feeds(db, [result['click'].user_id for result in results if 'click' in result and result['click'].user_id is not None])
+    rows = [{
+      'key': result['key'],
+      'image': result['image'],
+      'error': result.get('error'),
+      'click_id': result['click'].click_id if 'click' in result else None,
+      'image_url': result['click'].image_url if 'click' in result else None,
+      'masked_url': result['click'].masked_url if 'click' in result else None,
+      'bbox': list(result['click'].bbox) if 'click' in result else None,
+      'description': result['click'].description if 'click' in result else None,
+      'item_ids': [item.item_id for item in result['items']] if 'click' in result else [],
+      'item_titles': [item.title for item in result['items']] if 'click' in result else [],
+    } for result in results]
+    pd.DataFrame(rows).to_parquet(join(args.out_dir, f'part-{num_parts:05d}.parquet'), index=False)
+    num_parts += 1
+    # Failed records are left out of the checkpoint so the next run retries them
+    append_checkpoint(args.out_dir, [result['key'] for result in results if result.get('error') is None])
+    if args.index_items:
+      prefetch_thumbnails([item.thumbnail for item in all_items])
+      index_items(all_items)
+
+  context = multiprocessing.get_context('spawn')
+  batches = chunked(read_manifest(args.manifest, done), args.batch_size)
+  pending: 'deque[List[Future]]' = deque()
+  num_records, num_errors, start_time = 0, 0, time.time()
+  with ProcessPoolExecutor(args.num_workers, mp_context=context) as loaders, ThreadPoolExecutor(args.num_threads) as threads:
+    # Keep a few batches decoding ahead of the GPU, without loading the whole manifest into memory
+    for batch in batches:
+      pending.append([loaders.submit(load_record_image, record, args.cache_dir) for record in batch])
+      if len(pending) >= args.prefetch:
+        break
+    while len(pending) > 0:
+      loaded = [future.result() for future in pending.popleft()]
+      batch = next(batches, None)
+      if batch is not None:
+        pending.append([loaders.submit(load_record_image, record, args.cache_dir) for record in batch])
+      results = [{'key': record['key'], 'image': record['image'], 'items': [], 'error': error} for record, _, _, error in loaded]
+      ok = [i for i, (_, _, image, _) in enumerate(loaded) if image is not None]
+      masks = segment([loaded[i][2] for i in ok], [loaded[i][0] for i in ok]) if len(ok) > 0 else []
+      futures: Dict[int, Future] = {}
+      for i, segm in zip(ok, masks):
+        if isinstance(segm, Exception):
+          results[i]['error'] = f'{type(segm).__name__}: {segm}'
+          continue
+        record, path, image, _ = loaded[i]
+        click_id = record_document_id(record['key'])
+        futures[i] = threads.submit(finish, record, path, image, segm, click_id)
+      for i, future in futures.items():
+        try:
+          results[i].update(future.result())
+        except Exception as e:
+          results[i]['error'] = f'{type(e).__name__}: {e}'
+      write_batch(results)
+      num_records += len(results)
+      num_errors += sum(1 for result in results if result.get('error') is not None)
+      elapsed = time.time() - start_time
+      print(f'{num_records} records ({num_errors} errors) in {elapsed:.1f}s - {num_records / max(elapsed, 1e-6):.2f} images/s')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Segment and search a manifest of images in bulk')
+  parser.add_argument('manifest', type=str, help='JSONL file with `image` and `click` or `selection` per line')
+  parser.add_argument('--out-dir', type=str, default='./ingest', help='directory for parquet parts and the checkpoint')
+  parser.add_argument('--cache-dir', type=str, default='./cache/ingest', help='directory for downloaded and masked images')
+  parser.add_argument('--batch-size', type=int, default=8, help='images per SAM2 forward pass')
+  parser.add_argument('--prefetch', type=int, default=2, help='batches decoded ahead of inference')
+  parser.add_argument('--num-workers', type=int, default=4, help='processes decoding images')
+  parser.add_argument('--num-threads', type=int, default=8, help='threads uploading and searching')
+  parser.add_argument('--max-items', type=int, default=25, help='maximum items per image')
+  parser.add_argument('--no-search', action='store_true', help='only segment and upload')
+  parser.add_argument('--caption', action='store_true', help='call OpenAI when titles do not agree on a description')
+  parser.add_argument('--write-attempts', type=int, default=5, help='attempts per Firestore write before the record is marked failed')
+  parser.add_argument('--index-items', action='store_true', help='add item thumbnails to the local similarity index')
+  parser.add_argument('--model-cfg', type=str, default=os.environ.get('SAM2_MODEL_CFG', 'sam2.1_hiera_large'))
+  parser.add_argument('--weights-format', type=str, default=os.environ.get('SAM2_WEIGHTS_FORMAT', 'safetensors'))
+  parser.add_argument('--device', type=str, default='cuda')
+  main(parser.parse_args())
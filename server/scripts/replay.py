@@ -0,0 +1,327 @@
+'''Replay requests recorded by `server.capture` against a server, keeping their original spacing.
+
+  python scripts/replay.py ./cache/capture --target http://localhost:8000
+  python scripts/replay.py ./cache/capture --target http://staging:8000 --speed 4 --paths /click /chat
+  python scripts/replay.py ./cache/capture/capture-20261019-*.jsonl --target http://staging:8000 --out report.json
+
+Each request is sent `(ts - first ts) / speed` seconds after the start. Ids returned by replayed
+requests (`click_id`, `chat_id`, `item_id`) replace the captured ones in later requests, so refines,
+chats and favorites hit what the replay created. A request that uses an id created by an earlier
+request is held back until the response with that id arrives, and never sent if it does not map it.
+The report lists latency percentiles per route next to the captured ones, and how late requests were
+sent; if `lag` grows, raise `--concurrency`. Held and unmapped requests are reported separately.
+
+:note: this script does not import `server`, so it only needs `requests` on the load generator
+'''
+import os
+import json
+import time
+import argparse
+import threading
+from os.path import join, isdir, dirname
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Set
+import requests
+
+ID_KEYS = ['click_id', 'chat_id', 'item_id']
+# Path segments after these are ids, grouped under `{id}` in the report
+ID_PARENTS = ['click', 'item', 'user']
+PERCENTILES = [50, 90, 95, 99]
+
+def read_records(paths: List[str], prefixes: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+  '''Captured records from files or capture directories, oldest first.
+  :param prefixes: only keep requests whose path starts with one of these
+  '''
+  records = []
+  for path in paths:
+    files = sorted(join(path, name) for name in os.listdir(path) if name.endswith('.jsonl')) if isdir(path) else [path]
+    for file in files:
+      with open(file) as f:
+        for line in f:
+          if len(line.strip()) == 0:
+            continue
+          record = json.loads(line)
+          record['capture_dir'] = path if isdir(path) else dirname(file)
+          if record.get('body_skipped'):
+            continue
+          if prefixes is None or any(record['path'].startswith(prefix) for prefix in prefixes):
+            records.append(record)
+  return sorted(records, key=lambda record: record['ts'])
+
+def resolve_blobs(value: Any, capture_dir: str) -> Any:
+  '''Put back the strings `server.capture` stored as blobs.'''
+  if isinstance(value, dict) and list(value.keys()) == ['$blob']:
+    with open(join(capture_dir, 'blobs', value['$blob'])) as f:
+      return f.read()
+  if isinstance(value, list):
+    return [resolve_blobs(v, capture_dir) for v in value]
+  if isinstance(value, dict):
+    return {k: resolve_blobs(v, capture_dir) for k, v in value.items()}
+  return value
+
+def map_ids(captured: Any, replayed: Any, ids: Dict[str, str]):
+  '''Record which replayed ids stand for which captured ids, walking both responses together.'''
+  if isinstance(captured, dict) and isinstance(replayed, dict):
+    for key, value in captured.items():
+      if key in ID_KEYS and isinstance(value, str) and isinstance(replayed.get(key), str):
+        ids[value] = replayed[key]
+      elif key in replayed:
+        map_ids(value, replayed[key], ids)
+  elif isinstance(captured, list) and isinstance(replayed, list):
+    for c, r in zip(captured, replayed):
+      map_ids(c, r, ids)
+
+def replace_ids(value: Any, ids: Dict[str, str]) -> Any:
+  if isinstance(value, str):
+    return ids.get(value, value)
+  if isinstance(value, list):
+    return [replace_ids(v, ids) for v in value]
+  if isinstance(value, dict):
+    return {k: replace_ids(v, ids) for k, v in value.items()}
+  return value
+
+def collect_ids(value: Any, ids: Set[str]):
+  '''Ids returned in a captured response.'''
+  if isinstance(value, dict):
+    for key, v in value.items():
+      if key in ID_KEYS and isinstance(v, str):
+        ids.add(v)
+      else:
+        collect_ids(v, ids)
+  elif isinstance(value, list):
+    for v in value:
+      collect_ids(v, ids)
+
+def collect_strings(value: Any, strings: Set[str]):
+  if isinstance(value, str):
+    strings.add(value)
+  elif isinstance(value, list):
+    for v in value:
+      collect_strings(v, strings)
+  elif isinstance(value, dict):
+    for v in value.values():
+      collect_strings(v, strings)
+
+def find_dependencies(records: List[Dict[str, Any]]) -> List[Set[str]]:
+  '''Captured ids each request uses that an earlier request created, i.e. that must be mapped before it is sent.'''
+  created: Dict[str, int] = {}
+  for i, record in enumerate(records):
+    ids: Set[str] = set()
+    collect_ids(record.get('response'), ids)
+    for id_ in ids:
+      created.setdefault(id_, i)
+  dependencies = []
+  for i, record in enumerate(records):
+    used = set(record['path'].split('/'))
+    collect_strings(record.get('body'), used)
+    dependencies.append({id_ for id_ in used if created.get(id_, i) < i})
+  return dependencies
+
+def route_of(path: str) -> str:
+  '''Route of a path, with ids replaced by `{id}`.'''
+  segments = path.split('/')
+  return '/'.join('{id}' if i > 0 and segments[i - 1] in ID_PARENTS else s for i, s in enumerate(segments))
+
+def percentile(values: List[float], q: float) -> float:
+  '''Percentile with linear interpolation between closest ranks.'''
+  values = sorted(values)
+  if len(values) == 0:
+    return float('nan')
+  rank = (len(values) - 1) * q / 100.
+  lower = int(rank)
+  upper = min(lower + 1, len(values) - 1)
+  return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def summarize(values: List[float]) -> Dict[str, float]:
+  summary = {f'p{q}': round(percentile(values, q), 2) for q in PERCENTILES}
+  summary['max'] = round(max(values), 2) if len(values) > 0 else float('nan')
+  return summary
+
+class Replayer:
+  '''Sends captured requests on schedule from a thread pool and collects results.
+  Requests using ids that are not mapped yet wait in `held` until the responses that map them arrive.
+  :param target: base url of the server
+  :param speed: 1 for real time, 2 to send twice as fast, and so on
+  :param concurrency: maximum requests in flight
+  :param timeout: seconds before a request counts as failed
+  '''
+  def __init__(self, target: str, speed: float = 1., concurrency: int = 64, timeout: float = 60.):
+    self.target = target.rstrip('/')
+    self.speed = speed
+    self.timeout = timeout
+    self.pool = ThreadPoolExecutor(concurrency)
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.done = threading.Condition(self.lock)
+    self.ids: Dict[str, str] = {}
+    self.results: List[Dict[str, Any]] = []
+    # (captured ids it needs, record, scheduled time) of requests waiting for their ids
+    self.held: List[Any] = []
+    # Requests that were never sent because an id they use was not mapped
+    self.unmapped: List[Dict[str, Any]] = []
+    self.in_flight = 0
+
+  def session(self) -> 'requests.Session':
+    if not hasattr(self.local, 'session'):
+      self.local.session = requests.Session()
+    return self.local.session
+
+  def release_held(self) -> List[Any]:
+    '''Take the held requests whose ids are all mapped now.
+    :note: the caller must hold the lock
+    '''
+    ready, waiting = [], []
+    for held in self.held:
+      (ready if all(id_ in self.ids for id_ in held[0]) else waiting).append(held)
+    self.held = waiting
+    self.in_flight += len(ready)
+    return ready
+
+  def send(self, record: Dict[str, Any], scheduled: float, held_ms: Optional[float] = None):
+    try:
+      self.request(record, scheduled, held_ms)
+    finally:
+      with self.lock:
+        self.in_flight -= 1
+        now = time.time()
+        ready = self.release_held()
+        self.done.notify_all()
+      for _, held_record, held_scheduled in ready:
+        self.pool.submit(self.send, held_record, now, 1000 * (now - held_scheduled))
+
+  def request(self, record: Dict[str, Any], scheduled: float, held_ms: Optional[float] = None):
+    '''Send one request and record its result.
+    :param scheduled: time it should have been sent, or released from `held`
+    :param held_ms: how long it waited for its ids, None if it did not
+    '''
+    sent = time.time()
+    with self.lock:
+      path = '/'.join(self.ids.get(segment, segment) for segment in record['path'].split('/'))
+      body = replace_ids(record['body'], self.ids)
+    body = resolve_blobs(body, record['capture_dir'])
+    url = f"{self.target}{path}" + (f"?{record['query']}" if record.get('query') else '')
+    result = {'route': f"{record['method']} {route_of(record['path'])}", 'lag_ms': 1000 * (sent - scheduled), 'held_ms': held_ms}
+    try:
+      response = self.session().request(
+        record['method'], url,
+        json=body,
+        headers={k: v for k, v in record['headers'].items() if k != 'content-type'},
+        timeout=self.timeout,
+      )
+      result['status'] = response.status_code
+      if record.get('response') is not None and response.headers.get('content-type', '').startswith('application/json'):
+        replayed = response.json()
+        with self.lock:
+          map_ids(record['response'], replayed, self.ids)
+    except Exception as e:
+      result['status'] = None
+      result['error'] = f'{type(e).__name__}: {e}'
+    result['latency_ms'] = 1000 * (time.time() - sent)
+    result['captured_latency_ms'] = record.get('latency_ms')
+    with self.lock:
+      self.results.append(result)
+
+  def run(self, records: List[Dict[str, Any]]) -> float:
+    '''Replay every record and wait for the responses.
+    :return: seconds the replay took
+    '''
+    start_time = time.time()
+    first_ts = records[0]['ts']
+    dependencies = find_dependencies(records)
+    for i, (record, needs) in enumerate(zip(records, dependencies)):
+      scheduled = start_time + (record['ts'] - first_ts) / self.speed
+      wait = scheduled - time.time()
+      if wait > 0:
+        time.sleep(wait)
+      with self.lock:
+        if not all(id_ in self.ids for id_ in needs):
+          self.held.append((needs, record, scheduled))
+          continue
+        self.in_flight += 1
+      self.pool.submit(self.send, record, scheduled)
+      if (i + 1) % 1000 == 0:
+        print(f'{i + 1}/{len(records)} requests scheduled')
+    # Whatever is still held once nothing is in flight waits for ids that no response mapped
+    with self.done:
+      self.done.wait_for(lambda: self.in_flight == 0)
+      self.unmapped = [{'route': f"{record['method']} {route_of(record['path'])}"} for _, record, _ in self.held]
+      self.held = []
+    self.pool.shutdown(wait=True)
+    return time.time() - start_time
+
+def build_report(results: List[Dict[str, Any]], duration: float, unmapped: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+  '''Latency distribution per route and overall, with error counts and send lag.
+  :param unmapped: requests never sent because an id they use was not mapped, counted per route
+  '''
+  by_route = defaultdict(list)
+  for result in results:
+    by_route[result['route']].append(result)
+  by_route['all'] = results
+  report = {'duration_s': round(duration, 2), 'throughput_rps': round(len(results) / max(duration, 1e-6), 2), 'routes': {}}
+  for route, route_results in sorted(by_route.items()):
+    statuses = defaultdict(int)
+    for result in route_results:
+      statuses[str(result['status'])] += 1
+    captured = [r['captured_latency_ms'] for r in route_results if r.get('captured_latency_ms') is not None]
+    report['routes'][route] = {
+      'count': len(route_results),
+      'errors': sum(1 for r in route_results if r['status'] is None or r['status'] >= 500),
+      'statuses': dict(statuses),
+      'latency_ms': summarize([r['latency_ms'] for r in route_results]),
+      'captured_latency_ms': summarize(captured) if len(captured) > 0 else None,
+      'lag_ms': summarize([r['lag_ms'] for r in route_results]),
+    }
+  held = [r['held_ms'] for r in results if r.get('held_ms') is not None]
+  report['held'] = {'count': len(held), 'held_ms': summarize(held)}
+  unmapped_routes = defaultdict(int)
+  for request in unmapped or []:
+    unmapped_routes[request['route']] += 1
+  report['unmapped'] = dict(unmapped_routes)
+  return report
+
+def print_report(report: Dict[str, Any]):
+  print(f"{report['duration_s']}s, {report['throughput_rps']} requests/s")
+  header = f"{'route':<40} {'count':>6} {'errors':>6} " + ' '.join(f'{f"p{q}":>8}' for q in PERCENTILES)
+  header += f" {'captured p50':>13} {'captured p95':>13} {'lag p95':>8}"
+  print(header)
+  for route, stats in report['routes'].items():
+    latency = stats['latency_ms']
+    captured = stats['captured_latency_ms'] or {}
+    line = f"{route:<40} {stats['count']:>6} {stats['errors']:>6} " + ' '.join(f"{latency[f'p{q}']:>8.1f}" for q in PERCENTILES)
+    line += f" {captured.get('p50', float('nan')):>13.1f} {captured.get('p95', float('nan')):>13.1f} {stats['lag_ms']['p95']:>8.1f}"
+    print(line)
+  held = report['held']
+  if held['count'] > 0:
+    print(f"{held['count']} requests held for ids, p50 {held['held_ms']['p50']:.1f}ms, p95 {held['held_ms']['p95']:.1f}ms")
+  for route, count in report['unmapped'].items():
+    print(f'{route}: {count} requests not sent, an id they use was not created by the replay')
+
+def main(args: argparse.Namespace):
+  records = read_records(args.captures, args.paths)
+  if args.limit is not None:
+    records = records[:args.limit]
+  if len(records) == 0:
+    print('No requests to replay')
+    return
+  span = records[-1]['ts'] - records[0]['ts']
+  print(f'Replaying {len(records)} requests captured over {span:.1f}s at {args.speed}x against {args.target}')
+  replayer = Replayer(args.target, args.speed, args.concurrency, args.timeout)
+  duration = replayer.run(records)
+  report = build_report(replayer.results, duration, replayer.unmapped)
+  print_report(report)
+  if args.out is not None:
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Replay captured API traffic and report latencies')
+  parser.add_argument('captures', type=str, nargs='+', help='capture directories or capture-*.jsonl files')
+  parser.add_argument('--target', type=str, default='http://localhost:8000', help='base url of the server')
+  parser.add_argument('--speed', type=float, default=1., help='1 replays in real time, 4 four times faster')
+  parser.add_argument('--concurrency', type=int, default=64, help='maximum requests in flight')
+  parser.add_argument('--timeout', type=float, default=60., help='seconds before a request fails')
+  parser.add_argument('--paths', type=str, nargs='*', default=None, help='only replay paths starting with these')
+  parser.add_argument('--limit', type=int, default=None, help='only replay the first requests')
+  parser.add_argument('--out', type=str, default=None, help='write the report as JSON')
+  main(parser.parse_args())
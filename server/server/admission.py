@@ -0,0 +1,204 @@
+import math
+import time
+import threading
+from os import environ as env
+from collections import OrderedDict
+from typing import Optional, List, Dict
+from pydantic import BaseModel
+
+# Clicks should start processing within this many seconds of being accepted
+QUEUE_SLO_SECONDS = float(env.get('ADMISSION_QUEUE_SLO', 20))
+# Background work is shed (instead of deferred) past this multiple of the SLO
+SHED_FACTOR = float(env.get('ADMISSION_SHED_FACTOR', 3))
+WORKER_CONCURRENCY = int(env.get('ADMISSION_WORKER_CONCURRENCY', 1))
+GLOBAL_RATE = float(env.get('ADMISSION_GLOBAL_RATE', 20))  # requests per second
+GLOBAL_BURST = float(env.get('ADMISSION_GLOBAL_BURST', 40))
+USER_RATE = float(env.get('ADMISSION_USER_RATE', 1))
+USER_BURST = float(env.get('ADMISSION_USER_BURST', 5))
+MAX_TRACKED_USERS = 10000
+# Used until the workers have reported any latencies
+DEFAULT_SERVICE_SECONDS = {'click_task': 10., 'chat_task': 5., 'prepare_task': 2.}
+LATENCY_SAMPLES = 100
+DEPTH_CACHE_SECONDS = 0.5
+# Connections to the broker's Redis per process; callers wait for a free one past this
+REDIS_POOL_SIZE = int(env.get('REDIS_POOL_SIZE', 50))
+
+class TokenBucket:
+  '''Token bucket rate limiter.
+  :param rate: tokens added per second
+  :param burst: maximum number of tokens
+  '''
+  def __init__(self, rate: float, burst: float):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated_at = time.monotonic()
+    self.lock = threading.Lock()
+
+  def try_acquire(self, tokens: float = 1.) -> float:
+    '''Take tokens if available.
+    :return: 0 if acquired, otherwise seconds until enough tokens are available
+    '''
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+      self.updated_at = now
+      if self.tokens >= tokens:
+        self.tokens -= tokens
+        return 0.
+      return (tokens - self.tokens) / self.rate
+
+class AdmissionDecision(BaseModel):
+  '''Outcome of admission control.
+  :param admitted: whether the request may be enqueued
+  :param defer_seconds: delay before the task should run (background work only)
+  :param retry_after: seconds the client should wait before retrying, if rejected
+  :param reason: why the request was rejected or deferred
+  :param estimated_wait: estimated queue wait in seconds
+  '''
+  admitted: bool
+  defer_seconds: float = 0.
+  retry_after: float = 0.
+  reason: Optional[str] = None
+  estimated_wait: float = 0.
+
+_redis = None
+_depth_cache: Dict[str, tuple] = {}
+_global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+_user_buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+_lock = threading.Lock()
+
+def get_redis():
+  '''Redis client for the broker, created on first use.'''
+  global _redis
+  if _redis is None:
+    import redis
+    pool = redis.BlockingConnectionPool.from_url(
+      env['BROKER_URL'],
+      max_connections=REDIS_POOL_SIZE,
+      timeout=0.5,
+      socket_timeout=0.5,
+      socket_connect_timeout=0.5,
+    )
+    _redis = redis.Redis(connection_pool=pool)
+  return _redis
+
+def close_redis():
+  '''Close the connections of `get_redis`; the next call opens a new pool.'''
+  global _redis
+  if _redis is not None:
+    _redis.connection_pool.disconnect()
+    _redis = None
+
+def latency_key(stage: str) -> str:
+  return f'seeclickbuy:latency:{stage}'
+
+def record_latency(stage: str, seconds: float):
+  '''Record how long a task or stage took; called from the workers.
+  :param stage: e.g. `click_task` or `click_task.search`
+  :param seconds: duration
+  '''
+  try:
+    pipe = get_redis().pipeline()
+    pipe.lpush(latency_key(stage), f'{seconds:.4f}')
+    pipe.ltrim(latency_key(stage), 0, LATENCY_SAMPLES - 1)
+    pipe.execute()
+  except Exception as e:
+    print(f'Error recording latency for {stage}: {e}')
+
+def fetch_latencies(stage: str) -> List[float]:
+  '''Most recent durations of a stage, newest first.'''
+  return [float(x) for x in get_redis().lrange(latency_key(stage), 0, LATENCY_SAMPLES - 1)]
+
+def fetch_latency_summary(stages: List[str]) -> Dict[str, Dict[str, float]]:
+  '''Count, mean and p90 of recent durations per stage.'''
+  summary = {}
+  for stage in stages:
+    samples = sorted(fetch_latencies(stage))
+    if len(samples) == 0:
+      continue
+    summary[stage] = {
+      'count': len(samples),
+      'mean': sum(samples) / len(samples),
+      'p90': samples[min(len(samples) - 1, int(0.9 * len(samples)))],
+    }
+  return summary
+
+def queue_depth(queue: str = 'standard') -> int:
+  '''Number of messages waiting in a broker queue (cached briefly).'''
+  now = time.monotonic()
+  cached = _depth_cache.get(queue)
+  if cached is not None and now - cached[0] < DEPTH_CACHE_SECONDS:
+    return cached[1]
+  depth = int(get_redis().llen(queue))
+  _depth_cache[queue] = (now, depth)
+  return depth
+
+def service_seconds(task: str) -> float:
+  '''Mean recent duration of a task.'''
+  samples = fetch_latencies(task)
+  if len(samples) == 0:
+    return DEFAULT_SERVICE_SECONDS.get(task, 10.)
+  return sum(samples) / len(samples)
+
+def estimate_queue_wait(queue: str = 'standard', task: str = 'click_task') -> float:
+  '''Estimate how long a newly enqueued task waits before a worker picks it up.'''
+  return queue_depth(queue) * service_seconds(task) / max(WORKER_CONCURRENCY, 1)
+
+def get_user_bucket(user_id: str) -> 'TokenBucket':
+  with _lock:
+    bucket = _user_buckets.pop(user_id, None)
+    if bucket is None:
+      bucket = TokenBucket(USER_RATE, USER_BURST)
+    _user_buckets[user_id] = bucket
+    while len(_user_buckets) > MAX_TRACKED_USERS:
+      _user_buckets.popitem(last=False)
+    return bucket
+
+def admit(
+  user_id: Optional[str],
+  priority: str = 'interactive',
+  queue: str = 'standard',
+  task: str = 'click_task',
+) -> AdmissionDecision:
+  '''Decide whether to accept a request that enqueues worker work.
+  :note: fails open if the broker cannot be reached
+  :param user_id: id of the user, anonymous requests only count against the global limit
+  :param priority: `interactive` requests are rejected when the queue is over the SLO;
+    `background` requests are deferred, then shed when far over the SLO
+  :param queue: broker queue the task goes to
+  :param task: name of the task, used to look up its recent latency
+  :return: the decision
+  '''
+  wait = _global_bucket.try_acquire()
+  if wait > 0:
+    return AdmissionDecision(admitted=False, retry_after=wait, reason='global rate limit')
+  if user_id is not None:
+    wait = get_user_bucket(user_id).try_acquire()
+    if wait > 0:
+      return AdmissionDecision(admitted=False, retry_after=wait, reason='user rate limit')
+  try:
+    estimated_wait = estimate_queue_wait(queue, task)
+  except Exception as e:
+    print(f'Error estimating queue wait: {e}')
+    return AdmissionDecision(admitted=True)
+  if estimated_wait <= QUEUE_SLO_SECONDS:
+    return AdmissionDecision(admitted=True, estimated_wait=estimated_wait)
+  retry_after = estimated_wait - QUEUE_SLO_SECONDS
+  if priority == 'background' and estimated_wait <= SHED_FACTOR * QUEUE_SLO_SECONDS:
+    return AdmissionDecision(
+      admitted=True,
+      defer_seconds=retry_after,
+      reason='queue over latency SLO',
+      estimated_wait=estimated_wait,
+    )
+  return AdmissionDecision(
+    admitted=False,
+    retry_after=retry_after,
+    reason='queue over latency SLO',
+    estimated_wait=estimated_wait,
+  )
+
+def retry_after_header(decision: 'AdmissionDecision') -> Dict[str, str]:
+  '''`Retry-After` header (whole seconds) for a rejected request.'''
+  return {'Retry-After': str(max(1, math.ceil(decision.retry_after)))}
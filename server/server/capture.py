@@ -0,0 +1,267 @@
+'''Opt-in capture of sampled API requests for replay with `scripts/replay.py`.
+
+Each request is one line of `{CAPTURE_DIR}/capture-*-{pid}.jsonl`; files rotate by size and the oldest are deleted.
+Every server process writes its own files, and only deletes its own or those of processes that have exited,
+so a file another worker is still appending to is never unlinked.
+Long strings in JSON bodies (base64 images and frames) are replaced by `{"$blob": sha256}` and written
+once to `{CAPTURE_DIR}/blobs/{sha256}`, so repeated images cost nothing and lines stay small.
+'''
+import os
+import time
+import json
+import queue
+import random
+import hashlib
+import threading
+from os import environ as env
+from os.path import join, exists
+from typing import Dict, Any, List, Optional, Tuple
+
+# Fraction of requests captured (0 disables capture)
+CAPTURE_SAMPLE_RATE = float(env.get('CAPTURE_SAMPLE_RATE', 0))
+CAPTURE_DIR = env.get('CAPTURE_DIR', './cache/capture')
+# A new file is started once the current one is larger than this
+CAPTURE_MAX_FILE_BYTES = int(env.get('CAPTURE_MAX_FILE_BYTES', 64 * 1024 * 1024))
+# Oldest files (and the blobs only they used) are deleted past this many files
+CAPTURE_MAX_FILES = int(env.get('CAPTURE_MAX_FILES', 48))
+# Strings longer than this are stored as blobs
+CAPTURE_INLINE_LIMIT = int(env.get('CAPTURE_INLINE_LIMIT', 1024))
+# Bodies larger than this are not captured; responses larger than this are not kept
+CAPTURE_MAX_BODY_BYTES = int(env.get('CAPTURE_MAX_BODY_BYTES', 32 * 1024 * 1024))
+CAPTURE_MAX_RESPONSE_BYTES = int(env.get('CAPTURE_MAX_RESPONSE_BYTES', 64 * 1024))
+CAPTURE_EXCLUDE_PREFIXES = [p for p in env.get('CAPTURE_EXCLUDE_PREFIXES', '/stats').split(',') if p]
+# Only these headers are kept; everything else (cookies, auth, trace ids) is dropped
+CAPTURE_HEADERS = ['content-type', 'x-timeout', 'x-profile']
+
+def blob_digest(value: str) -> str:
+  return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+def extract_blobs(value: Any, blobs: Dict[str, str], limit: int = CAPTURE_INLINE_LIMIT) -> Any:
+  '''Replace long strings in a JSON value by `{"$blob": sha256}`.
+  :param blobs: filled with the replaced strings, by digest
+  '''
+  if isinstance(value, str) and len(value) > limit:
+    digest = blob_digest(value)
+    blobs[digest] = value
+    return {'$blob': digest}
+  if isinstance(value, list):
+    return [extract_blobs(v, blobs, limit) for v in value]
+  if isinstance(value, dict):
+    return {k: extract_blobs(v, blobs, limit) for k, v in value.items()}
+  return value
+
+def should_capture(path: str, sample_rate: float = CAPTURE_SAMPLE_RATE) -> bool:
+  if any(path.startswith(prefix) for prefix in CAPTURE_EXCLUDE_PREFIXES) or path.endswith('/thumbnail'):
+    return False
+  return sample_rate > 0 and random.random() < sample_rate
+
+def build_record(
+  scope: Dict[str, Any],
+  body: Optional[bytes],
+  status: Optional[int],
+  response: Optional[bytes],
+  start_time: float,
+  end_time: float,
+) -> Tuple[Dict[str, Any], Dict[str, str]]:
+  '''Line written for one request.
+  :param body: request body, None if it was too large to keep
+  :param response: response body, None if it was too large or not JSON
+  :return: (record, blobs it references)
+  '''
+  headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+  blobs: Dict[str, str] = {}
+  record = {
+    'ts': start_time,
+    'method': scope['method'],
+    'path': scope['path'],
+    'query': scope.get('query_string', b'').decode('latin-1'),
+    'headers': {k: headers[k] for k in CAPTURE_HEADERS if k in headers},
+    'body': None,
+    'status': status,
+    'latency_ms': round(1000 * (end_time - start_time), 2),
+    'response': None,
+  }
+  if body is None:
+    record['body_skipped'] = True
+  elif len(body) > 0:
+    try:
+      record['body'] = extract_blobs(json.loads(body), blobs)
+    except ValueError:
+      # Not JSON; keep the raw body as a blob
+      record['body'] = extract_blobs(body.decode('utf-8', errors='replace'), blobs, limit=0)
+  if response is not None:
+    try:
+      record['response'] = extract_blobs(json.loads(response), blobs)
+    except ValueError:
+      pass
+  return record, blobs
+
+class CaptureWriter:
+  '''Writes records from a background thread so requests never wait on the disk.
+  :note: records are dropped when the queue is full
+  '''
+  def __init__(
+    self,
+    capture_dir: str = CAPTURE_DIR,
+    max_file_bytes: int = CAPTURE_MAX_FILE_BYTES,
+    max_files: int = CAPTURE_MAX_FILES,
+    max_queue: int = 1000,
+  ):
+    self.capture_dir = capture_dir
+    self.max_file_bytes = max_file_bytes
+    self.max_files = max_files
+    self.queue: 'queue.Queue[Tuple[Dict[str, Any], Dict[str, str]]]' = queue.Queue(max_queue)
+    self.file = None
+    self.num_dropped = 0
+    os.makedirs(join(capture_dir, 'blobs'), exist_ok=True)
+    self.thread = threading.Thread(target=self.run, name='capture-writer', daemon=True)
+    self.thread.start()
+
+  def submit(self, record: Dict[str, Any], blobs: Dict[str, str]):
+    try:
+      self.queue.put_nowait((record, blobs))
+    except queue.Full:
+      self.num_dropped += 1
+
+  def run(self):
+    while True:
+      record, blobs = self.queue.get()
+      try:
+        self.write(record, blobs)
+      except Exception as e:
+        print(f'Error writing capture record: {e}')
+
+  def write(self, record: Dict[str, Any], blobs: Dict[str, str]):
+    for digest, value in blobs.items():
+      path = join(self.capture_dir, 'blobs', digest)
+      if exists(path):
+        # Touch it so pruning sees it is still referenced
+        os.utime(path)
+        continue
+      # Write then rename so the replay tool never reads a partial blob
+      with open(f'{path}.tmp', 'w') as f:
+        f.write(value)
+      os.replace(f'{path}.tmp', path)
+    if self.file is None or self.file.tell() > self.max_file_bytes:
+      self.rotate()
+    self.file.write(json.dumps(record) + '\n')
+    self.file.flush()
+
+  def rotate(self):
+    if self.file is not None:
+      self.file.close()
+    name = f"capture-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl"
+    self.file = open(join(self.capture_dir, name), 'a')
+    prune_captures(self.capture_dir, self.max_files, keep=self.file.name)
+
+def capture_file_pid(path: str) -> Optional[int]:
+  '''Pid of the process that wrote a capture file, from its name.'''
+  try:
+    return int(os.path.basename(path)[:-len('.jsonl')].rsplit('-', 1)[1])
+  except (IndexError, ValueError):
+    return None
+
+def is_process_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # Exists, owned by another user
+    return True
+  return True
+
+def capture_file_created_at(path: str) -> float:
+  '''Creation time of a capture file, from its name.'''
+  return time.mktime(time.strptime(os.path.basename(path)[len('capture-'):][:15], '%Y%m%d-%H%M%S'))
+
+def list_capture_files(capture_dir: str = CAPTURE_DIR) -> List[str]:
+  '''Capture files, oldest first.'''
+  paths = [join(capture_dir, name) for name in os.listdir(capture_dir) if name.startswith('capture-') and name.endswith('.jsonl')]
+  return sorted(paths, key=os.path.getmtime)
+
+def prune_captures(capture_dir: str = CAPTURE_DIR, max_files: int = CAPTURE_MAX_FILES, keep: Optional[str] = None):
+  '''Delete the oldest capture files past `max_files`, and blobs older than every remaining file.
+  :note: only files of this process or of exited processes are deleted, since other workers append to theirs
+  :param keep: file this process is writing to
+  '''
+  paths = list_capture_files(capture_dir)
+  num_excess = len(paths) - max_files
+  for path in list(paths):
+    if num_excess <= 0:
+      break
+    pid = capture_file_pid(path)
+    if path == keep or (pid is not None and pid != os.getpid() and is_process_alive(pid)):
+      continue
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    paths.remove(path)
+    num_excess -= 1
+  if len(paths) == 0:
+    return
+  # Blobs are written or touched whenever a line references them, so blobs older than
+  # the creation of the oldest remaining file are only referenced by deleted files
+  oldest = min(capture_file_created_at(path) for path in paths)
+  blob_dir = join(capture_dir, 'blobs')
+  for name in os.listdir(blob_dir):
+    path = join(blob_dir, name)
+    try:
+      if os.path.getmtime(path) < oldest:
+        os.remove(path)
+    except FileNotFoundError:
+      pass
+
+class CaptureMiddleware:
+  '''ASGI middleware recording sampled requests with `CaptureWriter`.
+  Written against raw ASGI so the body can be read without consuming it for the route.
+  :param sample_rate: fraction of requests captured
+  '''
+  def __init__(self, app, sample_rate: float = CAPTURE_SAMPLE_RATE, capture_dir: str = CAPTURE_DIR):
+    self.app = app
+    self.sample_rate = sample_rate
+    self.writer = CaptureWriter(capture_dir)
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http' or not should_capture(scope['path'], self.sample_rate):
+      return await self.app(scope, receive, send)
+    body: Optional[bytearray] = bytearray()
+    response: Optional[bytearray] = bytearray()
+    status: Optional[int] = None
+
+    async def capture_receive():
+      nonlocal body
+      message = await receive()
+      if message['type'] == 'http.request' and body is not None:
+        body += message.get('body', b'')
+        if len(body) > CAPTURE_MAX_BODY_BYTES:
+          body = None
+      return message
+
+    async def capture_send(message):
+      nonlocal status, response
+      if message['type'] == 'http.response.start':
+        status = message['status']
+        headers = dict(message.get('headers', []))
+        if not headers.get(b'content-type', b'').startswith(b'application/json'):
+          response = None
+      elif message['type'] == 'http.response.body' and response is not None:
+        response += message.get('body', b'')
+        if len(response) > CAPTURE_MAX_RESPONSE_BYTES:
+          response = None
+      await send(message)
+
+    start_time = time.time()
+    try:
+      await self.app(scope, capture_receive, capture_send)
+    finally:
+      record, blobs = build_record(
+        scope,
+        bytes(body) if body is not None else None,
+        status,
+        bytes(response) if response is not None else None,
+        start_time,
+        time.time(),
+      )
+      self.writer.submit(record, blobs)
@@ -0,0 +1,203 @@
+import os
+import time
+import json
+from os import environ as env
+from os.path import join, isfile
+from typing import Dict, Any, List, Set, Tuple
+from firebase_admin import firestore, storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from .admission import TokenBucket
+from .similarity import remove_indexed_items
+
+# Firestore allows at most 500 writes per batch
+COMPACTION_BATCH_SIZE = int(env.get('COMPACTION_BATCH_SIZE', 200))
+COMPACTION_MAX_WRITES_PER_SECOND = float(env.get('COMPACTION_MAX_WRITES_PER_SECOND', 100))
+# Either delete superseded items outright or move them to `ArchivedItems`
+COMPACTION_ARCHIVE = env.get('COMPACTION_ARCHIVE', 'false').lower() == 'true'
+CACHE_TTL_SECONDS = int(env.get('CACHE_TTL_SECONDS', 7 * 24 * 3600))
+# Only blobs older than this are considered, so in-flight clicks are never touched
+MASK_TTL_SECONDS = int(env.get('MASK_TTL_SECONDS', 24 * 3600))
+# Subdirectories of the cache that manage their own eviction
+MANAGED_CACHE_DIRS = ['thumbnails', 'item_index', 'profiles', 'capture']
+
+def estimate_document_bytes(doc_id: str, data: Dict[str, Any]) -> int:
+  '''Rough storage size of a Firestore document (name + encoded fields + overhead).'''
+  return len(doc_id) + len(json.dumps(data, default=str)) + 32
+
+def wait_for_writes(bucket: 'TokenBucket', num_writes: int):
+  '''Block until the rate limit allows `num_writes` more writes.'''
+  while True:
+    wait = bucket.try_acquire(num_writes)
+    if wait <= 0:
+      return
+    time.sleep(wait)
+
+def fetch_fingerprinted_versions(db: 'firestore.Client') -> Set[Tuple[str, int]]:
+  '''(click_id, version) of the items that completed dedup results are copied from (`dedup.copy_click_result`).'''
+  versions = set()
+  for fb_fingerprint in db.collection('Fingerprints').where('status', '==', 'done').select(['click_id', 'version']).stream():
+    data = fb_fingerprint.to_dict()
+    if data.get('click_id') is not None and data.get('version') is not None:
+      versions.add((data['click_id'], data['version']))
+  return versions
+
+def compact_superseded_items(
+  db: 'firestore.Client',
+  archive: bool = COMPACTION_ARCHIVE,
+  batch_size: int = COMPACTION_BATCH_SIZE,
+  max_writes_per_second: float = COMPACTION_MAX_WRITES_PER_SECOND,
+  dry_run: bool = False,
+) -> Dict[str, int]:
+  '''Delete (or archive) non-favorite items from versions older than their click's current version.
+  :note: favorites are kept since `fetch_favorite_items_for_click` reads every version, and so are the items
+    of versions that a completed fingerprint copies to identical clicks (see `fetch_fingerprinted_versions`)
+  :param archive: copy items to `ArchivedItems` before deleting them
+  :param batch_size: documents per batched write
+  :param max_writes_per_second: rate limit on writes
+  :param dry_run: only count what would be reclaimed
+  :note: deleted items are also removed from the local match index (`server.similarity`)
+  :return: number of clicks visited, documents reclaimed and estimated bytes reclaimed
+  '''
+  writes_per_item = 2 if archive else 1
+  bucket = TokenBucket(max_writes_per_second, max(max_writes_per_second, batch_size * writes_per_item))
+  report = {'clicks': 0, 'documents': 0, 'bytes': 0}
+  pending: List['firestore.DocumentSnapshot'] = []
+  deleted_ids: List[str] = []
+
+  def flush():
+    if len(pending) == 0 or dry_run:
+      pending.clear()
+      return
+    wait_for_writes(bucket, len(pending) * writes_per_item)
+    batch = db.batch()
+    for fb_item in pending:
+      if archive:
+        batch.set(db.collection('ArchivedItems').document(fb_item.id), fb_item.to_dict())
+      batch.delete(fb_item.reference)
+    batch.commit()
+    deleted_ids.extend(fb_item.id for fb_item in pending)
+    pending.clear()
+
+  fingerprinted = fetch_fingerprinted_versions(db)
+  fb_clicks = db.collection('Clicks').where('version', '>', 1).select(['version']).stream()
+  for fb_click in fb_clicks:
+    report['clicks'] += 1
+    fb_items = db.collection('Items')\
+      .where('click_id', '==', fb_click.id)\
+      .where('version', '<', fb_click.get('version'))\
+      .stream()
+    for fb_item in fb_items:
+      data = fb_item.to_dict()
+      if data.get('is_favorite', False) or (fb_click.id, data.get('version')) in fingerprinted:
+        continue
+      report['documents'] += 1
+      report['bytes'] += estimate_document_bytes(fb_item.id, data)
+      pending.append(fb_item)
+      if len(pending) >= batch_size:
+        flush()
+  flush()
+  try:
+    remove_indexed_items(deleted_ids)
+  except Exception as e:
+    print(f'Error removing compacted items from the local index: {e}')
+  return report
+
+def expire_cache_files(cache_dir: str = './cache', ttl: int = CACHE_TTL_SECONDS, dry_run: bool = False) -> Dict[str, int]:
+  '''Delete images and masks in the local cache that have not been modified within `ttl` seconds.
+  :return: number of files and bytes reclaimed
+  '''
+  report = {'files': 0, 'bytes': 0}
+  if not os.path.isdir(cache_dir):
+    return report
+  now = time.time()
+  for name in os.listdir(cache_dir):
+    path = join(cache_dir, name)
+    if name in MANAGED_CACHE_DIRS or not isfile(path):
+      continue
+    stat = os.stat(path)
+    if now - stat.st_mtime < ttl:
+      continue
+    if not dry_run:
+      os.remove(path)
+    report['files'] += 1
+    report['bytes'] += stat.st_size
+  return report
+
+def fetch_referenced_urls(db: 'firestore.Client') -> Set[str]:
+  '''Urls of every image and mask that a click or a stored dedup result points to.'''
+  urls = set()
+  for fb_click in db.collection('Clicks').select(['image_url', 'masked_url']).stream():
+    data = fb_click.to_dict()
+    urls.update(url for url in [data.get('image_url'), data.get('masked_url')] if url is not None)
+  # Results in `Fingerprints` are copied into new clicks long after the click that produced them
+  for fb_fingerprint in db.collection('Fingerprints').select(['result.image_url', 'result.masked_url']).stream():
+    result = fb_fingerprint.to_dict().get('result') or {}
+    urls.update(url for url in [result.get('image_url'), result.get('masked_url')] if url is not None)
+  return urls
+
+def expire_orphaned_blobs(
+  db: 'firestore.Client',
+  prefixes: List[str] = ['images/', 'masks/'],
+  ttl: int = MASK_TTL_SECONDS,
+  max_writes_per_second: float = COMPACTION_MAX_WRITES_PER_SECOND,
+  dry_run: bool = False,
+) -> Dict[str, int]:
+  '''Delete image and mask blobs that no click points to anymore.
+  This covers blobs of deleted clicks and masks replaced by a refinement.
+  :note: blobs are content-addressed and shared between clicks, so references are checked across all clicks.
+    A click reusing a blob touches it (`upload_content_addressed`), so a blob touched after it was listed
+    fails the metageneration precondition of the delete and is kept.
+  :return: number of blobs and bytes reclaimed
+  '''
+  bucket = TokenBucket(max_writes_per_second, max_writes_per_second)
+  report = {'blobs': 0, 'bytes': 0}
+  now = time.time()
+  # List blobs before reading references; a click committing a listed blob in between touched it first
+  blobs = [
+    blob for prefix in prefixes for blob in storage.bucket().list_blobs(prefix=prefix)
+    if blob.updated is not None and now - blob.updated.timestamp() >= ttl
+  ]
+  referenced_urls = fetch_referenced_urls(db)
+  for blob in blobs:
+    if blob.public_url in referenced_urls:
+      continue
+    if not dry_run:
+      wait_for_writes(bucket, 1)
+      try:
+        blob.delete(if_generation_match=blob.generation, if_metageneration_match=blob.metageneration)
+      except (PreconditionFailed, NotFound):
+        # Touched or re-uploaded since it was listed
+        continue
+    report['blobs'] += 1
+    report['bytes'] += blob.size or 0
+  return report
+
+def run_compaction(db: 'firestore.Client', cache_dir: str = './cache', dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+  '''Run every compaction step.
+  :return: report of what each step reclaimed
+  '''
+  return {
+    'items': compact_superseded_items(db, dry_run=dry_run),
+    'cache': expire_cache_files(cache_dir, dry_run=dry_run),
+    'blobs': expire_orphaned_blobs(db, dry_run=dry_run),
+  }
+
+def record_compaction_report(db: 'firestore.Client', report: Dict[str, Dict[str, int]]):
+  '''Add a report from `run_compaction` to the running totals in `Stats/compaction`.'''
+  try:
+    db.collection('Stats').document('compaction').set({
+      'documents': firestore.Increment(report['items']['documents']),
+      'document_bytes': firestore.Increment(report['items']['bytes']),
+      'files': firestore.Increment(report['cache']['files']),
+      'file_bytes': firestore.Increment(report['cache']['bytes']),
+      'blobs': firestore.Increment(report['blobs']['blobs']),
+      'blob_bytes': firestore.Increment(report['blobs']['bytes']),
+      'last_run_at': firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+  except Exception as e:
+    print(f'Error recording compaction report: {e}')
+
+def fetch_compaction_stats(db: 'firestore.Client') -> Dict[str, Any]:
+  '''Fetch totals reclaimed by compaction so far.'''
+  fb_stats = db.collection('Stats').document('compaction').get()
+  return fb_stats.to_dict() if fb_stats.exists else {}
@@ -1,10 +1,68 @@
 import time
-from typing import List, Dict, Any
+import base64
+from typing import List, Dict, Any, Optional, Tuple
 from serpapi import GoogleSearch
 from firebase_admin import firestore
-from .schemas import ClickCreate, Click, ClickUpdate, ChatCreate, Chat, Item
+from .schemas import ClickCreate, Click, ClickUpdate, ClickMaskUpdate, ChatCreate, Chat, Item
+from .schemas import ClickSummary, ItemSummary, ClickSummaryPage, ItemSummaryPage
+from .schemas import CLICK_SUMMARY_FIELDS, ITEM_SUMMARY_FIELDS
 from .schemas import click_to_pydantic, chat_to_pydantic, item_to_pydantic
+from .schemas import clicks_to_pydantic, items_to_pydantic
+from .schemas import click_summaries_to_pydantic, item_summaries_to_pydantic
+from .tracing import traced, span
+from .similarity import index_items_in_background
+from .views import update_click_views, set_top_items, set_favorite_in_views
 
+def encode_cursor(created_at: int, doc_id: str) -> str:
+  '''Encode a pagination cursor from the last document of a page.
+  :param created_at: creation timestamp of the document
+  :param doc_id: id of the document
+  :return: opaque url-safe cursor
+  '''
+  return base64.urlsafe_b64encode(f'{created_at}:{doc_id}'.encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+  '''Decode a cursor from `encode_cursor`.
+  :return: created_at, doc_id
+  '''
+  try:
+    created_at, doc_id = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8').split(':', 1)
+    return int(created_at), doc_id
+  except Exception:
+    raise ValueError(f'Invalid cursor {cursor}')
+
+def next_cursor(created_ats: List[int], doc_ids: List[str], limit: int) -> Optional[str]:
+  '''Cursor for the page after this one.
+  :return: None if the page was not full (there is nothing after it)
+  '''
+  if len(doc_ids) < limit or len(doc_ids) == 0:
+    return None
+  return encode_cursor(created_ats[-1], doc_ids[-1])
+
+def paginate_query(
+  db: 'firestore.Client',
+  collection: str,
+  fb_query: 'firestore.Query',
+  limit: int,
+  start_after: Optional[str] = None,
+) -> 'firestore.Query':
+  '''Order a query newest first and start it after a cursor.
+  :note: the doc id breaks ties between documents created in the same second
+  :param collection: collection the query reads from
+  :param start_after: cursor from `encode_cursor`
+  '''
+  fb_query = fb_query\
+    .order_by('created_at', direction=firestore.Query.DESCENDING)\
+    .order_by('__name__', direction=firestore.Query.DESCENDING)
+  if start_after is not None:
+    created_at, doc_id = decode_cursor(start_after)
+    fb_query = fb_query.start_after({
+      'created_at': created_at, 
+      '__name__': db.collection(collection).document(doc_id),
+    })
+  return fb_query.limit(limit)
+
+@traced('firestore.create_click')
 def create_click(db: 'firestore.Client', click_request: 'ClickCreate') -> Click:
   '''Create a click document in firebase.
   :note: it sets `is_processed` to `False` and waits for the job to set it to `True`
@@ -22,8 +80,10 @@ def create_click(db: 'firestore.Client', click_request: 'ClickCreate') -> Click:
   )
   _, click_ref = db.collection('Clicks').add(click.model_dump())
   click.click_id = click_ref.id
+  update_click_views(db, click.click_id)
   return click
 
+@traced('firestore.update_click')
 def update_click(db: 'firestore.Client', click_id: str, update_request: 'ClickUpdate') -> Click:
   '''Update a click document in firebase.
   :note: this sets `is_processed` to `True`
@@ -41,13 +101,54 @@ def update_click(db: 'firestore.Client', click_id: str, update_request: 'ClickUp
     'masked_url': update_request.masked_url,
     'masked_size': update_request.masked_size,
     'description': update_request.description,
+    'degradations': update_request.degradations,
+    # A new mask starts without refinements
+    'refine_points': None,
     'is_processed': True,
     'updated_at': now,
   })
   click_doc = click_ref.get()
   click = click_to_pydantic(click_doc, click_id)
+  update_click_views(db, click_id, fields=['image_url', 'masked_url', 'description', 'is_processed'])
   return click
 
+@traced('firestore.mark_click_failed')
+def mark_click_failed(db: 'firestore.Client', click_id: str, degradation: str):
+  '''Stop clients waiting on a click whose task failed.
+  :note: this sets `is_processed` to `True` and records why in `degradations`
+  :param degradation: e.g. `pipeline:error`
+  '''
+  db.collection('Clicks').document(click_id).update({
+    'is_processed': True,
+    'degradations': firestore.ArrayUnion([degradation]),
+    'updated_at': int(time.time()),
+  })
+  update_click_views(db, click_id, fields=['is_processed'])
+
+@traced('firestore.update_click_mask')
+def update_click_mask(db: 'firestore.Client', click_id: str, update_request: 'ClickMaskUpdate') -> Click:
+  '''Replace the mask of a click after a refinement.
+  :note: this sets `is_processed` to `True`
+  '''
+  now = int(time.time())
+  click_ref = db.collection('Clicks').document(click_id)
+  try:
+    click_ref.update({
+      'bbox': update_request.bbox,
+      'segm': update_request.segm,
+      'masked_url': update_request.masked_url,
+      'masked_size': update_request.masked_size,
+      'refine_points': [point.model_dump() for point in update_request.refine_points or []],
+      'is_processed': True,
+      'updated_at': now,
+    })
+  except Exception as e:
+    raise ValueError(f'Failed to update mask for click {click_id}: {e}')
+  update_click_views(db, click_id, fields=['masked_url', 'is_processed'])
+  click = fetch_click_by_id(db, click_id)
+  return click
+
+@traced('firestore.fetch_click_by_id')
 def fetch_click_by_id(db: 'firestore.Client', click_id: str) -> Click:
   '''Fetch a click document by id.
   '''
@@ -56,53 +157,148 @@ def fetch_click_by_id(db: 'firestore.Client', click_id: str) -> Click:
     raise ValueError(f'Click with id {click_id} does not exist')
   return click_to_pydantic(fb_click, click_id)
 
-def create_chat(
-  db: 'firestore.Client', 
-  chat_request: 'ChatCreate',
-  pre_description: str,
-  post_description: str,
-  version: int,
-  ) -> Chat:
-  '''Create a click document in firebase.
-  :note: this does not validate that the click if valid
+@traced('firestore.create_pending_chat')
+def create_pending_chat(db: 'firestore.Client', chat_request: 'ChatCreate') -> Tuple[Click, Chat, bool]:
+  '''Record a chat whose edit runs in the worker, and make it the latest chat of its click.
+  :note: the same text sent again while the latest chat is in flight returns that chat
+  :return: click, chat, whether the chat is new and needs a `chat_task`
   '''
-  now = int(time.time())
-  chat = Chat(
-    click_id=chat_request.click_id,
-    text=chat_request.text,
-    pre_description=pre_description,
-    post_description=post_description,
-    version=version,
-    created_at=now,
-    updated_at=now,
-  )
-  _, chat_ref = db.collection('Chats').add(chat.model_dump())
-  chat.chat_id = chat_ref.id
-  return chat
+  click_ref = db.collection('Clicks').document(chat_request.click_id)
+  chat_ref = db.collection('Chats').document()
 
-def upgrade_click_description_version(db: 'firestore.Client', click_id: str, new_description: str) -> Click:
-  '''Upgrade the version of a click.
-  :param click_id: id of the click
-  :param new_description: new description
-  :return: the updated click
+  @firestore.transactional
+  def create(transaction: 'firestore.Transaction') -> Tuple[Click, Chat, bool]:
+    fb_click = click_ref.get(transaction=transaction)
+    if not fb_click.exists:
+      raise ValueError(f'Click with id {chat_request.click_id} does not exist')
+    click = click_to_pydantic(fb_click, chat_request.click_id)
+    if click.description is None:
+      raise ValueError(f'Click {chat_request.click_id} description is not available')
+    if click.latest_chat_id is not None:
+      fb_latest = db.collection('Chats').document(click.latest_chat_id).get(transaction=transaction)
+      if fb_latest.exists:
+        latest = chat_to_pydantic(fb_latest, fb_latest.id)
+        if latest.status in ('pending', 'streaming') and latest.text.strip().lower() == chat_request.text.strip().lower():
+          return click, latest, False
+    now = int(time.time())
+    chat = Chat(
+      click_id=chat_request.click_id,
+      text=chat_request.text,
+      pre_description=click.description,
+      version=click.version,
+      status='pending',
+      created_at=now,
+      updated_at=now,
+    )
+    transaction.set(chat_ref, chat.model_dump())
+    transaction.update(click_ref, {'latest_chat_id': chat_ref.id, 'is_processed': False, 'updated_at': now})
+    chat.chat_id = chat_ref.id
+    click.latest_chat_id = chat_ref.id
+    click.is_processed = False
+    click.updated_at = now
+    return click, chat, True
+
+  # `is_processed` is only unset until `complete_chat`, which updates the feed, so the feed is left alone
+  return create(db.transaction())
+
+@traced('firestore.fetch_chat_by_id')
+def fetch_chat_by_id(db: 'firestore.Client', chat_id: str) -> Chat:
+  '''Fetch a chat document by id.
   '''
-  now = int(time.time())
-  click_ref = db.collection('Clicks').document(click_id)
-  click_doc = click_ref.get()
-  if not click_doc.exists:
-    raise ValueError(f'Click with id {click_id} does not exist')
-  click = click_to_pydantic(click_doc, click_id)
+  fb_chat = db.collection('Chats').document(chat_id).get()
+  if not fb_chat.exists:
+    raise ValueError(f'Chat with id {chat_id} does not exist')
+  return chat_to_pydantic(fb_chat, chat_id)
+
+@traced('firestore.update_chat_status')
+def update_chat_status(db: 'firestore.Client', chat_id: str, status: str, post_description: Optional[str] = None):
+  '''Update the status of a chat, and the edited description streamed so far.
+  '''
+  update = {'status': status, 'updated_at': int(time.time())}
+  if post_description is not None:
+    update['post_description'] = post_description
   try:
-    click_ref.update({
+    db.collection('Chats').document(chat_id).update(update)
+  except Exception as e:
+    raise ValueError(f'Failed to update chat {chat_id}: {e}')
+
+@traced('firestore.complete_chat')
+def complete_chat(db: 'firestore.Client', chat_id: str, new_description: str) -> Optional[Click]:
+  '''Apply the edited description of a chat to its click, unless a newer chat replaced it.
+  :note: the click moves to a new version, so items searched next replace the current ones
+  :param chat_id: id of the chat
+  :param new_description: edited description
+  :return: the updated click, None if the chat was superseded
+  '''
+  chat_ref = db.collection('Chats').document(chat_id)
+
+  @firestore.transactional
+  def complete(transaction: 'firestore.Transaction') -> Optional[str]:
+    fb_chat = chat_ref.get(transaction=transaction)
+    if not fb_chat.exists:
+      raise ValueError(f'Chat with id {chat_id} does not exist')
+    click_id = fb_chat.get('click_id')
+    click_ref = db.collection('Clicks').document(click_id)
+    fb_click = click_ref.get(transaction=transaction)
+    if not fb_click.exists:
+      raise ValueError(f'Click with id {click_id} does not exist')
+    click = click_to_pydantic(fb_click, click_id)
+    now = int(time.time())
+    if click.latest_chat_id != chat_id:
+      transaction.update(chat_ref, {'post_description': new_description, 'status': 'superseded', 'updated_at': now})
+      return None
+    # Items of the new version are only searched after this, so the old top items go away
+    transaction.update(click_ref, {
       'description': new_description,
       'version': click.version + 1,
+      'top_items': [],
+      'top_items_version': click.version + 1,
       'updated_at': now,
     })
-  except Exception as e:
-    raise ValueError(f'Failed to upgrade click version: {e}')
-  click = fetch_click_by_id(db, click_id)
-  return click
+    transaction.update(chat_ref, {'post_description': new_description, 'status': 'done', 'updated_at': now})
+    return click_id
+
+  click_id = complete(db.transaction())
+  if click_id is None:
+    return None
+  update_click_views(db, click_id, fields=['description', 'version', 'top_items'])
+  return fetch_click_by_id(db, click_id)
+
+@traced('firestore.upgrade_click_version')
+def upgrade_click_version(db: 'firestore.Client', click_id: str, from_version: int) -> Optional[Click]:
+  '''Upgrade the version of a click, so items searched for the next version replace the current ones.
+  :note: runs in a transaction so it does not race with `complete_chat`, which also moves the version
+  :param click_id: id of the click
+  :param from_version: version the caller searched from; nothing changes if the click moved on since
+  :return: the updated click, None if the click is no longer at `from_version`
+  '''
+  click_ref = db.collection('Clicks').document(click_id)
+
+  @firestore.transactional
+  def upgrade(transaction: 'firestore.Transaction') -> bool:
+    fb_click = click_ref.get(transaction=transaction)
+    if not fb_click.exists:
+      raise ValueError(f'Click with id {click_id} does not exist')
+    if fb_click.get('version') != from_version:
+      return False
+    transaction.update(click_ref, {'version': from_version + 1, 'updated_at': int(time.time())})
+    return True
+
+  if not upgrade(db.transaction()):
+    return None
+  update_click_views(db, click_id, fields=['version'])
+  return fetch_click_by_id(db, click_id)
+
+@traced('firestore.delete_items')
+def delete_items(db: 'firestore.Client', items: List[Item]):
+  '''Delete items, e.g. results of a search whose version was taken by another writer.'''
+  batch = db.batch()
+  for item in items:
+    if item.item_id is not None:
+      batch.delete(db.collection('Items').document(item.item_id))
+  batch.commit()
 
+@traced('firestore.fetch_chats_for_click')
 def fetch_chats_for_click(db: 'firestore.Client', click_id: str, limit: int = 10) -> List[Chat]:
   '''Fetch all chats in order for a given click.
   '''
@@ -116,6 +312,7 @@ def fetch_chats_for_click(db: 'firestore.Client', click_id: str, limit: int = 10
     chats.append(chat)
   return chats
 
+@traced('firestore.fetch_item_by_id')
 def fetch_item_by_id(db: 'firestore.Client', item_id: str) -> Item:
   '''Fetch an item document by id.
   '''
@@ -124,40 +321,102 @@ def fetch_item_by_id(db: 'firestore.Client', item_id: str) -> Item:
     raise ValueError(f'Item with id {item_id} does not exist')
   return item_to_pydantic(fb_item, item_id)
 
-def fetch_items_for_click(db: 'firestore.Client', click_id: str, click_version: int, limit: int = 10) -> List[Item]:
+@traced('firestore.fetch_items_for_click')
+def fetch_items_for_click(
+  db: 'firestore.Client', 
+  click_id: str, 
+  click_version: int, 
+  limit: int = 10,
+  start_after: Optional[str] = None,
+) -> List[Item]:
   '''Fetch all items (search results) for a given click.
   :param click_id: id of the click
   :param click_version: version of the click
   :param limit: maximum number of items to return
+  :param start_after: cursor of the previous page
   :return: list of items
   '''
+  fb_query = db.collection('Items')\
+    .where('click_id', '==', click_id)\
+    .where('version', '==', click_version)
+  fb_query = paginate_query(db, 'Items', fb_query, limit, start_after)
+  items: List[Item] = items_to_pydantic(fb_query.stream())
+  return items
+
+@traced('firestore.fetch_item_summaries_for_click')
+def fetch_item_summaries_for_click(
+  db: 'firestore.Client', 
+  click_id: str, 
+  click_version: int, 
+  limit: int = 10,
+  start_after: Optional[str] = None,
+) -> ItemSummaryPage:
+  '''Fetch a page of item summaries for a given click.
+  :note: only the summary fields are read from firestore
+  :param click_id: id of the click
+  :param click_version: version of the click
+  :param limit: maximum number of items to return
+  :param start_after: cursor of the previous page
+  :return: page of item summaries
+  '''
   fb_query = db.collection('Items')\
     .where('click_id', '==', click_id)\
     .where('version', '==', click_version)\
-    .order_by('created_at', direction=firestore.Query.DESCENDING)\
-    .limit(limit)
+    .select(ITEM_SUMMARY_FIELDS)
+  fb_query = paginate_query(db, 'Items', fb_query, limit, start_after)
+  items: List[ItemSummary] = item_summaries_to_pydantic(fb_query.stream())
+  cursor = next_cursor([item.created_at for item in items], [item.item_id for item in items], limit)
+  return ItemSummaryPage(items=items, next_cursor=cursor)
+
+@traced('firestore.copy_items_to_click')
+def copy_items_to_click(db: 'firestore.Client', item_ids: List[str], click_id: str, click_version: int) -> List[Item]:
+  '''Copy existing items (e.g. local visual matches) into a click.
+  :note: items that no longer exist are skipped, as are repeated links
+  :param item_ids: ids of the items to copy, in order
+  :param click_id: id of the click
+  :param click_version: version of the click
+  :return: list of new items
+  '''
+  now = int(time.time())
+  refs = [db.collection('Items').document(item_id) for item_id in item_ids]
+  fb_items = {fb_item.id: fb_item for fb_item in db.get_all(refs) if fb_item.exists}
+  batch = db.batch()
   items: List[Item] = []
-  for fb_item in fb_query.stream():
-    item = item_to_pydantic(fb_item, fb_item.id)
+  links = set()
+  for item_id in item_ids:
+    if item_id not in fb_items:
+      continue
+    item = item_to_pydantic(fb_items[item_id], item_id)
+    if item.link in links:
+      continue
+    links.add(item.link)
+    item.click_id = click_id
+    item.version = click_version
+    item.is_favorite = False
+    item.created_at = now
+    item.updated_at = now
+    item_ref = db.collection('Items').document()
+    item.item_id = item_ref.id
+    batch.set(item_ref, item.model_dump(exclude={'item_id'}))
     items.append(item)
+  batch.commit()
+  set_top_items(db, click_id, click_version, items)
   return items
 
-def search_items_for_click(
-  db: 'firestore.Client', 
+def fetch_lens_items(
   api_key: str, 
   click_id: str,
   image_url: str,
   click_version: int,
   limit: int = 50,
 ) -> List[Item]:
-  '''Search for items in the click
-  :note: this saves documents to firebase
+  '''Search Google Lens for items matching an image, without saving them.
   :param api_key: api key for serpapi
   :param click_id: id of the click
   :param image_url: url of the image
   :param click_version: version of the click
   :param limit: maximum number of items to return
-  :return: list of items
+  :return: list of items (without an `item_id`)
   '''
   params = {
     "api_key": api_key,
@@ -165,51 +424,74 @@ def search_items_for_click(
     "url": image_url,
   }
   items: List[Item] = []
-  try:
-    search = GoogleSearch(params)
+  search = GoogleSearch(params)
+  with span('serpapi.google_lens'):
     results = search.get_dict()
-    now = int(time.time())
-    if 'visual_matches' in results:
-      count = 0
-      for match in results['visual_matches']:
-        # Make sure critical fields are present
-        if (('title' not in match) or 
-            ('link' not in match) or 
-            ('source' not in match) or
-            ('price' not in match)):
-          continue
-        # Ignore items that are not in stock
-        if not match.get('in_stock', False):
-          continue
-        count += 1
-        # Create the item
-        match: Dict[str, Any] = match
-        item = Item(
-          click_id=click_id,
-          title=match['title'],
-          link=match['link'],
-          source=match['source'],
-          source_icon=match.get('source_icon', None),
-          price_value=match['price']['extracted_value'],
-          price_currency=match['price']['currency'],
-          thumbnail=match.get('thumbnail', None),
-          in_stock=match.get('in_stock', False),
-          is_favorite=False,
-          version=click_version,
-          created_at=now,
-          updated_at=now,
-        )
-        _, item_ref = db.collection('Items').add(item.model_dump())
-        item.item_id = item_ref.id
-        items.append(item)
-        # Stop if we have enough items
-        if count >= limit:
-          print(f'Found {count} items for click {click_id}. Stopping.')
-          break
-  except Exception as e:
-    print(f'Error searching for items: {e}')
+  now = int(time.time())
+  if 'visual_matches' in results:
+    for match in results['visual_matches']:
+      # Make sure critical fields are present
+      if (('title' not in match) or 
+          ('link' not in match) or 
+          ('source' not in match) or
+          ('price' not in match)):
+        continue
+      # Ignore items that are not in stock
+      if not match.get('in_stock', False):
+        continue
+      # Create the item
+      match: Dict[str, Any] = match
+      items.append(Item(
+        click_id=click_id,
+        title=match['title'],
+        link=match['link'],
+        source=match['source'],
+        source_icon=match.get('source_icon', None),
+        price_value=match['price']['extracted_value'],
+        price_currency=match['price']['currency'],
+        thumbnail=match.get('thumbnail', None),
+        in_stock=match.get('in_stock', False),
+        is_favorite=False,
+        version=click_version,
+        created_at=now,
+        updated_at=now,
+      ))
+      # Stop if we have enough items
+      if len(items) >= limit:
+        print(f'Found {len(items)} items for click {click_id}. Stopping.')
+        break
+  return items
+
+@traced('firestore.search_items_for_click')
+def search_items_for_click(
+  db: 'firestore.Client', 
+  api_key: str, 
+  click_id: str,
+  image_url: str,
+  click_version: int,
+  limit: int = 50,
+) -> List[Item]:
+  '''Search for items in the click
+  :note: this saves documents to firebase
+  :param api_key: api key for serpapi
+  :param click_id: id of the click
+  :param image_url: url of the image
+  :param click_version: version of the click
+  :param limit: maximum number of items to return
+  :raises Exception: if the search fails, so callers can tell a failure from a search without results
+  :return: list of items
+  '''
+  items: List[Item] = []
+  for item in fetch_lens_items(api_key, click_id, image_url, click_version, limit):
+    _, item_ref = db.collection('Items').add(item.model_dump())
+    item.item_id = item_ref.id
+    items.append(item)
+  set_top_items(db, click_id, click_version, items)
+  # Make the results searchable locally for future clicks
+  index_items_in_background(items)
   return items
 
+@traced('firestore.search_items_for_text')
 def search_items_for_text(
   db: 'firestore.Client', 
   api_key: str, 
@@ -234,7 +516,8 @@ def search_items_for_text(
   items: List[Item] = []
   try:
     search = GoogleSearch(params)
-    results = search.get_dict()
+    with span('serpapi.google_shopping'):
+      results = search.get_dict()
     now = int(time.time())
     if 'shopping_results' in results:
       count = 0
@@ -271,8 +554,12 @@ def search_items_for_text(
           break
   except Exception as e:
     print(f'Error searching for items: {e}')
+  set_top_items(db, click_id, click_version, items)
+  # Make the results searchable locally for future clicks
+  index_items_in_background(items)
   return items
 
+@traced('firestore.favorite_item')
 def favorite_item(db: 'firestore.Client', item_id: str) -> Item:
   '''Create a favorite document in firebase.
   '''
@@ -286,8 +573,12 @@ def favorite_item(db: 'firestore.Client', item_id: str) -> Item:
   except Exception as e:
     raise ValueError(f'Failed to favorite item: {e}')
   item = item_to_pydantic(fb_item, item_id)
+  item.is_favorite = True
+  item.updated_at = now
+  set_favorite_in_views(db, [item], True)
   return item
 
+@traced('firestore.unfavorite_item')
 def unfavorite_item(db: 'firestore.Client', item_id: str) -> Item:
   '''Unfavorite an item.
   '''
@@ -301,42 +592,113 @@ def unfavorite_item(db: 'firestore.Client', item_id: str) -> Item:
   except Exception as e:
     raise ValueError(f'Failed to unfavorite item: {e}')
   item = item_to_pydantic(fb_item, item_id)
+  item.is_favorite = False
+  item.updated_at = now
+  set_favorite_in_views(db, [item], False)
   return item
 
-def fetch_favorite_items_for_click(db: 'firestore.Client', click_id: str, limit: int = 10) -> List[Item]:
+@traced('firestore.fetch_items_by_ids')
+def fetch_items_by_ids(db: 'firestore.Client', item_ids: List[str]) -> List[Item]:
+  '''Fetch many item documents in a single RPC.
+  :param item_ids: ids of the items
+  :return: items in the order of `item_ids`, skipping ones that do not exist
+  '''
+  refs = [db.collection('Items').document(item_id) for item_id in item_ids]
+  fb_items = {fb_item.id: fb_item for fb_item in db.get_all(refs) if fb_item.exists}
+  items: List[Item] = items_to_pydantic([fb_items[item_id] for item_id in item_ids if item_id in fb_items])
+  return items
+
+@traced('firestore.set_favorite_for_items')
+def set_favorite_for_items(db: 'firestore.Client', item_ids: List[str], is_favorite: bool) -> List[Item]:
+  '''Favorite or unfavorite many items with one read and one batched write.
+  :param item_ids: ids of the items
+  :param is_favorite: new favorite state
+  :return: the updated items, in the order of `item_ids`
+  '''
+  now = int(time.time())
+  items = fetch_items_by_ids(db, item_ids)
+  found = set(item.item_id for item in items)
+  missing = [item_id for item_id in item_ids if item_id not in found]
+  if len(missing) > 0:
+    raise ValueError(f'Items with ids {missing} do not exist')
+  # A batch holds at most 500 writes
+  try:
+    for start in range(0, len(items), 500):
+      batch = db.batch()
+      for item in items[start:start + 500]:
+        batch.update(db.collection('Items').document(item.item_id), {'is_favorite': is_favorite, 'updated_at': now})
+      batch.commit()
+  except Exception as e:
+    raise ValueError(f'Failed to update favorites: {e}')
+  for item in items:
+    item.is_favorite = is_favorite
+    item.updated_at = now
+  set_favorite_in_views(db, items, is_favorite)
+  return items
+
+@traced('firestore.fetch_favorite_items_for_click')
+def fetch_favorite_items_for_click(
+  db: 'firestore.Client', 
+  click_id: str, 
+  limit: int = 10,
+  start_after: Optional[str] = None,
+) -> List[Item]:
   '''Fetch favorites for a given click.
   :note: fetch items from any version
   :param click_id: id of the click
   :param limit: maximum number of items to return
+  :param start_after: cursor of the previous page
   :return: list of favorite items
   '''
   fb_query = db.collection('Items')\
     .where('click_id', '==', click_id)\
-    .where('is_favorite', '==', True)\
-    .order_by('created_at', direction=firestore.Query.DESCENDING)\
-    .limit(limit)
-  items: List[Item] = []
-  for fb_item in fb_query.stream():
-    item = item_to_pydantic(fb_item, fb_item.id)
-    items.append(item)
+    .where('is_favorite', '==', True)
+  fb_query = paginate_query(db, 'Items', fb_query, limit, start_after)
+  items: List[Item] = items_to_pydantic(fb_query.stream())
   return items
 
-def fetch_recent_clicks_by_user(db: 'firestore.Client', user_id: str, limit: int = 10) -> List[Click]:
+@traced('firestore.fetch_recent_clicks_by_user')
+def fetch_recent_clicks_by_user(
+  db: 'firestore.Client', 
+  user_id: str, 
+  limit: int = 10,
+  start_after: Optional[str] = None,
+) -> List[Click]:
   '''Fetch recent clicks for a given user.
   :param user_id: id of the user
   :param limit: maximum number of clicks to return
+  :param start_after: cursor of the previous page
   :return: list of clicks
   '''
   fb_query = db.collection('Clicks')\
-    .where('user_id', '==', user_id)\
-    .order_by('created_at', direction=firestore.Query.DESCENDING)\
-    .limit(limit)
-  clicks: List[Click] = []
-  for fb_click in fb_query.stream():
-    click = click_to_pydantic(fb_click, fb_click.id)
-    clicks.append(click)
+    .where('user_id', '==', user_id)
+  fb_query = paginate_query(db, 'Clicks', fb_query, limit, start_after)
+  clicks: List[Click] = clicks_to_pydantic(fb_query.stream())
   return clicks
 
+@traced('firestore.fetch_recent_click_summaries_by_user')
+def fetch_recent_click_summaries_by_user(
+  db: 'firestore.Client', 
+  user_id: str, 
+  limit: int = 10,
+  start_after: Optional[str] = None,
+) -> ClickSummaryPage:
+  '''Fetch a page of click summaries for a given user.
+  :note: only the summary fields are read from firestore, so `segm` is never transferred
+  :param user_id: id of the user
+  :param limit: maximum number of clicks to return
+  :param start_after: cursor of the previous page
+  :return: page of click summaries
+  '''
+  fb_query = db.collection('Clicks')\
+    .where('user_id', '==', user_id)\
+    .select(CLICK_SUMMARY_FIELDS)
+  fb_query = paginate_query(db, 'Clicks', fb_query, limit, start_after)
+  clicks: List[ClickSummary] = click_summaries_to_pydantic(fb_query.stream())
+  cursor = next_cursor([click.created_at for click in clicks], [click.click_id for click in clicks], limit)
+  return ClickSummaryPage(clicks=clicks, next_cursor=cursor)
+
+@traced('firestore.update_is_processed_for_click')
 def update_is_processed_for_click(db: 'firestore.Client', click_id: str, is_processed: bool) -> Click:
   '''Update the is_processed field for a click.
   :param click_id: id of the click
@@ -347,5 +709,8 @@ def update_is_processed_for_click(db: 'firestore.Client', click_id: str, is_proc
     fb_click_ref.update({'is_processed': is_processed, 'updated_at': now})
   except Exception as e:
     raise ValueError(f'Failed to update is_processed for click {click_id}: {e}')
+  # Unsetting it is transient (a refinement or tracking is running) and the write that sets it back updates the feed
+  if is_processed:
+    update_click_views(db, click_id, fields=['is_processed'])
   click = fetch_click_by_id(db, click_id)
   return click
@@ -0,0 +1,116 @@
+import time
+import contextvars
+from os import environ as env
+from typing import Optional, Dict, Any, Callable
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
+from firebase_admin import firestore
+from .profiling import run_profiled
+
+# Time a click may take from `POST /click` until its first result is committed
+CLICK_DEADLINE_SECONDS = float(env.get('CLICK_DEADLINE_SECONDS', 20))
+MAX_CLICK_DEADLINE_SECONDS = float(env.get('MAX_CLICK_DEADLINE_SECONDS', 60))
+# Longest each stage may block the task; a stage also never runs past the deadline
+STAGE_BUDGETS = {
+  'upload': float(env.get('CLICK_BUDGET_UPLOAD', 4)),
+  'segmentation': float(env.get('CLICK_BUDGET_SEGMENTATION', 8)),
+  'search': float(env.get('CLICK_BUDGET_SEARCH', 12)),
+  'caption': float(env.get('CLICK_BUDGET_CAPTION', 4)),
+}
+# Every stage gets at least this long, even past the deadline, in case it is nearly done
+MIN_STAGE_BUDGET = float(env.get('CLICK_MIN_STAGE_BUDGET', 0.25))
+
+class StageTimeout(Exception):
+  '''A stage did not finish within its budget; it keeps running in its thread.'''
+  def __init__(self, stage: str, budget: float):
+    super().__init__(f'{stage} did not finish within {budget:.2f}s')
+    self.stage = stage
+    self.budget = budget
+
+class Deadline:
+  '''Deadline of a click and the time budget of each stage.
+  :param deadline: unix time by which the click should be committed, None for the default from now
+  '''
+  def __init__(self, deadline: Optional[float] = None):
+    self.deadline = deadline if deadline is not None else time.time() + CLICK_DEADLINE_SECONDS
+
+  def remaining(self) -> float:
+    return self.deadline - time.time()
+
+  def budget(self, stage: str) -> float:
+    '''Seconds the stage may block for.'''
+    return max(MIN_STAGE_BUDGET, min(STAGE_BUDGETS[stage], self.remaining()))
+
+def click_deadline(timeout: Optional[float] = None) -> float:
+  '''Deadline for a new click.
+  :param timeout: seconds requested by the client, clamped to `MAX_CLICK_DEADLINE_SECONDS`
+  '''
+  timeout = CLICK_DEADLINE_SECONDS if timeout is None else min(max(timeout, 1.), MAX_CLICK_DEADLINE_SECONDS)
+  return time.time() + timeout
+
+_stage_executor: Optional[ThreadPoolExecutor] = None
+_background_executor: Optional[ThreadPoolExecutor] = None
+
+def get_stage_executor() -> 'ThreadPoolExecutor':
+  '''Threads that run stages under a budget.'''
+  global _stage_executor
+  if _stage_executor is None:
+    _stage_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='click-stage')
+  return _stage_executor
+
+def get_background_executor() -> 'ThreadPoolExecutor':
+  '''Threads that finish clicks after their first commit.
+  :note: separate from the stage threads, which these wait on
+  '''
+  global _background_executor
+  if _background_executor is None:
+    _background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='click-background')
+  return _background_executor
+
+def submit_stage(fn: Callable, *args, **kwargs) -> 'Future':
+  '''Start a stage in a thread, keeping the current trace context and profiler.'''
+  context = contextvars.copy_context()
+  return get_stage_executor().submit(context.run, run_profiled, fn, *args, **kwargs)
+
+def submit_background(fn: Callable, *args, **kwargs) -> 'Future':
+  '''Finish work in a thread after the task has returned, keeping the current trace context and profiler.'''
+  context = contextvars.copy_context()
+  return get_background_executor().submit(context.run, run_profiled, fn, *args, **kwargs)
+
+def wait_stage(future: 'Future', stage: str, budget: float) -> Any:
+  '''Wait for a stage started with `submit_stage`.
+  :raises StageTimeout: if it is not done within `budget` seconds
+  '''
+  try:
+    return future.result(timeout=budget)
+  except TimeoutError:
+    raise StageTimeout(stage, budget)
+
+def wait_stage_or_degrade(future: 'Future', stage: str, budget: float, degrade: Callable[[str, str], None], default: Any = None) -> Any:
+  '''Wait for a stage started with `submit_stage`; a stage that raised is degraded as `{stage}:error`.
+  :param degrade: records a degraded stage, called as `degrade(stage, 'error')`
+  :param default: returned if the stage raised
+  :raises StageTimeout: if it is not done within `budget` seconds
+  '''
+  try:
+    return wait_stage(future, stage, budget)
+  except StageTimeout:
+    raise
+  except Exception as e:
+    print(f'Error in stage {stage}: {e}')
+    degrade(stage, 'error')
+    return default
+
+def record_degradation(db: 'firestore.Client', stage: str, action: str):
+  '''Count a degraded stage.
+  :param stage: `upload`, `segmentation`, `search` or `caption`
+  :param action: `background` (finished after the first commit), `error` (skipped) or `slow` (waited past budget)
+  '''
+  try:
+    db.collection('Stats').document('degradations').set({f'{stage}_{action}': firestore.Increment(1)}, merge=True)
+  except Exception as e:
+    print(f'Error recording degradation {stage}:{action}: {e}')
+
+def fetch_degradation_stats(db: 'firestore.Client') -> Dict[str, int]:
+  '''Fetch degradation counters, keyed by `{stage}_{action}`.'''
+  fb_stats = db.collection('Stats').document('degradations').get()
+  return fb_stats.to_dict() if fb_stats.exists else {}
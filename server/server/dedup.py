@@ -0,0 +1,233 @@
+import time
+import base64
+import hashlib
+from os import environ as env
+from typing import Optional, Tuple, Dict, Any, List
+from firebase_admin import firestore
+from .schemas import Click, ClickUpdate, Item
+from .schemas import item_to_pydantic
+from .crud import update_click, mark_click_failed
+from .views import set_top_items
+
+# Bump the pipeline version whenever segmentation/search/caption output changes
+PIPELINE_VERSION = 1
+MODEL_VERSION = f"{env.get('SAM2_MODEL_CFG', 'sam2.1_hiera_large')}:{PIPELINE_VERSION}"
+# Clicks within the same quantum (in pixels) are treated as the same click
+CLICK_QUANTUM = int(env.get('DEDUP_CLICK_QUANTUM', 8))
+# Pending work older than this (in seconds) is assumed dead and can be taken over
+PENDING_TTL = int(env.get('DEDUP_PENDING_TTL', 300))
+# Completed results older than this (in seconds) are computed again, so search results do not go stale
+DONE_TTL = int(env.get('DEDUP_DONE_TTL', 7 * 24 * 3600))
+
+def image_digest(base64_image: str) -> str:
+  '''Content digest of an image.
+  :param base64_image: base64 encoded image
+  :return: sha256 hex digest of the decoded bytes
+  '''
+  return hashlib.sha256(base64.b64decode(base64_image)).hexdigest()
+
+def quantize(values: Tuple[int, ...], quantum: int = CLICK_QUANTUM) -> Tuple[int, ...]:
+  '''Snap coordinates to a grid so nearby clicks share a fingerprint.'''
+  return tuple(int(round(v / quantum)) for v in values)
+
+def click_fingerprint(
+  digest: str,
+  click: Optional[Tuple[int, int]] = None,
+  selection: Optional[Tuple[int, int, int, int]] = None,
+  model_version: str = MODEL_VERSION,
+) -> str:
+  '''Fingerprint of a click request.
+  :param digest: image digest from `image_digest`
+  :param click: click coordinates
+  :param selection: selection coordinates
+  :param model_version: version of the models/pipeline producing the result
+  :return: hex fingerprint
+  '''
+  # The task prefers the selection over the click, so only one of them matters
+  if selection is not None:
+    prompt = 'selection:' + ','.join(map(str, quantize(selection)))
+  elif click is not None:
+    prompt = 'click:' + ','.join(map(str, quantize(click)))
+  else:
+    prompt = 'none'
+  key = f'{digest}|{prompt}|{model_version}'
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def record_dedup_event(db: 'firestore.Client', event: str):
+  '''Increment a dedup counter.
+  :param event: one of `hit` (completed result reused), `coalesced` (joined in-flight work) or `miss`
+  '''
+  try:
+    db.collection('Stats').document('dedup').set({event: firestore.Increment(1)}, merge=True)
+  except Exception as e:
+    print(f'Error recording dedup event {event}: {e}')
+
+def fetch_dedup_stats(db: 'firestore.Client') -> Dict[str, Any]:
+  '''Fetch dedup counters and hit rates.
+  :return: counts of hits, coalesced and misses with the hit rate
+  '''
+  fb_stats = db.collection('Stats').document('dedup').get()
+  stats = fb_stats.to_dict() if fb_stats.exists else {}
+  hits, coalesced, misses = stats.get('hit', 0), stats.get('coalesced', 0), stats.get('miss', 0)
+  total = hits + coalesced + misses
+  return {
+    'hit': hits,
+    'coalesced': coalesced,
+    'miss': misses,
+    'hit_rate': (hits + coalesced) / total if total > 0 else 0.,
+  }
+
+def claim_fingerprint(db: 'firestore.Client', fingerprint: str, click_id: str) -> Optional[Dict[str, Any]]:
+  '''Claim a fingerprint for a new click.
+  :note: runs in a transaction so concurrent requests agree on a single leader
+  :param fingerprint: fingerprint from `click_fingerprint`
+  :param click_id: id of the click making the request
+  :return: None if this click should run the pipeline, otherwise the fingerprint document.
+    If its status is `done`, the result can be copied; if `pending`, this click was added
+    as a follower and will be filled in when the leader completes. Results older than `DONE_TTL`
+    are claimed again like new ones.
+  '''
+  fingerprint_ref = db.collection('Fingerprints').document(fingerprint)
+
+  @firestore.transactional
+  def claim(transaction: 'firestore.Transaction') -> Optional[Dict[str, Any]]:
+    now = int(time.time())
+    fb_fingerprint = fingerprint_ref.get(transaction=transaction)
+    doc = fb_fingerprint.to_dict() if fb_fingerprint.exists else None
+    if doc is not None and doc['status'] == 'done' and now - doc['updated_at'] < DONE_TTL:
+      return doc
+    if doc is not None and doc['status'] == 'pending' and now - doc['updated_at'] < PENDING_TTL:
+      transaction.update(fingerprint_ref, {'followers': firestore.ArrayUnion([click_id])})
+      return doc
+    # Either new, expired or the previous leader died; keep a dead leader's followers so they still get resolved
+    followers = doc.get('followers', []) if doc is not None and doc['status'] == 'pending' else []
+    transaction.set(fingerprint_ref, {
+      'status': 'pending',
+      'click_id': click_id,
+      'followers': followers,
+      'created_at': now,
+      'updated_at': now,
+    })
+    return None
+
+  doc = claim(db.transaction())
+  if doc is None:
+    record_dedup_event(db, 'miss')
+  else:
+    record_dedup_event(db, 'hit' if doc['status'] == 'done' else 'coalesced')
+  return doc
+
+def copy_click_result(db: 'firestore.Client', fingerprint_doc: Dict[str, Any], click_id: str) -> Click:
+  '''Copy a completed result (mask, urls, description and items) into another click.
+  :param fingerprint_doc: a `done` fingerprint document
+  :param click_id: id of the click to fill in
+  :return: the updated click
+  '''
+  now = int(time.time())
+  click = update_click(db, click_id, ClickUpdate.model_validate(fingerprint_doc['result']))
+  fb_query = db.collection('Items')\
+    .where('click_id', '==', fingerprint_doc['click_id'])\
+    .where('version', '==', fingerprint_doc['version'])
+  batch = db.batch()
+  items: List[Item] = []
+  for fb_item in fb_query.stream():
+    item: Item = item_to_pydantic(fb_item, fb_item.id)
+    item_ref = db.collection('Items').document()
+    item.item_id = None
+    item.click_id = click_id
+    item.version = click.version
+    item.is_favorite = False
+    item.created_at = now
+    item.updated_at = now
+    batch.set(item_ref, item.model_dump())
+    item.item_id = item_ref.id
+    items.append(item)
+  batch.commit()
+  # Copied items are written directly, so embed them like a search would
+  set_top_items(db, click_id, click.version, items)
+  return click
+
+def is_reusable_result(degradations: Optional[List[str]], num_items: int) -> bool:
+  '''Whether a result can be stored for identical clicks.
+  Stages that were slow or finished in the background still produced their output; a stage that
+  failed (e.g. `search:error`, or `upload:error` without urls) did not, and must not be reused.
+  A search without results is not reused either, since it is as likely a Lens hiccup as a real answer.
+  :param num_items: number of items found for the result
+  '''
+  return num_items > 0 and all(not degradation.endswith(':error') for degradation in degradations or [])
+
+def release_fingerprint(
+  db: 'firestore.Client',
+  fingerprint: str,
+  click_id: str,
+  update_request: Optional['ClickUpdate'] = None,
+  version: Optional[int] = None,
+) -> int:
+  '''Give up a claim without storing a result, so the next identical click runs the pipeline again.
+  Clicks waiting on it get the leader's result if there is one (e.g. a degraded one), otherwise they are marked failed.
+  :param fingerprint: fingerprint claimed by `click_id`
+  :param click_id: id of the leader click
+  :param update_request: the update applied to the leader click, None if the pipeline failed
+  :param version: version of the leader's items
+  :return: number of follower clicks resolved
+  '''
+  fingerprint_ref = db.collection('Fingerprints').document(fingerprint)
+
+  @firestore.transactional
+  def release(transaction: 'firestore.Transaction') -> List[str]:
+    fb_fingerprint = fingerprint_ref.get(transaction=transaction)
+    if not fb_fingerprint.exists:
+      return []
+    doc = fb_fingerprint.to_dict()
+    # Another click took over after `PENDING_TTL`, or the result was already stored
+    if doc['status'] != 'pending' or doc['click_id'] != click_id:
+      return []
+    transaction.delete(fingerprint_ref)
+    return [follower_id for follower_id in doc.get('followers', []) if follower_id != click_id]
+
+  count = 0
+  for follower_id in release(db.transaction()):
+    try:
+      if update_request is not None:
+        copy_click_result(db, {'click_id': click_id, 'version': version, 'result': update_request.model_dump()}, follower_id)
+      else:
+        mark_click_failed(db, follower_id, 'pipeline:error')
+      count += 1
+    except Exception as e:
+      print(f'Error resolving {follower_id} after click {click_id} failed: {e}')
+  return count
+
+def complete_fingerprint(
+  db: 'firestore.Client',
+  fingerprint: str,
+  click_id: str,
+  update_request: 'ClickUpdate',
+  version: int,
+) -> int:
+  '''Store the result for a fingerprint and fill in every click waiting on it.
+  :param fingerprint: fingerprint claimed by `click_id`
+  :param click_id: id of the leader click
+  :param update_request: the update applied to the leader click
+  :param version: version of the leader's items
+  :return: number of follower clicks filled in
+  '''
+  now = int(time.time())
+  fingerprint_ref = db.collection('Fingerprints').document(fingerprint)
+  fingerprint_ref.update({
+    'status': 'done',
+    'click_id': click_id,
+    'version': version,
+    'result': update_request.model_dump(),
+    'updated_at': now,
+  })
+  fingerprint_doc = fingerprint_ref.get().to_dict()
+  count = 0
+  for follower_id in fingerprint_doc.get('followers', []):
+    if follower_id == click_id:
+      continue
+    try:
+      copy_click_result(db, fingerprint_doc, follower_id)
+      count += 1
+    except Exception as e:
+      print(f'Error copying result of click {click_id} to {follower_id}: {e}')
+  return count
@@ -0,0 +1,95 @@
+'''Speculative SAM2 image encoding before a click, see `POST /prepare`.
+
+The worker that encodes an image keeps the embedding in `prepared_embeddings` and records its
+hostname under `seeclickbuy:prepare:{image_hash}` in the broker's Redis. `/click` then sends the
+click to that worker's direct queue so it only runs the mask decoder.
+
+:note: the direct queue belongs to a worker, not to a process: with a prefork pool any child can take
+  the click, and the embedding only lives in the child that encoded it. Preparations are therefore only
+  run by `solo` workers (`CELERY_POOL`, see `start_celery.sh`); other workers skip them
+'''
+import os
+import time
+from os import environ as env
+from typing import Optional, Dict
+from firebase_admin import firestore
+from .admission import get_redis
+
+# Seconds a preparation is kept without being clicked; the task also expires if it has not started by then
+PREPARE_TTL = int(env.get('PREPARE_TTL', 60))
+# Pool of this worker, as passed to `celery worker --pool` by `start_celery.sh`
+CELERY_POOL = env.get('CELERY_POOL', 'solo')
+
+def preparations_enabled() -> bool:
+  '''Whether this worker can hold embeddings for the clicks routed to it (only a `solo` worker can).'''
+  return CELERY_POOL == 'solo'
+
+def prepare_key(image_hash: str) -> str:
+  return f'seeclickbuy:prepare:{image_hash}'
+
+def decode_preparation(values: Dict[bytes, bytes]) -> Dict[str, str]:
+  return {k.decode(): v.decode() for k, v in values.items()}
+
+def record_preparation(image_hash: str, task_id: str):
+  '''Record a queued preparation.'''
+  pipe = get_redis().pipeline()
+  pipe.hset(prepare_key(image_hash), mapping={'task_id': task_id, 'status': 'queued', 'created_at': int(time.time())})
+  pipe.expire(prepare_key(image_hash), PREPARE_TTL)
+  pipe.execute()
+
+def update_preparation(image_hash: str, status: str, hostname: Optional[str] = None) -> bool:
+  '''Record progress of a preparation from the worker.
+  :param status: `encoding` or `ready`
+  :param hostname: celery hostname of the worker holding the embedding
+  :return: False if the preparation was cancelled or has expired
+  :note: the pid of the process holding the embedding is recorded too, to tell misses in another process apart
+  '''
+  key = prepare_key(image_hash)
+  values = {'status': status, 'pid': os.getpid()}
+  if hostname is not None:
+    values['hostname'] = hostname
+  pipe = get_redis().pipeline()
+  pipe.exists(key)
+  pipe.hset(key, mapping=values)
+  pipe.expire(key, PREPARE_TTL)
+  exists, _, _ = pipe.execute()
+  if not exists:
+    # Writing to a missing key re-created it
+    get_redis().delete(key)
+  return bool(exists)
+
+def fetch_preparation(image_hash: str) -> Optional[Dict[str, str]]:
+  '''Fetch a preparation and keep it alive for another `PREPARE_TTL` seconds.
+  :return: `task_id`, `status`, `created_at` and `hostname` once a worker picked it up; None if there is none
+  '''
+  pipe = get_redis().pipeline()
+  pipe.hgetall(prepare_key(image_hash))
+  pipe.expire(prepare_key(image_hash), PREPARE_TTL)
+  values, _ = pipe.execute()
+  return decode_preparation(values) if len(values) > 0 else None
+
+def cancel_preparation(image_hash: str) -> Optional[Dict[str, str]]:
+  '''Forget a preparation so no click is routed for it.
+  :return: the cancelled preparation, None if there was none
+  '''
+  pipe = get_redis().pipeline()
+  pipe.hgetall(prepare_key(image_hash))
+  pipe.delete(prepare_key(image_hash))
+  values, _ = pipe.execute()
+  return decode_preparation(values) if len(values) > 0 else None
+
+def record_preparation_event(db: 'firestore.Client', event: str):
+  '''Count how preparations ended.
+  :param event: `hit` (a click used the embedding), `miss` (a click came before it was ready
+    or went to another worker), `miss_process` (a click reached the right worker but another process
+    of it), `cancelled` or `skipped` (not enqueued because the queue was busy, or the worker is not `solo`)
+  '''
+  try:
+    db.collection('Stats').document('preparations').set({event: firestore.Increment(1)}, merge=True)
+  except Exception as e:
+    print(f'Error recording preparation event {event}: {e}')
+
+def fetch_preparation_stats(db: 'firestore.Client') -> Dict[str, int]:
+  '''Fetch preparation counters, keyed by event.'''
+  fb_stats = db.collection('Stats').document('preparations').get()
+  return fb_stats.to_dict() if fb_stats.exists else {}
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import random
+import threading
+from os import environ as env
+from os.path import join
+from collections import Counter
+from contextvars import ContextVar, Token
+from contextlib import contextmanager
+from typing import List, Tuple, Optional, Dict, Callable, Iterator, Any
+
+# Fraction of tasks profiled without being asked to (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(env.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = env.get('PROFILE_DIR', './cache/profiles')
+# Oldest profiles are deleted once the directory holds more files than this
+PROFILE_MAX_FILES = int(env.get('PROFILE_MAX_FILES', 200))
+PROFILE_INTERVAL = float(env.get('PROFILE_INTERVAL', 0.005))
+PROFILE_TOP_N = int(env.get('PROFILE_TOP_N', 15))
+
+# Profiler of the running task, copied to stage threads with the rest of the context (see `profile_thread`)
+_active_profiler: ContextVar[Optional['SamplingProfiler']] = ContextVar('active_profiler', default=None)
+
+def should_profile(requested: Optional[bool] = None) -> bool:
+  '''Whether to profile a task.
+  :param requested: value of the task's `profile` header, if any
+  '''
+  if requested:
+    return True
+  return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+class SamplingProfiler:
+  '''Samples the stacks of a task's threads from a background thread.
+  Low overhead compared to deterministic profilers, so it is safe on production tasks.
+  Stacks are rooted at the thread they were sampled in (`[task]`, `[click-stage]`, ...).
+  :param thread_id: id of the thread to sample (defaults to the calling thread); more are added with `attach`
+  :param interval: seconds between samples
+  '''
+  def __init__(self, thread_id: Optional[int] = None, interval: float = PROFILE_INTERVAL):
+    self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+    # Thread id -> label of the threads currently working for the task
+    self.threads: Dict[int, str] = {self.thread_id: 'task'}
+    self.lock = threading.Lock()
+    self.interval = interval
+    self.stacks: Counter = Counter()
+    self.num_samples = 0
+    self.start_time = 0.
+    self.end_time = 0.
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+
+  def start(self) -> 'SamplingProfiler':
+    self.start_time = time.time()
+    self.thread.start()
+    return self
+
+  def stop(self) -> 'SamplingProfiler':
+    self.stopped.set()
+    self.thread.join()
+    self.end_time = time.time()
+    return self
+
+  def attach(self, thread_id: int, label: str):
+    '''Also sample a thread, e.g. a stage thread running part of the task.'''
+    with self.lock:
+      self.threads[thread_id] = label
+
+  def detach(self, thread_id: int):
+    with self.lock:
+      self.threads.pop(thread_id, None)
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      frames = sys._current_frames()
+      with self.lock:
+        threads = list(self.threads.items())
+      for thread_id, label in threads:
+        frame = frames.get(thread_id)
+        if frame is None:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+          frame = frame.f_back
+        stack.append(f'[{label}]')
+        self.stacks[tuple(reversed(stack))] += 1
+        self.num_samples += 1
+
+  def top_functions(self, n: int = PROFILE_TOP_N) -> List[Tuple[str, float, float]]:
+    '''Hottest functions.
+    :return: (function, self %, total %) sorted by self time
+    '''
+    own, total = Counter(), Counter()
+    for stack, count in self.stacks.items():
+      own[stack[-1]] += count
+      for function in set(stack):
+        total[function] += count
+    num_samples = max(self.num_samples, 1)
+    return [
+      (function, 100. * count / num_samples, 100. * total[function] / num_samples)
+      for function, count in own.most_common(n)
+    ]
+
+  def write_collapsed(self, path: str):
+    '''Write stacks in collapsed format (one `frame;frame;frame count` per line) for flamegraphs.'''
+    with open(path, 'w') as f:
+      for stack, count in self.stacks.most_common():
+        f.write(f"{';'.join(stack)} {count}\n")
+
+  def summary(self, n: int = PROFILE_TOP_N) -> str:
+    lines = [f'{self.num_samples} samples over {self.end_time - self.start_time:.2f}s', f'{"self%":>7} {"total%":>7}  function']
+    for function, self_pct, total_pct in self.top_functions(n):
+      lines.append(f'{self_pct:>7.1f} {total_pct:>7.1f}  {function}')
+    return '\n'.join(lines)
+
+def activate_profiler(profiler: 'SamplingProfiler') -> Token:
+  '''Make a profiler the one of the current task, so the threads started by `run_profiled` are sampled too.'''
+  return _active_profiler.set(profiler)
+
+def deactivate_profiler(token: Token):
+  _active_profiler.reset(token)
+
+@contextmanager
+def profile_thread() -> Iterator[None]:
+  '''Sample the current thread with the active profiler (if any) within this block.'''
+  profiler = _active_profiler.get()
+  if profiler is None:
+    yield
+    return
+  thread_id = threading.get_ident()
+  # `click-stage_3` -> `click-stage`, so every stage thread falls under one root
+  profiler.attach(thread_id, threading.current_thread().name.rsplit('_', 1)[0])
+  try:
+    yield
+  finally:
+    profiler.detach(thread_id)
+
+def run_profiled(fn: Callable, *args, **kwargs) -> Any:
+  '''Run a function in a pool thread under the profiler of the task that submitted it.
+  :note: the caller's context must be copied into the thread, see `server.deadlines.submit_stage`
+  '''
+  with profile_thread():
+    return fn(*args, **kwargs)
+
+def prune_profiles(profile_dir: str = PROFILE_DIR, max_files: int = PROFILE_MAX_FILES):
+  '''Delete the oldest files so the directory holds at most `max_files`.'''
+  paths = [join(profile_dir, name) for name in os.listdir(profile_dir)]
+  paths = sorted((p for p in paths if os.path.isfile(p)), key=os.path.getmtime)
+  for path in paths[:max(0, len(paths) - max_files)]:
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+
+def task_profile_prefix(task_name: str, task_id: str, profile_dir: str = PROFILE_DIR) -> str:
+  '''Prefix for the profile files of a task.'''
+  os.makedirs(profile_dir, exist_ok=True)
+  return join(profile_dir, f"{task_name.replace(':', '_')}-{task_id}")
@@ -0,0 +1,97 @@
+'''Priority queues and weighted fair scheduling between them, wired up in `server.worker`.
+
+Tasks are routed to `interactive`, `standard` or `background` by task type and the channel of the click.
+Workers consume every queue and pick the next one with `WeightedCycle`, so interactive clicks are
+served first most of the time while background work still gets its share and never starves.
+'''
+from os import environ as env
+from typing import Dict, List, Optional, Any
+
+PRIORITY_QUEUES = ['interactive', 'standard', 'background']
+
+def parse_weights(value: str) -> Dict[str, int]:
+  '''Parse `queue:weight,queue:weight`.'''
+  weights = {}
+  for entry in value.split(','):
+    queue, weight = entry.split(':')
+    weights[queue.strip()] = max(1, int(weight))
+  return weights
+
+# Share of polls each queue is preferred in while all of them have work
+QUEUE_WEIGHTS = parse_weights(env.get('QUEUE_WEIGHTS', 'interactive:6,standard:3,background:1'))
+# Queues that are not listed (e.g. worker direct queues `{hostname}.dq2`) weigh as much as `interactive`
+DEFAULT_QUEUE_WEIGHT = QUEUE_WEIGHTS.get('interactive', 1)
+# Clicks from these channels are bulk work; other channels are pages the extension runs on
+BATCH_CHANNELS = [c for c in env.get('BATCH_CHANNELS', 'ingest,batch,api,replay').split(',') if c]
+# Queue of each task; `interactive` tasks from batch channels go to `background`
+TASK_QUEUES = {
+  'seeclickbuy:click_task': 'interactive',
+  'seeclickbuy:refine_task': 'interactive',
+  'seeclickbuy:track_task': 'interactive',
+  'seeclickbuy:prepare_task': 'interactive',
+  'seeclickbuy:chat_task': 'standard',
+  'seeclickbuy:compaction_task': 'background',
+}
+
+def task_queue(task_name: str, channel: Optional[str] = None) -> str:
+  '''Queue a task is routed to.
+  :param task_name: registered name, e.g. `seeclickbuy:click_task`
+  :param channel: channel of the click the task works on
+  '''
+  queue = TASK_QUEUES.get(task_name, 'standard')
+  if channel is not None and channel in BATCH_CHANNELS:
+    return 'background'
+  return queue
+
+def route_task(name: str, args: Any, kwargs: Any, options: Dict[str, Any], task: Any = None, **kw) -> Optional[Dict[str, str]]:
+  '''Celery router (`task_routes`); reads the channel from the `channel` message header.
+  :note: an explicit `queue` (e.g. a worker direct queue) is kept
+  '''
+  if options.get('queue') is not None:
+    return None
+  channel = (options.get('headers') or {}).get('channel')
+  return {'queue': task_queue(name, channel)}
+
+class WeightedCycle:
+  '''Queue order for the Redis transport (`queue_order_strategy`), as start-time fair queueing.
+  Each poll lists queues by virtual finish time and BRPOP takes from the first one with messages.
+  Taking a message advances its queue by `1 / weight`, so while all queues have work each gets a share
+  proportional to its weight and background work never starves. Queues listed before the one a message
+  came from were empty; they are moved up to the current virtual time so an idle queue cannot bank
+  credit and crowd out interactive work once it fills up again.
+  :param it: queues to cycle between (kombu passes its active queues)
+  :param weights: weight of each queue, defaults to `QUEUE_WEIGHTS`
+  '''
+  def __init__(self, it: Optional[List[str]] = None, weights: Optional[Dict[str, int]] = None):
+    self.items: List[str] = it if it is not None else []
+    self.weights = weights if weights is not None else QUEUE_WEIGHTS
+    # Virtual start time of the next message of each queue
+    self.start_times: Dict[str, float] = {}
+    self.virtual_time = 0.
+    self.last_order: List[str] = []
+
+  def weight(self, queue: str) -> int:
+    return self.weights.get(queue, DEFAULT_QUEUE_WEIGHT)
+
+  def update(self, it: List[str]):
+    '''Update items from iterable.'''
+    self.items[:] = it
+
+  def consume(self, n: int) -> List[str]:
+    '''Queues to poll, earliest virtual finish time first; ties go to the heavier queue.'''
+    for queue in self.items:
+      self.start_times.setdefault(queue, self.virtual_time)
+    def finish_time(queue: str):
+      return (self.start_times[queue] + 1. / self.weight(queue), -self.weight(queue))
+    self.last_order = sorted(self.items, key=finish_time)[:n]
+    return self.last_order
+
+  def rotate(self, last_used: str) -> str:
+    '''Charge the queue a message was taken from.'''
+    start = self.start_times.get(last_used, self.virtual_time)
+    self.virtual_time = max(self.virtual_time, start)
+    self.start_times[last_used] = start + 1. / self.weight(last_used)
+    if last_used in self.last_order:
+      for queue in self.last_order[:self.last_order.index(last_used)]:
+        self.start_times[queue] = max(self.start_times[queue], self.virtual_time)
+    return last_used
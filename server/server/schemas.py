@@ -1,5 +1,5 @@
-from typing import Optional, List, Tuple
-from pydantic import BaseModel
+from typing import Optional, List, Tuple, Iterable
+from pydantic import BaseModel, TypeAdapter
 from firebase_admin import firestore
 
 class ClickCreate(BaseModel):
@@ -10,13 +10,90 @@ class ClickCreate(BaseModel):
   channel: Optional[str] = None
 
 class ClickUpdate(BaseModel):
-  image_url: str
+  image_url: Optional[str] = None
   image_size: Tuple[int, int]
   bbox: Tuple[int, int, int, int]
   segm: List[int]
   description: Optional[str] = None
+  masked_url: Optional[str] = None
+  masked_size: Tuple[int, int]
+  degradations: Optional[List[str]] = None
+
+class RefinePoint(BaseModel):
+  '''A point added by a refinement, stored flat since Firestore does not nest arrays.
+  :param x: x coordinate in the image
+  :param y: y coordinate in the image
+  :param label: 1 for a positive point and 0 for a negative point
+  :param step: index of the refinement that added the point, starting at 0
+  '''
+  x: int
+  y: int
+  label: int
+  step: int
+
+class ClickMaskUpdate(BaseModel):
+  '''
+  :param refine_points: every point of the refinements so far, see `Click`
+  '''
+  bbox: Tuple[int, int, int, int]
+  segm: List[int]
   masked_url: str
   masked_size: Tuple[int, int]
+  refine_points: Optional[List[RefinePoint]] = None
+
+class RefineCreate(BaseModel):
+  '''Points to refine the mask of a click with.
+  :param points: new points (x, y) in image coordinates
+  :param labels: 1 for a positive point (include) and 0 for a negative point (exclude)
+  '''
+  points: List[Tuple[int, int]]
+  labels: List[int]
+
+class PrepareCreate(BaseModel):
+  '''Image to encode before it is clicked.
+  :param base64_image: base64 encoded image, identical to the one the click will send
+  :param user_id: id of the user
+  '''
+  base64_image: str
+  user_id: Optional[str] = None
+
+class Preparation(BaseModel):
+  '''State of a speculative image encoding.
+  :param image_hash: sha256 of the decoded image, used to cancel it
+  :param status: `queued`, `encoding`, `ready`, `skipped` (not started, the queue was busy) or `cancelled`
+  :param task_id: id of the celery task
+  '''
+  image_hash: str
+  status: str
+  task_id: Optional[str] = None
+
+class TrackCreate(BaseModel):
+  '''New frames of the video or page a click was made on.
+  :param frames: base64 encoded frames, oldest first
+  '''
+  frames: List[str]
+
+class ItemSummary(BaseModel):
+  '''Lightweight view of an item for list endpoints.
+  :param item_id: id of the item
+  :param title: name of the item
+  :param link: url of the item
+  :param source: store/distribution/channel of the item
+  :param price_value: price of the item
+  :param price_currency: currency of the price
+  :param thumbnail: url of the item thumbnail
+  :param is_favorite: whether the item is a favorite
+  :param created_at: creation timestamp
+  '''
+  item_id: Optional[str] = None
+  title: str
+  link: str
+  source: str
+  price_value: float
+  price_currency: str
+  thumbnail: Optional[str] = None
+  is_favorite: bool = False
+  created_at: int
 
 class Click(BaseModel):
   '''Firebase object for clicks.
@@ -31,6 +108,11 @@ class Click(BaseModel):
   :param bbox: bounding box coordinates
   :param segm: segmentation mask
   :param description: description of the click
+  :param degradations: stages that ran out of time or failed, as `stage:action`
+  :param top_items: summaries of the first items of `top_items_version`, favorites first
+  :param top_items_version: version the top items were found for
+  :param refine_points: points of the refinements of the current mask, so any worker can rebuild it
+  :param latest_chat_id: id of the most recent chat; older chats still in flight are not applied
   :param created_at: creation timestamp
   :param updated_at: update timestamp
   '''
@@ -46,6 +128,11 @@ class Click(BaseModel):
   segm: Optional[List[int]] = None
   description: Optional[str] = None
   channel: Optional[str] = None
+  degradations: Optional[List[str]] = None
+  top_items: Optional[List[ItemSummary]] = None
+  top_items_version: Optional[int] = None
+  refine_points: Optional[List[RefinePoint]] = None
+  latest_chat_id: Optional[str] = None
   version: Optional[int] = 1
   is_processed: bool = False
   created_at: int
@@ -61,7 +148,9 @@ class Chat(BaseModel):
   :param click_id: id of the click
   :param text: text of the chat
   :param pre_description: description of the click before the chat
-  :param post_description: description of the click after the chat
+  :param post_description: description of the click after the chat, partial while `status` is `streaming`
+  :param version: version of the click the chat edits
+  :param status: `pending`, `streaming`, `done`, `superseded` (a newer chat of the click replaced it) or `failed`
   :param created_at: creation timestamp
   :param updated_at: update timestamp
   '''
@@ -69,10 +158,15 @@ class Chat(BaseModel):
   click_id: str
   text: str
   pre_description: str
-  post_description: str
+  post_description: Optional[str] = None
+  version: Optional[int] = None
+  status: str = 'done'
   created_at: int
   updated_at: int
 
+class ItemIds(BaseModel):
+  item_ids: List[str]
+
 class Item(BaseModel):
   '''Firebase for a retrieved item.
   :param item_id: id of the item
@@ -103,6 +197,64 @@ class Item(BaseModel):
   created_at: int
   updated_at: int
 
+class ClickSummary(BaseModel):
+  '''Lightweight view of a click for list endpoints (no segmentation polygon).
+  :param click_id: id of the click
+  :param image_url: url of the image
+  :param masked_url: url of the masked image
+  :param description: description of the click
+  :param channel: channel the click came from
+  :param version: version of the click
+  :param is_processed: whether the click has been processed
+  :param top_items: summaries of the first items of the current version, see `server.views`
+  :param created_at: creation timestamp
+  '''
+  click_id: Optional[str] = None
+  image_url: Optional[str] = None
+  masked_url: Optional[str] = None
+  description: Optional[str] = None
+  channel: Optional[str] = None
+  version: Optional[int] = 1
+  is_processed: bool = False
+  top_items: Optional[List[ItemSummary]] = None
+  created_at: int
+
+class ClickSummaryPage(BaseModel):
+  '''A page of click summaries.
+  :param clicks: click summaries in this page
+  :param next_cursor: cursor for the next page, None if this is the last page
+  '''
+  clicks: List[ClickSummary]
+  next_cursor: Optional[str] = None
+
+class ItemSummaryPage(BaseModel):
+  '''A page of item summaries.
+  :param items: item summaries in this page
+  :param next_cursor: cursor for the next page, None if this is the last page
+  '''
+  items: List[ItemSummary]
+  next_cursor: Optional[str] = None
+
+class Feed(BaseModel):
+  '''Recent clicks of a user with their top items, kept in one document (`Feeds/{user_id}`).
+  :param user_id: id of the user
+  :param clicks: summaries of the most recent clicks, newest first
+  :param updated_at: update timestamp
+  '''
+  user_id: str
+  clicks: List[ClickSummary]
+  updated_at: int
+
+# Fields fetched with Firestore `select()` for the summary views
+CLICK_SUMMARY_FIELDS = [f for f in ClickSummary.model_fields if f != 'click_id']
+ITEM_SUMMARY_FIELDS = [f for f in ItemSummary.model_fields if f != 'item_id']
+
+# Bulk validators/serializers for lists of documents
+ClickListAdapter = TypeAdapter(List[Click])
+ItemListAdapter = TypeAdapter(List[Item])
+ClickSummaryListAdapter = TypeAdapter(List[ClickSummary])
+ItemSummaryListAdapter = TypeAdapter(List[ItemSummary])
+
 def click_to_pydantic(fb_click: 'firestore.DocumentSnapshot', click_id: str) -> Click:
   fb_click_dict = fb_click.to_dict()
   click = Click.model_validate(fb_click_dict)
@@ -120,3 +272,19 @@ def item_to_pydantic(fb_item: 'firestore.DocumentSnapshot', item_id: str) -> Ite
   item = Item.model_validate(fb_item_dict)
   item.item_id = item_id
   return item
+
+def clicks_to_pydantic(fb_clicks: Iterable['firestore.DocumentSnapshot']) -> List[Click]:
+  '''Validate a list of click documents in a single pass.'''
+  return ClickListAdapter.validate_python([{**fb_click.to_dict(), 'click_id': fb_click.id} for fb_click in fb_clicks])
+
+def items_to_pydantic(fb_items: Iterable['firestore.DocumentSnapshot']) -> List[Item]:
+  '''Validate a list of item documents in a single pass.'''
+  return ItemListAdapter.validate_python([{**fb_item.to_dict(), 'item_id': fb_item.id} for fb_item in fb_items])
+
+def click_summaries_to_pydantic(fb_clicks: Iterable['firestore.DocumentSnapshot']) -> List[ClickSummary]:
+  '''Validate a list of projected click documents in a single pass.'''
+  return ClickSummaryListAdapter.validate_python([{**fb_click.to_dict(), 'click_id': fb_click.id} for fb_click in fb_clicks])
+
+def item_summaries_to_pydantic(fb_items: Iterable['firestore.DocumentSnapshot']) -> List[ItemSummary]:
+  '''Validate a list of projected item documents in a single pass.'''
+  return ItemSummaryListAdapter.validate_python([{**fb_item.to_dict(), 'item_id': fb_item.id} for fb_item in fb_items])
@@ -0,0 +1,114 @@
+import time
+import threading
+from os import environ as env
+from collections import OrderedDict
+from typing import Optional, List, Tuple, Dict, Any, Generic, TypeVar
+import numpy.typing as npt
+
+V = TypeVar('V')
+
+class BoundedStore(Generic[V]):
+  '''Thread-safe LRU store with a time-to-live, kept in worker memory.
+  :param max_items: maximum number of entries; the least recently used one is evicted first
+  :param ttl: seconds an entry may go unused before it expires
+  '''
+  def __init__(self, max_items: int, ttl: float):
+    self.max_items = max_items
+    self.ttl = ttl
+    self.entries: 'OrderedDict[str, Tuple[float, V]]' = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key: str) -> Optional[V]:
+    '''Fetch an entry and mark it as recently used.'''
+    with self.lock:
+      self.expire()
+      if key not in self.entries:
+        return None
+      _, value = self.entries.pop(key)
+      self.entries[key] = (time.time(), value)
+      return value
+
+  def put(self, key: str, value: V):
+    '''Insert or replace an entry, evicting the least recently used ones if full.'''
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (time.time(), value)
+      while len(self.entries) > self.max_items:
+        self.entries.popitem(last=False)
+
+  def pop(self, key: str) -> Optional[V]:
+    '''Remove an entry.'''
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      return entry[1] if entry is not None else None
+
+  def expire(self):
+    '''Drop entries that have not been used within the ttl.
+    :note: the caller must hold the lock
+    '''
+    now = time.time()
+    while len(self.entries) > 0:
+      key, (last_used, _) = next(iter(self.entries.items()))
+      if now - last_used < self.ttl:
+        break
+      self.entries.pop(key)
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+class RefinementSession:
+  '''State needed to refine a click's mask without re-encoding the image.
+  :param embedding: SAM2 image embedding from `get_image_embedding`
+  :param image: the image (H, W, 3), used to re-create the masked image
+  :param points: all points so far (x, y)
+  :param labels: 1 for positive and 0 for negative points
+  :param selection: box prompt, if the click was a selection
+  :param logits: low-res logits of the last mask
+  '''
+  def __init__(
+    self,
+    embedding: Dict[str, Any],
+    image: npt.NDArray,
+    points: List[Tuple[int, int]],
+    labels: List[int],
+    selection: Optional[Tuple[int, int, int, int]] = None,
+    logits: Optional[npt.NDArray] = None,
+  ):
+    self.embedding = embedding
+    self.image = image
+    self.points = points
+    self.labels = labels
+    self.selection = selection
+    self.logits = logits
+    self.num_refinements = 0
+
+# Each session holds a GPU embedding (~16MB for hiera large), so keep this small
+refinement_sessions: BoundedStore[RefinementSession] = BoundedStore(
+  max_items=int(env.get('REFINEMENT_MAX_SESSIONS', 32)),
+  ttl=float(env.get('REFINEMENT_SESSION_TTL', 900)),
+)
+
+class TrackingSession:
+  '''State needed to keep tracking a click's object across new frames.
+  :param state: SAM2 video inference state from `init_video_tracking`
+  :param frame_size: size (width, height) of the first frame; later frames are resized to it
+  :param search_embedding: embedding of the masked crop that items were last searched for
+  '''
+  def __init__(self, state: Dict[str, Any], frame_size: Tuple[int, int], search_embedding: Optional[npt.NDArray] = None):
+    self.state = state
+    self.frame_size = frame_size
+    self.search_embedding = search_embedding
+    self.num_frames = 1
+    self.num_searches = 0
+
+# Each session holds SAM2 memories of the last few frames on the GPU, so keep this smaller still
+tracking_sessions: BoundedStore[TrackingSession] = BoundedStore(
+  max_items=int(env.get('TRACKING_MAX_SESSIONS', 4)),
+  ttl=float(env.get('TRACKING_SESSION_TTL', 300)),
+)
+
+# Embeddings encoded by `prepare_task` ahead of a click, keyed by image hash
+prepared_embeddings: BoundedStore[Dict[str, Any]] = BoundedStore(
+  max_items=int(env.get('PREPARE_MAX_EMBEDDINGS', 8)),
+  ttl=float(env.get('PREPARE_TTL', 60)),
+)
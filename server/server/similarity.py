@@ -0,0 +1,69 @@
+import threading
+from os import environ as env
+from typing import List, Tuple, Optional
+from seeclickbuy.retrieval import VectorIndex, embed_image
+from .schemas import Item
+from .thumbnails import get_thumbnail_path, get_executor
+
+ITEM_INDEX_DIR = env.get('ITEM_INDEX_DIR', './cache/item_index')
+# `off` always calls Google Lens, `background` returns local matches first and still calls
+# Lens afterwards, and `skip` does not call Lens when there are enough local matches.
+# Off by default: the embedding is handcrafted (color, layout and texture), so local matches
+# should be checked against Lens results before they replace them
+LOCAL_MATCH_MODE = env.get('LOCAL_MATCH_MODE', 'off')
+LOCAL_MATCH_THRESHOLD = float(env.get('LOCAL_MATCH_THRESHOLD', 0.9))
+LOCAL_MATCH_MIN_ITEMS = int(env.get('LOCAL_MATCH_MIN_ITEMS', 3))
+
+_index: Optional['VectorIndex'] = None
+_lock = threading.Lock()
+
+def get_item_index() -> 'VectorIndex':
+  '''Index of item thumbnail embeddings, opened on first use.'''
+  global _index
+  with _lock:
+    if _index is None:
+      _index = VectorIndex(ITEM_INDEX_DIR)
+  return _index
+
+def index_items(items: List[Item]) -> int:
+  '''Embed item thumbnails and add them to the index.
+  :param items: items saved to firebase (with an `item_id`)
+  :return: number of items indexed
+  '''
+  ids, vectors = [], []
+  for item in items:
+    if item.item_id is None or item.thumbnail is None:
+      continue
+    path = get_thumbnail_path(item.thumbnail, 128)
+    if path is None:
+      continue
+    try:
+      vectors.append(embed_image(path))
+      ids.append(item.item_id)
+    except Exception as e:
+      print(f'Error embedding thumbnail of item {item.item_id}: {e}')
+  get_item_index().add(ids, vectors)
+  return len(ids)
+
+def index_items_in_background(items: List[Item]):
+  '''Index items without blocking the caller.'''
+  if len(items) > 0:
+    get_executor().submit(index_items, items)
+
+def remove_indexed_items(item_ids: List[str]) -> int:
+  '''Remove deleted items from the index so they are no longer matched.
+  :return: number of items removed
+  '''
+  if len(item_ids) == 0:
+    return 0
+  return get_item_index().remove(item_ids)
+
+def find_similar_items(image_path: str, k: int = 25, threshold: float = LOCAL_MATCH_THRESHOLD) -> List[Tuple[str, float]]:
+  '''Find indexed items that look like an image.
+  :param image_path: path to the (masked) image
+  :param k: maximum number of matches
+  :param threshold: minimum cosine similarity of a match
+  :return: (item_id, similarity) pairs, most similar first
+  '''
+  matches = get_item_index().search(embed_image(image_path), k)
+  return [(item_id, score) for item_id, score in matches if score >= threshold]
@@ -1,33 +1,90 @@
+import os
+import time
 import numpy as np
 from os import makedirs
 from os.path import join
 from os import environ as env
-from typing import List
+from typing import List, Optional, Callable, Dict, Any
+from concurrent.futures import Future
 from dotenv import load_dotenv
 from celery import shared_task
 from celery.utils.log import get_task_logger
-from celery.signals import worker_process_init
-from seeclickbuy.utils import load_image
-from seeclickbuy.models import load_sam2, init_openai, summarize_captions
-from seeclickbuy.models import infer_click, infer_selection
+from celery.signals import worker_init, worker_process_init
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from seeclickbuy.utils import load_image, get_rss_mb, get_checkpoints_dir
+from seeclickbuy.llm import init_openai, summarize_captions, edit_caption_stream
+from seeclickbuy.text import prepare_captions
+from seeclickbuy.models import load_sam2, convert_checkpoint_to_safetensors
+from seeclickbuy.models import infer_click, infer_selection, get_image_embedding, refine_mask
+from seeclickbuy.models import load_sam2_video, init_video_tracking, track_frame
+from seeclickbuy.retrieval import embed_image
+from seeclickbuy.profiling import enable_torch_profiling, torch_profile
 from .database import get_firebase_client
+from .dedup import complete_fingerprint, release_fingerprint, is_reusable_result
+from .sessions import refinement_sessions, RefinementSession, tracking_sessions, TrackingSession, prepared_embeddings
+from .preparation import update_preparation, record_preparation_event, fetch_preparation, cancel_preparation, preparations_enabled
+from .similarity import find_similar_items, LOCAL_MATCH_MODE, LOCAL_MATCH_MIN_ITEMS
+from .admission import record_latency
+from .scheduling import PRIORITY_QUEUES
+from .deadlines import (
+  Deadline,
+  StageTimeout,
+  STAGE_BUDGETS,
+  submit_stage,
+  submit_background,
+  wait_stage,
+  record_degradation,
+  wait_stage_or_degrade,
+)
+from .compaction import run_compaction, record_compaction_report
+from .profiling import (
+  SamplingProfiler,
+  should_profile,
+  activate_profiler,
+  deactivate_profiler,
+  prune_profiles,
+  task_profile_prefix,
+  PROFILE_DIR,
+)
+from .tracing import (
+  span,
+  start_span,
+  end_span,
+  record_span,
+  inject_headers,
+  activate_span,
+  deactivate_span,
+  attach_remote_parent,
+  detach_remote_parent,
+)
 from .schemas import click_to_pydantic
 from .crud import (
   update_click, 
+  update_click_mask,
+  upgrade_click_version,
+  delete_items,
+  fetch_click_by_id,
+  copy_items_to_click,
   search_items_for_click, 
   search_items_for_text,
   update_is_processed_for_click,
+  mark_click_failed,
+  fetch_chat_by_id,
+  fetch_chats_for_click,
+  update_chat_status,
+  complete_chat,
 )
-from .schemas import ClickUpdate, Item
+from .schemas import Click, ClickUpdate, ClickMaskUpdate, RefinePoint, Item, Chat
 from .utils import (
   tick, 
   binary_mask_to_coco_format, 
   round_bbox, 
-  upload_file_to_firebase,
+  upload_content_addressed,
   binary_mask_to_bbox, 
   create_masked_image,
   standardize_text,
   decode_base64_to_image,
+  download_image,
 )
 
 def build_response(success, data={}, error=None):
@@ -40,20 +97,117 @@ load_dotenv()
 assert env.get('SERP_API_KEY') is not None, 'SERP_API_KEY is not defined'
 assert env.get('OPENAI_API_KEY') is not None, 'OPENAI_API_KEY is not defined'
 
+# `safetensors` memory-maps weights, which workers on `cpu` share (see `load_sam2`); `pt` is the legacy path
+SAM2_MODEL_CFG = env.get('SAM2_MODEL_CFG', 'sam2.1_hiera_large')
+SAM2_WEIGHTS_FORMAT = env.get('SAM2_WEIGHTS_FORMAT', 'safetensors')
+SAM2_DEVICE = env.get('SAM2_DEVICE', 'cuda')
+# Tracked crops less similar than this to the last searched crop are searched again
+TRACK_SEARCH_SIMILARITY = float(env.get('TRACK_SEARCH_SIMILARITY', 0.85))
+# Masks covering less than this fraction of the frame mean the object was lost
+TRACK_MIN_MASK_AREA = float(env.get('TRACK_MIN_MASK_AREA', 0.0005))
+# Seconds between writes of a caption being streamed to its chat document
+CHAT_STREAM_INTERVAL = float(env.get('CHAT_STREAM_INTERVAL', 0.3))
+
 # Initialize models and db only when called
 sam2 = None
+sam2_video = None  # loaded on the first tracking task, see `get_sam2_video`
 db = None
 openai = None
 
+# Spans of running tasks, keyed by task id, closed in `end_task_span`
+task_spans = {}
+
+@before_task_publish.connect
+def inject_trace_headers(headers=None, **kwargs):
+  '''Propagate the current trace (e.g. of an API request) to the task message.'''
+  if headers is not None:
+    inject_headers(headers)
+    headers.setdefault('enqueued_at', time.time())
+
+def task_queue_label(delivery_info: Optional[Dict[str, Any]]) -> str:
+  '''Priority queue a message was delivered from; worker direct queues are reported as `direct`.'''
+  routing_key = (delivery_info or {}).get('routing_key')
+  return routing_key if routing_key in PRIORITY_QUEUES + ['celery'] else 'direct'
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+  '''Continue the publisher's trace in the worker and record time spent in the queue.'''
+  parent_token = attach_remote_parent(task.request.get('traceparent'))
+  enqueued_at = task.request.get('enqueued_at')
+  if enqueued_at is not None:
+    queue = task_queue_label(task.request.delivery_info)
+    record_span('celery.queue_wait', float(enqueued_at), time.time(), task=task.name, queue=queue)
+    record_latency(f'queue_wait.{queue}', time.time() - float(enqueued_at))
+  task_span = start_span(f'celery.{task.name}', task_id=task_id)
+  task_spans[task_id] = (task_span, activate_span(task_span), parent_token)
+
+@task_postrun.connect
+def end_task_span(task_id=None, state=None, **kwargs):
+  if task_id not in task_spans:
+    return
+  task_span, span_token, parent_token = task_spans.pop(task_id)
+  task_span.set_attribute('state', state)
+  deactivate_span(span_token)
+  detach_remote_parent(parent_token)
+  end_span(task_span)
+
+# Profilers of running tasks, keyed by task id, closed in `end_task_profile`
+task_profiles = {}
+
+@task_prerun.connect
+def start_task_profile(task_id=None, task=None, **kwargs):
+  '''Profile a task if it has a `profile` header (`apply_async(headers={'profile': True})`) 
+  or is sampled by `PROFILE_SAMPLE_RATE`. Model calls are also profiled with torch.profiler.
+  :note: stage threads started with `submit_stage` are sampled along with the task thread
+  '''
+  if not should_profile(task.request.get('profile')):
+    return
+  torch_profiling = enable_torch_profiling(PROFILE_DIR)
+  torch_outputs = torch_profiling.__enter__()
+  profiler = SamplingProfiler().start()
+  task_profiles[task_id] = (profiler, activate_profiler(profiler), torch_profiling, torch_outputs)
+
+@task_postrun.connect
+def end_task_profile(task_id=None, task=None, **kwargs):
+  if task_id not in task_profiles:
+    return
+  profiler, profiler_token, torch_profiling, torch_outputs = task_profiles.pop(task_id)
+  profiler.stop()
+  deactivate_profiler(profiler_token)
+  torch_profiling.__exit__(None, None, None)
+  try:
+    prefix = task_profile_prefix(task.name, task_id)
+    profiler.write_collapsed(f'{prefix}.collapsed.txt')
+    logger.info(f'profile of {task.name} {task_id}:\n{profiler.summary()}')
+    for path in torch_outputs:
+      logger.info(f'torch profile written to {path}')
+    prune_profiles()
+  except Exception as e:
+    logger.error(f'error writing profile of {task_id}: {e}')
+
+@worker_init.connect
+def prepare_worker_weights(**kwargs):
+  '''Convert the checkpoint once in the parent process, before workers are forked.
+  '''
+  if SAM2_WEIGHTS_FORMAT != 'safetensors':
+    return
+  start_time = time.time()
+  convert_checkpoint_to_safetensors(join(get_checkpoints_dir(), f'{SAM2_MODEL_CFG}.pt'))
+  logger.info(f"sam2 weights ready - {time.time()-start_time:.2f}s elapsed")
+
 @worker_process_init.connect
 def init_worker_models(**kwargs):
   '''Initialize models only when called.
   '''
   global sam2, db, openai
   if sam2 is None:
-    start_time = tick()
-    sam2 = load_sam2()
-    logger.info(f"sam2 initialized - {tick()-start_time}s elapsed")
+    start_time = time.time()
+    start_rss = get_rss_mb()
+    sam2 = load_sam2(SAM2_MODEL_CFG, SAM2_DEVICE, weights_format=SAM2_WEIGHTS_FORMAT)
+    logger.info(
+      f"sam2 initialized ({SAM2_WEIGHTS_FORMAT} on {SAM2_DEVICE}) - {time.time()-start_time:.2f}s elapsed, "
+      f"rss {start_rss:.0f}MB -> {get_rss_mb():.0f}MB"
+    )
   if db is None:
     start_time = tick()
     db = get_firebase_client()
@@ -63,16 +217,184 @@ def init_worker_models(**kwargs):
     openai = init_openai(env['OPENAI_API_KEY'])
     logger.info(f"openai initialized - {tick()-start_time}s elapsed")
 
+def timed_upload(file_path: str, prefix: str) -> str:
+  '''Upload a file and record how long it took.'''
+  stage_start = time.time()
+  url = upload_content_addressed(file_path, prefix)
+  record_latency('click_task.upload', time.time() - stage_start)
+  return url
+
+def describe_items(items: List[Item]) -> Optional[str]:
+  '''Describe a click from the titles of its items.
+  :return: description, None if there are no items or captioning failed
+  '''
+  stage_start = time.time()
+  description = None
+  try:
+    # Cluster the titles; one dominant cluster is described without the LLM
+    with span('captions.cluster'):
+      description, captions = prepare_captions([item.title for item in items], max_titles=5)
+    if description is not None:
+      logger.info(f'description from dominant cluster: {description}')
+    elif len(captions) > 0:
+      with span('openai.summarize_captions', num_captions=len(captions)):
+        description = summarize_captions(openai, captions, model="gpt-4o-mini")
+      logger.info(f'generated description: {description}')
+  except Exception as e:
+    logger.error(f'error summarizing captions: {e}')
+  record_latency('click_task.caption', time.time() - stage_start)
+  return description
+
+class ClickStages:
+  '''Results of the stages of a click that run under a budget, some possibly still running.
+  :param image_upload: upload of the image
+  :param mask_upload: upload of the masked image
+  :param items: items found so far
+  :param search_done: whether no (more) search is needed
+  '''
+  def __init__(self, image_upload: 'Future', mask_upload: 'Future', items: List[Item], search_done: bool):
+    self.image_upload = image_upload
+    self.mask_upload = mask_upload
+    self.items = items
+    self.search_done = search_done
+    self.search: Optional['Future'] = None
+    self.caption: Optional['Future'] = None
+    self.caption_done = False
+    self.image_url: Optional[str] = None
+    self.masked_url: Optional[str] = None
+    self.description: Optional[str] = None
+    # First stage that ran out of budget, finished by `finish_click_in_background`
+    self.pending_stage: Optional[str] = None
+
+def finish_click_in_background(
+  click_id: str, 
+  version: int, 
+  update_request: ClickUpdate, 
+  stages: ClickStages, 
+  fingerprint: Optional[str] = None,
+):
+  '''Wait for (or run) the stages that ran out of budget, then commit the full result.
+  :note: the fingerprint is only completed if every stage succeeded, otherwise it is released
+  '''
+  try:
+    stages.image_url = stages.image_upload.result()
+    stages.masked_url = stages.mask_upload.result()
+    if not stages.search_done:
+      try:
+        if stages.search is None:
+          stages.search = submit_stage(search_items_for_click, db, env['SERP_API_KEY'], click_id, stages.masked_url, version, limit=25)
+        stages.items = stages.items + stages.search.result()
+      except Exception as e:
+        logger.error(f'error searching for items in background: {e}')
+        record_degradation(db, 'search', 'error')
+        update_request = update_request.model_copy(update={
+          'degradations': (update_request.degradations or []) + ['search:error'],
+        })
+    if not stages.caption_done:
+      # Captioning only started in the foreground if search finished there
+      if stages.caption is None:
+        stages.caption = submit_stage(describe_items, stages.items)
+      stages.description = stages.caption.result()
+    update_request = update_request.model_copy(update={
+      'image_url': stages.image_url,
+      'masked_url': stages.masked_url,
+      'description': stages.description,
+    })
+    click = update_click(db, click_id, update_request)
+    logger.info(f'finished {stages.pending_stage} of click {click_id} in background')
+    if fingerprint is not None:
+      resolve_fingerprint(fingerprint, click_id, update_request, click.version, len(stages.items))
+  except Exception as e:
+    logger.error(f'error finishing click {click_id} in background: {e}')
+    if fingerprint is not None:
+      # Followers get the result committed before the background work
+      release_fingerprint(db, fingerprint, click_id, update_request, version)
+
+def refresh_local_matches(click_id: str, masked_url: str, version: int):
+  '''Search Google Lens for a click answered from the local index (`LOCAL_MATCH_MODE=background`).'''
+  try:
+    lens_items = search_items_for_click(db, env['SERP_API_KEY'], click_id, masked_url, version, limit=25)
+    logger.info(f'{len(lens_items)} background items found for click {click_id}')
+  except Exception as e:
+    logger.error(f'error searching for items in background: {e}')
+    record_degradation(db, 'search', 'error')
+
+def resolve_fingerprint(fingerprint: str, click_id: str, update_request: ClickUpdate, version: int, num_items: int) -> int:
+  '''Share a committed result with identical clicks; only results with items and without failed stages
+  are kept for later ones (see `is_reusable_result`).
+  :param num_items: number of items found for the click
+  :return: number of waiting clicks filled in
+  '''
+  if is_reusable_result(update_request.degradations, num_items):
+    return complete_fingerprint(db, fingerprint, click_id, update_request, version)
+  return release_fingerprint(db, fingerprint, click_id, update_request, version)
+
+def classify_preparation_miss(image_hash: str) -> str:
+  '''`miss_process` if the embedding is held by another process of this worker, otherwise `miss`.'''
+  try:
+    preparation = fetch_preparation(image_hash)
+  except Exception as e:
+    logger.error(f'error fetching preparation {image_hash}: {e}')
+    return 'miss'
+  if preparation is None or preparation.get('hostname') != click_task.request.hostname:
+    return 'miss'
+  return 'miss_process' if preparation.get('pid') != str(os.getpid()) else 'miss'
+
 @shared_task(name="seeclickbuy:click_task")
-def click_task(click_id: str, base64_image: str, cache_dir: str = './cache') -> bool:
+def click_task(
+  click_id: str, 
+  base64_image: str, 
+  cache_dir: str = './cache', 
+  fingerprint: Optional[str] = None,
+  deadline: Optional[float] = None,
+  image_hash: Optional[str] = None,
+) -> bool:
   '''
+  :note: stages that run past their budget are finished in the background after the first commit
+  :note: if the task fails, its fingerprint is released and the click is marked failed (`pipeline:error`)
+    so neither it nor identical clicks waiting on it stay unprocessed
   :param click_id: The firebase document id of the click
   :param base64_image: The base64 encoded image
   :param cache_dir: The directory to store the cache in
+  :param fingerprint: The dedup fingerprint claimed by this click, if any
+  :param deadline: unix time by which the click should be committed (see `server.deadlines`)
+  :param image_hash: hash of the image if it was sent to `/prepare`, to reuse its embedding
+  '''
+  try:
+    result = process_click(click_id, base64_image, cache_dir, fingerprint, deadline, image_hash)
+  except Exception:
+    if fingerprint is not None:
+      release_fingerprint(db, fingerprint, click_id)
+    try:
+      mark_click_failed(db, click_id, 'pipeline:error')
+    except Exception as e:
+      logger.error(f'error marking click {click_id} failed: {e}')
+    raise
+  if result is not True and fingerprint is not None:
+    release_fingerprint(db, fingerprint, click_id)
+  return result
+
+def process_click(
+  click_id: str, 
+  base64_image: str, 
+  cache_dir: str, 
+  fingerprint: Optional[str],
+  deadline: Optional[float],
+  image_hash: Optional[str],
+):
+  '''Body of `click_task`.
+  :return: True once the click is committed, a failed `build_response` if it could not be processed
   '''
   logger.info(f'received click task with click_id={click_id}')
   # Fetch click
   start_time = tick()
+  task_start = time.time()
+  budget = Deadline(deadline)
+  degradations: List[str] = []
+  def degrade(stage: str, action: str):
+    degradations.append(f'{stage}:{action}')
+    record_degradation(db, stage, action)
+    logger.warning(f'{stage} degraded ({action}) - {budget.remaining():.2f}s until deadline')
   fb_click_ref = db.collection('Clicks').document(click_id)
   fb_click = fb_click_ref.get()
   if not fb_click.exists:  # bail if click does not exist
@@ -92,86 +414,461 @@ def click_task(click_id: str, base64_image: str, cache_dir: str = './cache') ->
   image_path = join(cache_dir, f'{click_id}.png')
   image_pil.save(image_path)
   image = np.asarray(image_pil)
-  # Upload the image to Firebase Storage
-  image_url = upload_file_to_firebase(image_path, f'images/{click.click_id}.png')
-  logger.info(f'uploading image - {tick()-start_time}s elapsed')
+  # Upload the image to Firebase Storage while SAM2 runs
+  image_upload = submit_stage(timed_upload, image_path, 'images/')
   # Call SAM2 to get the mask
+  stage_start = time.time()
+  # An embedding from `prepare_task` leaves only the mask decoder to run
+  embedding = prepared_embeddings.get(image_hash) if image_hash is not None else None
+  if image_hash is not None:
+    record_preparation_event(db, 'hit' if embedding is not None else classify_preparation_miss(image_hash))
   # If we have a selection, use that. Otherwise, use the click
-  if click.selection is not None:
-    segm = infer_selection(sam2, image, click.selection)
-  elif click.click is not None:
-    segm = infer_click(sam2, image, click.click)
-  else:
-    raise ValueError(f'click {click_id} does not have a click or selection')
+  with span('sam2.infer', prepared=embedding is not None):
+    if click.selection is not None:
+      segm, logits = infer_selection(sam2, image, click.selection, return_logits=True, embedding=embedding)
+    elif click.click is not None:
+      segm, logits = infer_click(sam2, image, click.click, return_logits=True, embedding=embedding)
+    else:
+      raise ValueError(f'click {click_id} does not have a click or selection')
+  # SAM2 cannot be interrupted and everything depends on the mask, so a slow run is only recorded
+  segmentation_seconds = time.time() - stage_start
+  record_latency('click_task.segmentation', segmentation_seconds)
+  if segmentation_seconds > STAGE_BUDGETS['segmentation']:
+    degrade('segmentation', 'slow')
   logger.info(f'sam2 inference - {tick()-start_time}s elapsed')
+  # Keep the embedding around so refinements only run the mask decoder
+  refinement_sessions.put(click_id, RefinementSession(
+    embedding=get_image_embedding(sam2),
+    image=image,
+    points=[tuple(click.click)] if click.selection is None else [],
+    labels=[1] if click.selection is None else [],
+    selection=click.selection,
+    logits=logits,
+  ))
   # Create PNG mask image and upload to Firebase Storage
   masked_path = create_masked_image(image, segm, join(cache_dir, f'{click.click_id}.masked.png'))
   logger.info(f'creating mask image - {tick()-start_time}s elapsed')
   masked = load_image(masked_path)
-  # Upload the mask image to Firebase Storage
-  masked_url = upload_file_to_firebase(masked_path, f'masks/{click.click_id}.png')
-  logger.info(f'uploading mask image - {tick()-start_time}s elapsed')
+  mask_upload = submit_stage(timed_upload, masked_path, 'masks/')
   # Compress the info for storage
   bbox = round_bbox(binary_mask_to_bbox(segm))
   segm = binary_mask_to_coco_format(segm)
-  # Search for items in the click
-  try: 
-    items = search_items_for_click(db, env['SERP_API_KEY'], click_id, masked_url, click.version, limit=25)
-    logger.info(f'{len(items)} items found - {tick()-start_time}s elapsed')
-  except Exception as e:
-    logger.error(f'error searching for items: {e}')
-    raise e
-  items: List[Item] = items
-  # Call OpenAI to get the description
+  # Look for visually similar items we have already retrieved
+  stage_start = time.time()
+  items: List[Item] = []
+  if LOCAL_MATCH_MODE != 'off':
+    try:
+      with span('local_index.search'):
+        matches = find_similar_items(masked_path)
+      if len(matches) >= LOCAL_MATCH_MIN_ITEMS:
+        items = copy_items_to_click(db, [item_id for item_id, _ in matches], click_id, click.version)
+      logger.info(f'{len(items)} local items found - {tick()-start_time}s elapsed')
+    except Exception as e:
+      logger.error(f'error searching local index: {e}')
+  use_local = len(items) >= LOCAL_MATCH_MIN_ITEMS
+  # Run the remaining stages under their budgets; the first one out of time moves the rest to the background
+  stages = ClickStages(image_upload=image_upload, mask_upload=mask_upload, items=items, search_done=use_local)
   try:
-    captions = [item.title for item in items]
-    # for now, cap at 5 to now overwhelm
-    description = summarize_captions(openai, captions[:5], model="gpt-4o-mini")
-    logger.info(f'generated description: {description}')
+    stages.image_url = wait_stage(image_upload, 'upload', budget.budget('upload'))
+    stages.masked_url = wait_stage(mask_upload, 'upload', budget.budget('upload'))
+    logger.info(f'uploaded image and mask - {tick()-start_time}s elapsed')
+    if not use_local:
+      stages.search = submit_stage(search_items_for_click, db, env['SERP_API_KEY'], click_id, stages.masked_url, click.version, limit=25)
+      stages.items = stages.items + wait_stage_or_degrade(stages.search, 'search', budget.budget('search'), degrade, [])
+      logger.info(f'{len(stages.items)} items found - {tick()-start_time}s elapsed')
+      record_latency('click_task.search', time.time() - stage_start)
+      stages.search_done = True
+    stages.caption = submit_stage(describe_items, stages.items)
+    stages.description = wait_stage(stages.caption, 'caption', budget.budget('caption'))
+    stages.caption_done = True
+  except StageTimeout as e:
+    degrade(e.stage, 'background')
+    stages.pending_stage = e.stage
   except Exception as e:
-    logger.error(f'error summarizing captions: {e}')
-    description = None
-  # Update the click doc with the mask and description
+    logger.error(f'error uploading image or mask: {e}')
+    degrade('upload', 'error')
+  # Commit whatever is ready: the mask and bbox at least
   update_request = ClickUpdate(
-    image_url=image_url,
+    image_url=stages.image_url,
     image_size=[int(width), int(height)],
     bbox=bbox,
     segm=[int(x) for x in segm[0]],
-    masked_url=masked_url,
+    masked_url=stages.masked_url,
     masked_size=[int(x) for x in list(masked.shape)[:2]],  # width, height
-    description=description,
+    description=stages.description,
+    degradations=degradations if len(degradations) > 0 else None,
   )
   click = update_click(db, click_id, update_request)
+  record_latency('click_task', time.time() - task_start)
+  if stages.pending_stage is not None:
+    submit_background(finish_click_in_background, click_id, click.version, update_request, stages, fingerprint)
+    logger.info(f'click task committed early {click_id}, finishing {stages.pending_stage} in background - {tick()-start_time}s elapsed')
+    return True
+  # Share the result with identical requests that arrived while this one was running
+  if fingerprint is not None:
+    num_followers = resolve_fingerprint(fingerprint, click_id, update_request, click.version, len(stages.items))
+    logger.info(f'resolved {num_followers} duplicate clicks - {tick()-start_time}s elapsed')
+  # Local matches were committed first; fetch fresh results from Google Lens after, without holding the worker
+  if use_local and LOCAL_MATCH_MODE == 'background' and stages.masked_url is not None:
+    submit_background(refresh_local_matches, click_id, stages.masked_url, click.version)
   logger.info(f'click task complete {click_id} - {tick()-start_time}s elapsed')
   return True
 
+def chat_instruction(chat: 'Chat') -> str:
+  '''Instruction of a chat, prefixed by the chats on the same version it superseded.
+  Rapid-fire edits are applied at once instead of dropping all but the last one.
+  '''
+  chats = fetch_chats_for_click(db, chat.click_id, limit=10)
+  texts = [
+    other.text for other in reversed(chats)
+    if other.chat_id != chat.chat_id
+    and other.version == chat.version
+    and other.status in ('pending', 'streaming', 'superseded')
+    and other.created_at <= chat.created_at
+  ]
+  return '; '.join(texts + [chat.text])
+
+def stream_to_chat(chat_id: str) -> Callable[[str], None]:
+  '''Callback writing a streamed caption to its chat, at most every `CHAT_STREAM_INTERVAL` seconds.'''
+  last_write = 0.
+  def on_text(text: str):
+    nonlocal last_write
+    if time.time() - last_write < CHAT_STREAM_INTERVAL:
+      return
+    last_write = time.time()
+    try:
+      update_chat_status(db, chat_id, 'streaming', text)
+    except ValueError as e:
+      logger.error(f'error streaming chat {chat_id}: {e}')
+  return on_text
+
 @shared_task(name="seeclickbuy:chat_task")
-def chat_task(click_id: str) -> bool:
-  '''Search for new items based on a new description.
+def chat_task(click_id: str, chat_id: str) -> bool:
+  '''Edit the description of a click with a chat, then search for new items based on it.
+  :note: a chat that is no longer the latest of its click is skipped; the latest one applies its instruction
   :param click_id: id of the click
+  :param chat_id: id of the chat
   '''
-  logger.info(f'received chat task with click_id={click_id}')
-  # Fetch click
+  logger.info(f'received chat task with click_id={click_id} chat_id={chat_id}')
   start_time = tick()
-  fb_click_ref = db.collection('Clicks').document(click_id)
-  fb_click = fb_click_ref.get()
-  if not fb_click.exists:  # bail if click does not exist
-    logger.error(f'click {click_id} document does not exist. quitting...')
-    return build_response(success=False, error=f"click {click_id} does not exist")
-  click = click_to_pydantic(fb_click, click_id)
-  logger.info(f'fetched click doc - {tick()-start_time}s elapsed')
-  # Bail if click does not have a description
-  if click.description is None:
-    logger.error(f'click {click_id} does not have a description. quitting...')
-    return build_response(success=False, error=f"click {click_id} does not have a description")
-  # Search for items in the click
-  try:  
-    items = search_items_for_text(db, env['SERP_API_KEY'], click_id, standardize_text(click.description), click.version, limit=25)
+  task_start = time.time()
+  try:
+    click = fetch_click_by_id(db, click_id)
+    chat = fetch_chat_by_id(db, chat_id)
+  except ValueError as e:
+    logger.error(f'{e}. quitting...')
+    return build_response(success=False, error=str(e))
+  logger.info(f'fetched click and chat docs - {tick()-start_time}s elapsed')
+  if click.latest_chat_id != chat_id:
+    logger.info(f'chat {chat_id} superseded by {click.latest_chat_id}. skipping...')
+    update_chat_status(db, chat_id, 'superseded')
+    return True
+  # Edit the caption, streaming it to the chat document
+  update_chat_status(db, chat_id, 'streaming')
+  with span('openai.edit_caption'):
+    new_description = edit_caption_stream(openai, chat.pre_description, chat_instruction(chat), stream_to_chat(chat_id), model="gpt-4o-mini")
+  logger.info(f'edited caption - {tick()-start_time}s elapsed')
+  if not new_description:
+    logger.error(f'error editing caption for chat {chat_id}')
+    update_chat_status(db, chat_id, 'failed')
+    if fetch_click_by_id(db, click_id).latest_chat_id == chat_id:
+      update_is_processed_for_click(db, click_id, True)
+    return False
+  click = complete_chat(db, chat_id, new_description)
+  if click is None:
+    logger.info(f'chat {chat_id} superseded while editing. skipping search...')
+    return True
+  # Search as soon as the caption is final, unless a newer chat will search anyway
+  if fetch_click_by_id(db, click_id).latest_chat_id != chat_id:
+    logger.info(f'chat {chat_id} superseded before searching. skipping search...')
+    return True
+  try:
+    items = search_items_for_text(db, env['SERP_API_KEY'], click_id, standardize_text(new_description), click.version, limit=25)
     logger.info(f'{len(items)} items found - {tick()-start_time}s elapsed')
   except Exception as e:
     logger.error(f'error searching for items: {e}')
     return False
-  # Update the click to be processed
-  click = update_is_processed_for_click(db, click_id, True)
+  # Leave the click unprocessed while a newer chat is in flight
+  if fetch_click_by_id(db, click_id).latest_chat_id == chat_id:
+    update_is_processed_for_click(db, click_id, True)
+  record_latency('chat_task', time.time() - task_start)
   logger.info(f'chat task complete - {tick()-start_time}s elapsed')
   return True
+
+def start_refinement_session(click: Click, cache_dir: str = './cache') -> RefinementSession:
+  '''Rebuild a refinement session when it is not in this worker's store, or is behind the click.
+  The refinements persisted on the click (`refine_points`) are replayed one step at a time, so the
+  session ends up where the worker that made them left it.
+  :note: this runs the image encoder, so it is the slow path
+  '''
+  click_id = click.click_id
+  if click.image_url is None:
+    raise ValueError(f'click {click_id} has not been processed')
+  makedirs(cache_dir, exist_ok=True)
+  image_path = download_image(click.image_url, cache_dir, f'{click_id}.png')
+  image = load_image(image_path)
+  if click.selection is not None:
+    _, logits = infer_selection(sam2, image, click.selection, return_logits=True)
+  else:
+    _, logits = infer_click(sam2, image, click.click, return_logits=True)
+  session = RefinementSession(
+    embedding=get_image_embedding(sam2),
+    image=image,
+    points=[tuple(click.click)] if click.selection is None else [],
+    labels=[1] if click.selection is None else [],
+    selection=click.selection,
+    logits=logits,
+  )
+  refine_points = click.refine_points or []
+  for step in sorted(set(point.step for point in refine_points)):
+    step_points = [point for point in refine_points if point.step == step]
+    session.points = session.points + [(point.x, point.y) for point in step_points]
+    session.labels = session.labels + [point.label for point in step_points]
+    _, session.logits = refine_mask(sam2, session.embedding, session.points, session.labels, session.selection, session.logits)
+    session.num_refinements += 1
+  return session
+
+def count_refinements(click: Click) -> int:
+  '''Number of refinements persisted on a click.'''
+  return len(set(point.step for point in click.refine_points or []))
+
+@shared_task(name="seeclickbuy:refine_task")
+def refine_task(click_id: str, points: List[List[int]], labels: List[int], cache_dir: str = './cache') -> bool:
+  '''Refine the mask of a click with extra positive/negative points.
+  :param click_id: id of the click
+  :param points: new points (x, y), added to the points of earlier refinements
+  :param labels: 1 for positive and 0 for negative points
+  :param cache_dir: The directory to store the cache in
+  :note: points are persisted on the click, so a refinement reaching another worker (or an evicted
+    session) rebuilds the session with every earlier point instead of starting over
+  '''
+  logger.info(f'received refine task with click_id={click_id}')
+  start_time = time.time()
+  session = refinement_sessions.get(click_id)
+  try:
+    click = fetch_click_by_id(db, click_id)
+  except Exception as e:
+    logger.error(f'error fetching click {click_id}: {e}')
+    return build_response(success=False, error=str(e))
+  num_refinements = count_refinements(click)
+  if session is None or session.num_refinements != num_refinements:
+    logger.info(f'no refinement session for click {click_id} at refinement {num_refinements}, re-encoding image')
+    try:
+      session = start_refinement_session(click, cache_dir)
+    except Exception as e:
+      logger.error(f'error starting refinement session: {e}')
+      update_is_processed_for_click(db, click_id, True)
+      return build_response(success=False, error=str(e))
+  # The session only takes the new points once the mask is committed, so a failure rolls them back
+  session_points = session.points + [tuple(point) for point in points]
+  session_labels = session.labels + list(labels)
+  try:
+    with span('sam2.refine'):
+      segm, logits = refine_mask(sam2, session.embedding, session_points, session_labels, session.selection, session.logits)
+    if not segm.any():
+      raise ValueError('refinement removed the whole mask')
+    logger.info(f'sam2 refinement - {time.time()-start_time:.3f}s elapsed')
+    # Create PNG mask image and upload; blobs are named by content so clients never see a stale mask
+    makedirs(cache_dir, exist_ok=True)
+    masked_path = create_masked_image(session.image, segm, join(cache_dir, f'{click_id}.masked.png'))
+    masked = load_image(masked_path)
+    masked_url = upload_content_addressed(masked_path, 'masks/')
+    update_request = ClickMaskUpdate(
+      bbox=round_bbox(binary_mask_to_bbox(segm)),
+      segm=[int(x) for x in binary_mask_to_coco_format(segm)[0]],
+      masked_url=masked_url,
+      masked_size=[int(x) for x in list(masked.shape)[:2]],
+      refine_points=(click.refine_points or []) + [
+        RefinePoint(x=int(x), y=int(y), label=int(label), step=num_refinements)
+        for (x, y), label in zip(points, labels)
+      ],
+    )
+    update_click_mask(db, click_id, update_request)
+  except Exception as e:
+    # Keep the previous mask
+    logger.error(f'error refining click {click_id}: {e}')
+    update_is_processed_for_click(db, click_id, True)
+    return build_response(success=False, error=str(e))
+  session.points, session.labels, session.logits = session_points, session_labels, logits
+  session.num_refinements += 1
+  refinement_sessions.put(click_id, session)
+  logger.info(f'refine task complete {click_id} - {time.time()-start_time:.3f}s elapsed')
+  return True
+
+@shared_task(name="seeclickbuy:prepare_task")
+def prepare_task(image_hash: str, base64_image: str) -> bool:
+  '''Encode an image before it is clicked, so `click_task` only runs the mask decoder.
+  :note: `/click` routes the click to this worker's direct queue once the hostname is recorded
+  :param image_hash: hash of the image, see `server.dedup.image_digest`
+  :param base64_image: The base64 encoded image
+  '''
+  start_time = tick()
+  task_start = time.time()
+  if not preparations_enabled():
+    # Clicks routed to this worker could reach any of its processes, see `server.preparation`
+    cancel_preparation(image_hash)
+    record_preparation_event(db, 'skipped')
+    return False
+  if prepared_embeddings.get(image_hash) is not None:
+    update_preparation(image_hash, 'ready', prepare_task.request.hostname)
+    return True
+  # Record the worker first, so a click arriving while encoding waits for it in this worker's queue
+  if not update_preparation(image_hash, 'encoding', prepare_task.request.hostname):
+    logger.info(f'preparation {image_hash} was cancelled. skipping...')
+    return False
+  image = np.asarray(decode_base64_to_image(base64_image).convert('RGB'))
+  stage_start = time.time()
+  with span('sam2.set_image'), torch_profile('set_image'):
+    sam2.set_image(image)
+  record_latency('prepare_task.encode', time.time() - stage_start)
+  prepared_embeddings.put(image_hash, get_image_embedding(sam2))
+  if not update_preparation(image_hash, 'ready', prepare_task.request.hostname):
+    # Cancelled while encoding
+    prepared_embeddings.pop(image_hash)
+    return False
+  record_latency('prepare_task', time.time() - task_start)
+  logger.info(f'prepared image {image_hash} - {tick()-start_time}s elapsed')
+  return True
+
+@shared_task(name="seeclickbuy:drop_preparation_task")
+def drop_preparation_task(image_hash: str) -> bool:
+  '''Free the embedding of a cancelled preparation; sent to the worker's direct queue.'''
+  return prepared_embeddings.pop(image_hash) is not None
+
+@shared_task(name="seeclickbuy:compaction_task")
+def compaction_task(cache_dir: str = './cache', dry_run: bool = False) -> dict:
+  '''Reclaim superseded items, stale cache files and orphaned masks; scheduled by celery beat.
+  :param cache_dir: The directory to store the cache in
+  :param dry_run: only report what would be reclaimed
+  '''
+  logger.info(f'received compaction task (dry_run={dry_run})')
+  start_time = time.time()
+  report = run_compaction(db, cache_dir, dry_run=dry_run)
+  if not dry_run:
+    record_compaction_report(db, report)
+  logger.info(f'compaction task complete {report} - {time.time()-start_time:.3f}s elapsed')
+  return report
+
+def get_sam2_video() -> 'SAM2VideoPredictor':
+  '''Video predictor for tracking, sharing weights with the image predictor.'''
+  global sam2_video
+  if sam2_video is None:
+    start_time = time.time()
+    sam2_video = load_sam2_video(SAM2_MODEL_CFG, SAM2_DEVICE, weights_format=SAM2_WEIGHTS_FORMAT, image_predictor=sam2)
+    logger.info(f'sam2 video predictor initialized - {time.time()-start_time:.2f}s elapsed, rss {get_rss_mb():.0f}MB')
+  return sam2_video
+
+def start_tracking_session(click_id: str, cache_dir: str = './cache') -> TrackingSession:
+  '''Start tracking from the click's original image and prompt.'''
+  click = fetch_click_by_id(db, click_id)
+  if click.image_url is None or click.masked_url is None:
+    raise ValueError(f'click {click_id} has not been processed')
+  makedirs(cache_dir, exist_ok=True)
+  image_path = download_image(click.image_url, cache_dir, f'{click_id}.png')
+  masked_path = download_image(click.masked_url, cache_dir, f'{click_id}.masked.png')
+  image = load_image(image_path)
+  with span('sam2.track_init'):
+    state = init_video_tracking(get_sam2_video(), image, click.click, click.selection)
+  return TrackingSession(
+    state=state,
+    frame_size=(int(image.shape[1]), int(image.shape[0])),
+    search_embedding=embed_image(masked_path),
+  )
+
+def commit_tracked_frame(
+  click: 'Click',
+  session: TrackingSession,
+  frame_pil: 'Image.Image',
+  image: np.ndarray,
+  segm: np.ndarray,
+  cache_dir: str,
+):
+  '''Upload the last tracked frame and its mask, search again if the crop changed, and update the click.'''
+  click_id = click.click_id
+  makedirs(cache_dir, exist_ok=True)
+  image_path = join(cache_dir, f'{click_id}.png')
+  frame_pil.save(image_path)
+  image_url = upload_content_addressed(image_path, 'images/')
+  masked_path = create_masked_image(image, segm, join(cache_dir, f'{click_id}.masked.png'))
+  masked = load_image(masked_path)
+  masked_url = upload_content_addressed(masked_path, 'masks/')
+  # Search again only when the crop looks different from the one items were found for
+  description = click.description
+  embedding = embed_image(masked_path)
+  similarity = float(embedding @ session.search_embedding) if session.search_embedding is not None else -1.
+  if similarity < TRACK_SEARCH_SIMILARITY:
+    logger.info(f'crop changed (similarity {similarity:.3f}), searching again')
+    # Search under the next version, then switch to it, so the current items stay visible meanwhile
+    try:
+      items = search_items_for_click(db, env['SERP_API_KEY'], click_id, masked_url, click.version + 1, limit=25)
+    except Exception as e:
+      logger.error(f'error searching for items of tracked crop: {e}')
+      record_degradation(db, 'search', 'error')
+      items = []
+    if len(items) == 0:
+      # Keep the current items and search again on the next frames
+      logger.warning(f'no items found for tracked crop of click {click_id}, keeping version {click.version}')
+    elif upgrade_click_version(db, click_id, click.version) is None:
+      # A chat moved the click to that version meanwhile; its items win
+      logger.info(f'click {click_id} moved past version {click.version}, dropping tracked search results')
+      delete_items(db, items)
+    else:
+      description = describe_items(items) or description
+      session.search_embedding = embedding
+      session.num_searches += 1
+  update_request = ClickUpdate(
+    image_url=image_url,
+    image_size=list(session.frame_size),
+    bbox=round_bbox(binary_mask_to_bbox(segm)),
+    segm=[int(x) for x in binary_mask_to_coco_format(segm)[0]],
+    masked_url=masked_url,
+    masked_size=[int(x) for x in list(masked.shape)[:2]],
+    description=description,
+  )
+  update_click(db, click_id, update_request)
+
+@shared_task(name="seeclickbuy:track_task")
+def track_task(click_id: str, frames: List[str], cache_dir: str = './cache') -> bool:
+  '''Propagate the mask of a click to new frames without new prompts.
+  Only the last frame is committed; items are searched again only if its masked crop changed materially.
+  :param click_id: id of the click
+  :param frames: base64 encoded frames, oldest first
+  :param cache_dir: The directory to store the cache in
+  '''
+  logger.info(f'received track task with click_id={click_id} ({len(frames)} frames)')
+  start_time = time.time()
+  try:
+    click = fetch_click_by_id(db, click_id)
+    session = tracking_sessions.get(click_id)
+    if session is None:
+      logger.info(f'no tracking session for click {click_id}, starting one')
+      session = start_tracking_session(click_id, cache_dir)
+    for base64_frame in frames:
+      frame_pil = decode_base64_to_image(base64_frame).convert('RGB')
+      if frame_pil.size != session.frame_size:
+        frame_pil = frame_pil.resize(session.frame_size)
+      image = np.asarray(frame_pil)
+      with span('sam2.track'):
+        segm = track_frame(get_sam2_video(), session.state, image)
+      session.num_frames += 1
+    tracking_sessions.put(click_id, session)
+  except Exception as e:
+    logger.error(f'error tracking click {click_id}: {e}')
+    update_is_processed_for_click(db, click_id, True)
+    return build_response(success=False, error=str(e))
+  logger.info(f'sam2 tracking - {time.time()-start_time:.3f}s elapsed')
+  if segm.mean() < TRACK_MIN_MASK_AREA:
+    logger.info(f'object of click {click_id} lost, keeping the previous mask')
+    update_is_processed_for_click(db, click_id, True)
+    return build_response(success=False, error='object lost')
+  try:
+    commit_tracked_frame(click, session, frame_pil, image, segm, cache_dir)
+  except Exception as e:
+    # Keep the previous frame and mask
+    logger.error(f'error committing tracked frame of click {click_id}: {e}')
+    update_is_processed_for_click(db, click_id, True)
+    return build_response(success=False, error=str(e))
+  # The refinement embedding belongs to the old frame
+  refinement_sessions.pop(click_id)
+  logger.info(f'track task complete {click_id} ({session.num_frames} frames, {session.num_searches} searches) - {time.time()-start_time:.3f}s elapsed')
+  return True
@@ -0,0 +1,233 @@
+import io
+import os
+import json
+import socket
+import hashlib
+import threading
+import ipaddress
+import requests
+from os import environ as env
+from os.path import join, exists
+from typing import List, Optional, Dict
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+THUMBNAIL_DIR = env.get('THUMBNAIL_DIR', './cache/thumbnails')
+THUMBNAIL_SIZES = [int(x) for x in env.get('THUMBNAIL_SIZES', '64,128,256').split(',')]
+THUMBNAIL_MAX_BYTES = int(env.get('THUMBNAIL_MAX_BYTES', 512 * 1024 * 1024))
+THUMBNAIL_QUALITY = int(env.get('THUMBNAIL_QUALITY', 75))
+HTTP_TIMEOUT = float(env.get('THUMBNAIL_HTTP_TIMEOUT', 5))
+HTTP_POOL_SIZE = int(env.get('THUMBNAIL_HTTP_POOL_SIZE', 16))
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_REDIRECTS = 3
+# Eviction trims the cache to this fraction of `THUMBNAIL_MAX_BYTES` so it does not run on every write
+EVICT_TARGET = 0.9
+
+_session: Optional['requests.Session'] = None
+_executor: Optional['ThreadPoolExecutor'] = None
+_lock = threading.Lock()
+# Bytes of blobs in each cache directory, counted once and then updated as blobs are written
+_cache_bytes: Dict[str, int] = {}
+_cache_lock = threading.Lock()
+
+def get_http_session() -> 'requests.Session':
+  '''Shared HTTP session with a connection pool sized for concurrent prefetches.'''
+  global _session
+  with _lock:
+    if _session is None:
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=1)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      session.headers['User-Agent'] = 'seeclickbuy-thumbnails/0.1'
+      _session = session
+  return _session
+
+def get_executor() -> 'ThreadPoolExecutor':
+  '''Shared thread pool for background prefetches.'''
+  global _executor
+  with _lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix='thumbnails')
+  return _executor
+
+def close_http_clients():
+  '''Finish running prefetches, drop queued ones (they only warm caches) and close the pooled connections.'''
+  global _session, _executor
+  with _lock:
+    executor, session = _executor, _session
+    _executor, _session = None, None
+  if executor is not None:
+    executor.shutdown(wait=True, cancel_futures=True)
+  if session is not None:
+    session.close()
+
+def url_key(url: str) -> str:
+  '''Key of a source url, used to find its content digest.'''
+  return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def index_path(key: str, cache_dir: str = THUMBNAIL_DIR) -> str:
+  return join(cache_dir, 'index', f'{key}.json')
+
+def blob_path(digest: str, size: int, cache_dir: str = THUMBNAIL_DIR) -> str:
+  return join(cache_dir, 'blobs', digest[:2], f'{digest}_{size}.webp')
+
+def write_atomic(path: str, data: bytes):
+  '''Write a file so readers never see it half written.'''
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.replace(tmp_path, path)
+
+def encode_thumbnails(content: bytes, sizes: List[int] = THUMBNAIL_SIZES) -> Dict[int, bytes]:
+  '''Resize an image to each size (longest side) and re-encode as WebP.
+  :param content: raw bytes of the source image
+  :return: mapping from size to WebP bytes
+  '''
+  image = Image.open(io.BytesIO(content))
+  image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+  thumbnails: Dict[int, bytes] = {}
+  for size in sorted(sizes, reverse=True):
+    resized = image.copy()
+    resized.thumbnail((size, size), Image.LANCZOS)  # never upscales
+    buffered = io.BytesIO()
+    resized.save(buffered, format='WEBP', quality=THUMBNAIL_QUALITY, method=4)
+    thumbnails[size] = buffered.getvalue()
+  return thumbnails
+
+def is_public_url(url: str) -> bool:
+  '''Whether a url is http(s) and its host only resolves to public addresses.
+  :note: item images come from third parties, so this keeps the server from fetching internal
+    addresses (metadata endpoints, the broker, localhost) on their behalf
+  '''
+  parts = urlsplit(url)
+  if parts.scheme not in ('http', 'https') or not parts.hostname:
+    return False
+  try:
+    infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+  except (socket.gaierror, UnicodeError, ValueError):
+    return False
+  return len(infos) > 0 and all(ipaddress.ip_address(info[4][0].split('%')[0]).is_global for info in infos)
+
+def download_image(url: str) -> bytes:
+  '''Download a source image, checking every redirect target with `is_public_url`.'''
+  for _ in range(MAX_REDIRECTS + 1):
+    if not is_public_url(url):
+      raise ValueError('url is not a public http(s) url')
+    # Closing the streamed response on every path returns the connection to the pool only when it was
+    # read to the end; a partly read one (e.g. an oversized image) is discarded
+    with get_http_session().get(url, timeout=HTTP_TIMEOUT, stream=True, allow_redirects=False) as response:
+      if response.is_redirect:
+        url = urljoin(url, response.headers['location'])
+        continue
+      response.raise_for_status()
+      content = response.raw.read(MAX_SOURCE_BYTES + 1, decode_content=True)
+      if len(content) > MAX_SOURCE_BYTES:
+        raise ValueError(f'image is larger than {MAX_SOURCE_BYTES} bytes')
+      return content
+  raise ValueError(f'more than {MAX_REDIRECTS} redirects')
+
+def fetch_thumbnail(url: str, cache_dir: str = THUMBNAIL_DIR) -> Optional[str]:
+  '''Download, resize and store a thumbnail.
+  :note: blobs are content-addressed so the same image behind different urls is stored once
+  :param url: url of the source image, taken from a stored item
+  :return: content digest, None if the image could not be fetched
+  '''
+  key = url_key(url)
+  if exists(index_path(key, cache_dir)):
+    with open(index_path(key, cache_dir)) as f:
+      digest = json.load(f)['digest']
+    if all(exists(blob_path(digest, size, cache_dir)) for size in THUMBNAIL_SIZES):
+      return digest
+  written = 0
+  try:
+    content = download_image(url)
+    digest = hashlib.sha256(content).hexdigest()
+    for size, data in encode_thumbnails(content).items():
+      path = blob_path(digest, size, cache_dir)
+      if not exists(path):
+        write_atomic(path, data)
+        written += len(data)
+  except Exception as e:
+    print(f'Error fetching thumbnail {url}: {e}')
+    return None
+  write_atomic(index_path(key, cache_dir), json.dumps({'url': url, 'digest': digest}).encode('utf-8'))
+  record_written_bytes(written, cache_dir)
+  return digest
+
+def prefetch_thumbnails(urls: List[Optional[str]], cache_dir: str = THUMBNAIL_DIR):
+  '''Fetch thumbnails concurrently in the background.
+  :param urls: urls of source images; missing urls are skipped
+  '''
+  executor = get_executor()
+  for url in set(url for url in urls if url):
+    executor.submit(fetch_thumbnail, url, cache_dir)
+
+def get_thumbnail_path(url: str, size: int, cache_dir: str = THUMBNAIL_DIR) -> Optional[str]:
+  '''Path to a cached thumbnail, fetching it on a miss.
+  :param url: url of the source image
+  :param size: one of `THUMBNAIL_SIZES`, or the nearest larger one is used
+  :return: path to the WebP file, None if the image could not be fetched
+  '''
+  candidates = [s for s in sorted(THUMBNAIL_SIZES) if s >= size]
+  size = candidates[0] if len(candidates) > 0 else max(THUMBNAIL_SIZES)
+  digest = fetch_thumbnail(url, cache_dir)
+  if digest is None:
+    return None
+  path = blob_path(digest, size, cache_dir)
+  try:
+    os.utime(path)  # mark as recently used for eviction
+  except FileNotFoundError:
+    return None
+  return path
+
+def list_blobs(cache_dir: str = THUMBNAIL_DIR) -> List[tuple]:
+  '''(mtime, size, path) of every blob in the cache.'''
+  blobs = []
+  for root, _, files in os.walk(join(cache_dir, 'blobs')):
+    for filename in files:
+      path = join(root, filename)
+      try:
+        stat = os.stat(path)
+      except FileNotFoundError:
+        continue
+      blobs.append((stat.st_mtime, stat.st_size, path))
+  return blobs
+
+def record_written_bytes(written: int, cache_dir: str = THUMBNAIL_DIR, max_bytes: int = THUMBNAIL_MAX_BYTES):
+  '''Add newly written blobs to the size of the cache, evicting once it is over `max_bytes`.
+  :note: the directory is only walked on first use and when evicting; other processes writing to the
+    same directory are picked up at the next eviction
+  '''
+  with _cache_lock:
+    if cache_dir not in _cache_bytes:
+      _cache_bytes[cache_dir] = sum(size for _, size, _ in list_blobs(cache_dir))
+    else:
+      _cache_bytes[cache_dir] += written
+    if _cache_bytes[cache_dir] <= max_bytes:
+      return
+    # Set the count before evicting so concurrent writers do not evict as well
+    _cache_bytes[cache_dir] = 0
+  remaining = evict_thumbnails(cache_dir, int(EVICT_TARGET * max_bytes))
+  with _cache_lock:
+    _cache_bytes[cache_dir] += remaining
+
+def evict_thumbnails(cache_dir: str = THUMBNAIL_DIR, max_bytes: int = THUMBNAIL_MAX_BYTES) -> int:
+  '''Delete least recently used blobs until the cache fits in `max_bytes`.
+  :note: index entries pointing at evicted blobs are refetched on the next miss
+  :return: bytes left in the cache
+  '''
+  blobs = list_blobs(cache_dir)
+  total = sum(size for _, size, _ in blobs)
+  for _, size, path in sorted(blobs):
+    if total <= max_bytes:
+      break
+    try:
+      os.remove(path)
+      total -= size
+    except FileNotFoundError:
+      pass
+  return total
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import functools
+from os import environ as env
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, Callable
+
+# `none`, `console` or `file`; see `get_exporter_from_env`
+TRACE_EXPORTER = env.get('TRACE_EXPORTER', 'none')
+TRACE_FILE = env.get('TRACE_FILE', './cache/traces.jsonl')
+TRACEPARENT_HEADER = 'traceparent'
+
+class Span:
+  '''A timed operation within a trace.
+  :param name: name of the operation, e.g. `firestore.update_click`
+  :param trace_id: 32 hex characters shared by every span of a request
+  :param parent_id: span id of the parent span, None for a root span
+  :param attributes: extra key/values to export with the span
+  '''
+  def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Optional[Dict[str, Any]] = None):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = f'{random.getrandbits(64):016x}'
+    self.parent_id = parent_id
+    self.attributes = dict(attributes or {})
+    self.start_time = time.time()
+    self.end_time: Optional[float] = None
+    self.error: Optional[str] = None
+
+  def set_attribute(self, key: str, value: Any):
+    self.attributes[key] = value
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {
+      'name': self.name,
+      'trace_id': self.trace_id,
+      'span_id': self.span_id,
+      'parent_id': self.parent_id,
+      'start_time': self.start_time,
+      'end_time': self.end_time,
+      'duration_ms': (self.end_time - self.start_time) * 1000. if self.end_time else None,
+      'attributes': self.attributes,
+      'error': self.error,
+    }
+
+class NoopExporter:
+  '''Drops spans.'''
+  def export(self, span: 'Span'):
+    pass
+
+class ConsoleExporter:
+  '''Prints spans as JSON lines to stderr.'''
+  def export(self, span: 'Span'):
+    print(json.dumps(span.to_dict()), file=sys.stderr)
+
+class FileExporter:
+  '''Appends spans as JSON lines to a file.
+  :param path: path of the JSONL file
+  '''
+  def __init__(self, path: str):
+    self.path = path
+    self.lock = threading.Lock()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+  def export(self, span: 'Span'):
+    line = json.dumps(span.to_dict()) + '\n'
+    with self.lock:
+      with open(self.path, 'a') as f:
+        f.write(line)
+
+def get_exporter_from_env() -> Any:
+  '''Exporter configured by `TRACE_EXPORTER`.'''
+  if TRACE_EXPORTER == 'console':
+    return ConsoleExporter()
+  elif TRACE_EXPORTER == 'file':
+    return FileExporter(TRACE_FILE)
+  return NoopExporter()
+
+_exporter = get_exporter_from_env()
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+# Parent from another process (an incoming request or a task message), as (trace_id, span_id)
+_remote_parent: ContextVar[Optional[tuple]] = ContextVar('remote_parent', default=None)
+
+def set_exporter(exporter: Any):
+  '''Replace the exporter; anything with an `export(span)` method works.'''
+  global _exporter
+  _exporter = exporter
+
+def new_trace_id() -> str:
+  return f'{random.getrandbits(128):032x}'
+
+def current_span() -> Optional['Span']:
+  return _current_span.get()
+
+def start_span(name: str, **attributes) -> 'Span':
+  '''Start a span as a child of the current span (or the remote parent).
+  :note: prefer the `span` context manager; this is for spans that end in another callback
+  '''
+  parent = _current_span.get()
+  if parent is not None:
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+  remote = _remote_parent.get()
+  if remote is not None:
+    return Span(name, remote[0], remote[1], attributes)
+  return Span(name, new_trace_id(), None, attributes)
+
+def end_span(span: 'Span', error: Optional[BaseException] = None):
+  '''End a span and export it.'''
+  span.end_time = time.time()
+  if error is not None:
+    span.error = f'{type(error).__name__}: {error}'
+  try:
+    _exporter.export(span)
+  except Exception as e:
+    print(f'Error exporting span {span.name}: {e}')
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator['Span']:
+  '''Trace a block of code.
+  :param name: name of the operation
+  :param attributes: extra key/values to export with the span
+  '''
+  current = start_span(name, **attributes)
+  token = _current_span.set(current)
+  try:
+    yield current
+  except BaseException as e:
+    end_span(current, e)
+    raise
+  else:
+    end_span(current)
+  finally:
+    _current_span.reset(token)
+
+def activate_span(current: 'Span') -> Any:
+  '''Make a span from `start_span` the current span.
+  :return: token for `deactivate_span`
+  '''
+  return _current_span.set(current)
+
+def deactivate_span(token: Any):
+  _current_span.reset(token)
+
+def record_span(name: str, start_time: float, end_time: float, **attributes):
+  '''Export a span for something that was timed elsewhere (e.g. time spent in a queue).'''
+  recorded = start_span(name, **attributes)
+  recorded.start_time = start_time
+  recorded.end_time = end_time
+  try:
+    _exporter.export(recorded)
+  except Exception as e:
+    print(f'Error exporting span {name}: {e}')
+
+def traced(name: str) -> Callable:
+  '''Decorator that traces every call of a function.'''
+  def decorator(fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def inject_headers(headers: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+  '''Add a W3C `traceparent` header for the current span.'''
+  headers = headers if headers is not None else {}
+  current = _current_span.get()
+  if current is not None:
+    headers[TRACEPARENT_HEADER] = f'00-{current.trace_id}-{current.span_id}-01'
+  return headers
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[tuple]:
+  '''Parse a `traceparent` header.
+  :return: (trace_id, span_id), None if missing or malformed
+  '''
+  if not traceparent:
+    return None
+  parts = traceparent.strip().split('-')
+  if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+    return None
+  return parts[1], parts[2]
+
+def attach_remote_parent(traceparent: Optional[str]) -> Any:
+  '''Make spans started in this context children of a span in another process.
+  :return: token for `detach_remote_parent`
+  '''
+  return _remote_parent.set(parse_traceparent(traceparent))
+
+def detach_remote_parent(token: Any):
+  _remote_parent.reset(token)
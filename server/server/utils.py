@@ -2,13 +2,31 @@ import io
 import cv2
 import time
 import base64
-import requests
-from os.path import join
+import hashlib
+from os import environ as env
+from os.path import join, getsize, splitext
 from PIL import Image
 from typing import List, Optional
 import numpy as np
 import numpy.typing as npt
 from firebase_admin import storage
+from google.api_core.exceptions import NotFound
+from .thumbnails import get_http_session, HTTP_TIMEOUT
+from .tracing import traced
+from .sessions import BoundedStore
+
+# `object`: each upload carries a public-read ACL (no extra RPC)
+# `bucket`: the bucket is public through IAM (uniform bucket-level access); see `make_bucket_public`
+STORAGE_PUBLIC_ACCESS = env.get('STORAGE_PUBLIC_ACCESS', 'object')
+# Files above this size are uploaded in resumable chunks of `UPLOAD_CHUNK_SIZE` bytes
+RESUMABLE_UPLOAD_THRESHOLD = int(env.get('RESUMABLE_UPLOAD_THRESHOLD', 8 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(env.get('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))  # must be a multiple of 256 KB
+# Content-addressed blobs uploaded or touched recently; kept shorter than `MASK_TTL_SECONDS` used by compaction,
+# so a cached blob is always too recent to be deleted
+uploaded_blobs: 'BoundedStore[str]' = BoundedStore(
+  int(env.get('UPLOAD_CACHE_MAX_ITEMS', 10000)), 
+  float(env.get('UPLOAD_CACHE_TTL', 3600)),
+)
 
 def download_image(url: str, cache_dir: str, filename: str) -> str:
   '''Download an image from a URL and save it to the cache directory.
@@ -17,7 +35,8 @@ def download_image(url: str, cache_dir: str, filename: str) -> str:
   :param filename: The filename to save the image as
   :return: The path to the downloaded image
   '''
-  response = requests.get(url)
+  response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
+  response.raise_for_status()
   image_path = join(cache_dir, filename)
   with open(image_path, 'wb') as f:
     f.write(response.content)
@@ -27,6 +46,22 @@ def tick() -> int:
   '''Get the current time in seconds.'''
   return int(time.time())
 
+def file_digest(file_path: str) -> str:
+  '''sha256 hex digest of a file's contents.'''
+  sha = hashlib.sha256()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+def upload_blob(blob: 'storage.Blob', file_path: str, content_type: Optional[str] = None):
+  '''Upload a file to a blob, in resumable chunks if it is large.'''
+  if getsize(file_path) > RESUMABLE_UPLOAD_THRESHOLD:
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+  predefined_acl = 'publicRead' if STORAGE_PUBLIC_ACCESS == 'object' else None
+  blob.upload_from_filename(file_path, content_type=content_type, predefined_acl=predefined_acl)
+
+@traced('storage.upload')
 def upload_file_to_firebase(file_path: str, blob_path: str) -> str:
   '''Upload a file to firebase.
   :param file_path:
@@ -34,11 +69,49 @@ def upload_file_to_firebase(file_path: str, blob_path: str) -> str:
   '''
   bucket = storage.bucket()
   blob = bucket.blob(blob_path)
-  blob.upload_from_filename(file_path)
-  blob.make_public()
+  upload_blob(blob, file_path)
 
   return blob.public_url
 
+def touch_blob(blob: 'storage.Blob'):
+  '''Reset the `updated` time of a blob (and bump its metageneration) so compaction sees it as in use.
+  :raises NotFound: if the blob was deleted
+  '''
+  blob.metadata = {'used_at': str(int(time.time()))}
+  blob.patch()
+
+@traced('storage.upload')
+def upload_content_addressed(file_path: str, prefix: str) -> str:
+  '''Upload a file named by the hash of its contents, touching the blob instead if it already exists.
+  :note: identical images from different clicks share one blob, so blobs are immutable; a reused blob is
+    touched so compaction (which only deletes blobs untouched for `MASK_TTL_SECONDS`) keeps it
+  :param file_path: path to the file
+  :param prefix: folder in the bucket, e.g. `images/`
+  :return: public url of the blob
+  '''
+  blob_path = f'{prefix}{file_digest(file_path)}{splitext(file_path)[1]}'
+  blob = storage.bucket().blob(blob_path)
+  if uploaded_blobs.get(blob_path) is not None:
+    return blob.public_url
+  try:
+    if not blob.exists():
+      raise NotFound(blob_path)
+    touch_blob(blob)
+  except NotFound:
+    blob.cache_control = 'public, max-age=31536000, immutable'
+    upload_blob(blob, file_path, content_type='image/png' if file_path.endswith('.png') else None)
+  uploaded_blobs.put(blob_path, blob.public_url)
+  return blob.public_url
+
+def make_bucket_public():
+  '''Grant public read on the whole bucket, for `STORAGE_PUBLIC_ACCESS=bucket`.
+  :note: run once when setting up a bucket with uniform bucket-level access
+  '''
+  bucket = storage.bucket()
+  policy = bucket.get_iam_policy(requested_policy_version=3)
+  policy.bindings.append({'role': 'roles/storage.objectViewer', 'members': {'allUsers'}})
+  bucket.set_iam_policy(policy)
+
 def binary_mask_to_coco_format(mask: npt.NDArray) -> List[List[int]]:
   '''Convert a binary mask to COCO segmentation format.
   :param mask: A 2D numpy array where the object is represented by 1s and the background by 0s.
@@ -0,0 +1,185 @@
+'''Views denormalized on the write path, so listing a user's clicks takes one or two reads.
+
+Every click embeds `top_items`, summaries of the first items of its `top_items_version`
+(favorites first, then search order). `Feeds/{user_id}` holds the summaries of the user's
+most recent clicks, top items included. Both are updated in a transaction that re-reads the
+click, so concurrent writers never put a stale click in the feed.
+
+:note: maintenance never fails the write it follows; a failed update is counted in `Stats/views` and the
+  next write of the click fixes it, since entries are always rebuilt from the click document
+:note: every feed update is a write to the one feed document of the user, which Firestore only sustains at
+  about one write per second, so only writes that change what the feed shows update it
+'''
+import time
+from os import environ as env
+from collections import defaultdict
+from typing import List, Dict, Any, Optional, Callable, Iterable
+from firebase_admin import firestore
+from .schemas import Item, ClickSummary, Feed, CLICK_SUMMARY_FIELDS, ITEM_SUMMARY_FIELDS
+from .tracing import traced
+
+# Items embedded in each click
+TOP_ITEMS_N = int(env.get('TOP_ITEMS_N', 6))
+# Clicks kept in each feed document; older clicks are paged with `/user/{user_id}/clicks/summaries`
+FEED_SIZE = int(env.get('FEED_SIZE', 50))
+
+def to_item_summary(item: 'Item') -> Dict[str, Any]:
+  '''Summary of an item as stored in `top_items`.'''
+  return item.model_dump(include=set(ITEM_SUMMARY_FIELDS) | {'item_id'})
+
+def rank_top_items(summaries: List[Dict[str, Any]], n: int = TOP_ITEMS_N) -> List[Dict[str, Any]]:
+  '''Favorites first, otherwise in the given order, without repeated items.'''
+  unique: Dict[str, Dict[str, Any]] = {}
+  for summary in summaries:
+    unique.setdefault(summary['item_id'], summary)
+  return sorted(unique.values(), key=lambda summary: not summary.get('is_favorite', False))[:n]
+
+def to_click_summary(data: Dict[str, Any], click_id: str) -> Dict[str, Any]:
+  '''Feed entry of a click document.'''
+  summary = ClickSummary.model_validate({field: data[field] for field in CLICK_SUMMARY_FIELDS if field in data})
+  summary.click_id = click_id
+  return summary.model_dump()
+
+def merge_feed_entry(entries: List[Dict[str, Any]], entry: Dict[str, Any], size: int = FEED_SIZE) -> List[Dict[str, Any]]:
+  '''Replace the entry of the same click, newest first, keeping at most `size` entries.'''
+  entries = [e for e in entries if e['click_id'] != entry['click_id']] + [entry]
+  entries = sorted(entries, key=lambda e: (e['created_at'], e['click_id']), reverse=True)
+  return entries[:size]
+
+def replace_top_items(data: Dict[str, Any], click_version: int, items: List['Item']) -> Optional[Dict[str, Any]]:
+  '''Top items after a search added `items` to version `click_version` of a click.
+  :note: items of a newer version than the current top items replace them, items of the same version are merged
+  :return: fields to update on the click, None if the top items belong to a newer version
+  '''
+  version = data.get('top_items_version')
+  if version is not None and version > click_version:
+    return None
+  existing = data.get('top_items') or [] if version == click_version else []
+  return {
+    'top_items': rank_top_items(existing + [to_item_summary(item) for item in items]),
+    'top_items_version': click_version,
+  }
+
+def favorite_top_items(data: Dict[str, Any], items: List['Item'], is_favorite: bool) -> Optional[Dict[str, Any]]:
+  '''Top items after (un)favoriting `items` of a click.
+  A newly favorited item of the current version is moved to the front even if it was not a top item.
+  :return: fields to update on the click, None if nothing changed
+  '''
+  version = data.get('top_items_version')
+  items = [item for item in items if item.version == version]
+  if len(items) == 0:
+    return None
+  summaries = {item.item_id: {**to_item_summary(item), 'is_favorite': is_favorite} for item in items}
+  top_items = data.get('top_items') or []
+  updated = [summaries.pop(summary['item_id'], summary) for summary in top_items]
+  if is_favorite:
+    updated = list(summaries.values()) + updated
+  updated = rank_top_items(updated)
+  if updated == top_items:
+    return None
+  return {'top_items': updated}
+
+def record_view_event(db: 'firestore.Client', event: str):
+  '''Count a view maintenance event.
+  :param event: `failed`
+  '''
+  try:
+    db.collection('Stats').document('views').set({event: firestore.Increment(1)}, merge=True)
+  except Exception as e:
+    print(f'Error recording view event {event}: {e}')
+
+def fetch_view_stats(db: 'firestore.Client') -> Dict[str, int]:
+  '''Fetch view update counters, keyed by event.'''
+  fb_stats = db.collection('Stats').document('views').get()
+  return fb_stats.to_dict() if fb_stats.exists else {}
+
+def update_click_views(
+  db: 'firestore.Client',
+  click_id: str,
+  update_top_items: Optional[Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]] = None,
+  fields: Optional[Iterable[str]] = None,
+):
+  '''Refresh the feed entry of a click, and optionally its top items, in one transaction.
+  :note: only existing feeds are updated; `fetch_feed` builds a missing feed from the user's clicks
+  :param update_top_items: maps the click document to the fields to update on it, see `replace_top_items`
+  :param fields: fields the caller wrote to the click, None for all of them; nothing is done when none of
+    them are shown in the feed (`CLICK_SUMMARY_FIELDS`) and top items are not updated
+  '''
+  if update_top_items is None and fields is not None and not any(field in CLICK_SUMMARY_FIELDS for field in fields):
+    return
+  click_ref = db.collection('Clicks').document(click_id)
+
+  @firestore.transactional
+  def update(transaction: 'firestore.Transaction'):
+    # Firestore transactions read everything before writing anything
+    fb_click = click_ref.get(transaction=transaction)
+    if not fb_click.exists:
+      return
+    data = fb_click.to_dict()
+    changes = update_top_items(data) if update_top_items is not None else None
+    if changes is not None:
+      data.update(changes)
+    feed_ref = db.collection('Feeds').document(data['user_id']) if data.get('user_id') else None
+    fb_feed = feed_ref.get(transaction=transaction) if feed_ref is not None else None
+    if changes is not None:
+      transaction.update(click_ref, changes)
+    if fb_feed is None or not fb_feed.exists:
+      return
+    entries = fb_feed.get('clicks') or []
+    updated = merge_feed_entry(entries, to_click_summary(data, click_id))
+    # Skip the write (and the contention on the feed) when the feed already shows the click like this
+    if updated != entries:
+      transaction.update(feed_ref, {'clicks': updated, 'updated_at': int(time.time())})
+
+  try:
+    update(db.transaction())
+  except Exception as e:
+    print(f'Error updating views of click {click_id}: {e}')
+    record_view_event(db, 'failed')
+
+@traced('firestore.set_top_items')
+def set_top_items(db: 'firestore.Client', click_id: str, click_version: int, items: List['Item']):
+  '''Embed items found by a search in their click and its feed entry.'''
+  if len(items) == 0:
+    return
+  update_click_views(db, click_id, lambda data: replace_top_items(data, click_version, items))
+
+@traced('firestore.set_favorite_in_views')
+def set_favorite_in_views(db: 'firestore.Client', items: List['Item'], is_favorite: bool):
+  '''Update the top items of the clicks of (un)favorited items and their feed entries.'''
+  items_by_click: Dict[str, List['Item']] = defaultdict(list)
+  for item in items:
+    items_by_click[item.click_id].append(item)
+  for click_id, click_items in items_by_click.items():
+    update_click_views(db, click_id, lambda data, click_items=click_items: favorite_top_items(data, click_items, is_favorite))
+
+@traced('firestore.rebuild_feed')
+def rebuild_feed(db: 'firestore.Client', user_id: str) -> Feed:
+  '''Build the feed of a user from their most recent clicks and save it.'''
+  fb_query = db.collection('Clicks')\
+    .where('user_id', '==', user_id)\
+    .order_by('created_at', direction=firestore.Query.DESCENDING)\
+    .select(CLICK_SUMMARY_FIELDS)\
+    .limit(FEED_SIZE)
+  feed = Feed(
+    user_id=user_id,
+    clicks=[to_click_summary(fb_click.to_dict(), fb_click.id) for fb_click in fb_query.stream()],
+    updated_at=int(time.time()),
+  )
+  db.collection('Feeds').document(user_id).set(feed.model_dump())
+  return feed
+
+@traced('firestore.refresh_feeds')
+def refresh_feeds(db: 'firestore.Client', user_ids: Iterable[str]):
+  '''Rebuild the existing feeds of users after their clicks were written in bulk (e.g. `scripts/ingest.py`).'''
+  for user_id in set(user_ids):
+    if db.collection('Feeds').document(user_id).get().exists:
+      rebuild_feed(db, user_id)
+
+@traced('firestore.fetch_feed')
+def fetch_feed(db: 'firestore.Client', user_id: str) -> Feed:
+  '''Fetch the feed of a user in one read, building it on first use.'''
+  fb_feed = db.collection('Feeds').document(user_id).get()
+  if not fb_feed.exists:
+    return rebuild_feed(db, user_id)
+  return Feed.model_validate(fb_feed.to_dict())
@@ -1,8 +1,11 @@
 from os import environ as env
 from dotenv import load_dotenv
 from celery import Celery
+from celery.schedules import crontab
+from kombu import Queue
 
 from .tasks import click_task
+from .scheduling import route_task, PRIORITY_QUEUES
 
 load_dotenv()  # Loads all the project specific environment 
 
@@ -12,9 +15,32 @@ app = Celery('tasks', broker=env.get('BROKER_URL'), broker_connection_retry_on_s
 print(f'Initialized celery with broker: {app.conf.broker_url}')
 
 # Set wait time to 24 hours so we don't reassign tasks ever
-app.conf.broker_transport_options = {'visibility_timeout': 86400} 
+# Workers poll the priority queues in weighted fair order, see `server.scheduling.WeightedCycle`
+app.conf.broker_transport_options = {
+  'visibility_timeout': 86400,
+  'queue_order_strategy': 'server.scheduling:WeightedCycle',
+}
 app.conf.broker_connection_retry = True
 app.conf.broker_connection_max_retries = 5  # Retry 5 times
 app.conf.broker_connection_retry_interval = 10  # Retry every 10 seconds
+# Broker connections shared by the API threads publishing tasks; publishers wait for a free one past this
+app.conf.broker_pool_limit = int(env.get('BROKER_POOL_LIMIT', 10))
+# Each worker also consumes `{hostname}.dq2`, so clicks reach the worker holding their prepared embedding
+app.conf.worker_direct = True
+# Route tasks to `interactive`, `standard` or `background` by task type and channel;
+# `celery` is still consumed so messages published before the split are drained
+app.conf.task_queues = [Queue(queue) for queue in PRIORITY_QUEUES + ['celery']]
+app.conf.task_default_queue = 'standard'
+app.conf.task_routes = (route_task,)
+# Reserve one message at a time, otherwise a worker holds background tasks while interactive ones wait
+app.conf.worker_prefetch_multiplier = 1
+
+# Reclaim superseded items and stale blobs nightly; run with `celery -A server.worker beat`
+app.conf.beat_schedule = {
+  'compaction': {
+    'task': 'seeclickbuy:compaction_task',
+    'schedule': crontab(hour=int(env.get('COMPACTION_HOUR', 4)), minute=0),
+  },
+}
 
 app.autodiscover_tasks(['server.tasks'])
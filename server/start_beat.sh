@@ -0,0 +1,3 @@
+#!/bin/bash
+
+celery -A server.worker beat --loglevel=INFO
@@ -1,3 +1,7 @@
 #!/bin/bash
 
-celery -A server.worker worker --loglevel=DEBUG --concurrency 1 --pool solo
+# One solo worker owns the GPU. On CPU (`SAM2_DEVICE=cpu`), run several forked workers instead, which share
+# the memory-mapped SAM2 weights: CELERY_POOL=prefork CELERY_CONCURRENCY=4 ./start_celery.sh
+# Only solo workers run `/prepare` encodings, since their embeddings stay in the process that made them.
+export CELERY_POOL=${CELERY_POOL:-solo}
+celery -A server.worker worker --loglevel=DEBUG --concurrency ${CELERY_CONCURRENCY:-1} --pool ${CELERY_POOL}
@@ -1,3 +1,9 @@
 #!/bin/bash
 
-fastapi dev main.py
+# `./start_server.sh prod` serves with gunicorn (see gunicorn.conf.py), otherwise the dev server reloads on changes
+if [ "$1" == "prod" ]; then
+  # exec so SIGTERM reaches gunicorn and workers drain
+  exec gunicorn main:app -c gunicorn.conf.py
+else
+  fastapi dev main.py
+fi
@@ -0,0 +1,164 @@
+'''In-memory Firestore double for testing the write paths without a Firestore emulator.
+
+Only what the tested `server` modules use is implemented: documents, merged sets and updates, `Increment`,
+simple queries and transactions that apply their writes when the transactional function returns.
+'''
+import sys
+import copy
+import uuid
+import types
+import importlib
+from os.path import dirname, realpath, join
+from typing import Dict, Any, List, Optional
+import pytest
+
+SERVER_DIR = realpath(join(dirname(__file__), '..', 'server'))
+# `seeclickbuy`, which `server.similarity` imports
+AI_DIR = realpath(join(dirname(__file__), '..', '..', 'ai'))
+
+class Increment:
+  def __init__(self, value: int):
+    self.value = value
+
+class DocumentSnapshot:
+  def __init__(self, doc_id: str, data: Optional[Dict[str, Any]]):
+    self.id = doc_id
+    self.exists = data is not None
+    self._data = copy.deepcopy(data)
+
+  def to_dict(self) -> Optional[Dict[str, Any]]:
+    return copy.deepcopy(self._data)
+
+  def get(self, field: str) -> Any:
+    return copy.deepcopy(self._data.get(field))
+
+class DocumentReference:
+  def __init__(self, db: 'FakeFirestore', collection: str, doc_id: str):
+    self.db = db
+    self.collection = collection
+    self.id = doc_id
+
+  @property
+  def _docs(self) -> Dict[str, Dict[str, Any]]:
+    return self.db.data.setdefault(self.collection, {})
+
+  def get(self, transaction: Optional['Transaction'] = None) -> DocumentSnapshot:
+    self.db.reads.append((self.collection, self.id))
+    return DocumentSnapshot(self.id, self._docs.get(self.id))
+
+  def set(self, data: Dict[str, Any], merge: bool = False):
+    self.db.writes.append((self.collection, self.id))
+    current = self._docs.get(self.id, {}) if merge else {}
+    for key, value in data.items():
+      current[key] = current.get(key, 0) + value.value if isinstance(value, Increment) else copy.deepcopy(value)
+    self._docs[self.id] = current
+
+  def update(self, data: Dict[str, Any]):
+    if self.id not in self._docs:
+      raise KeyError(f'No document to update: {self.collection}/{self.id}')
+    self.set(data, merge=True)
+
+class Query:
+  def __init__(self, db: 'FakeFirestore', collection: str):
+    self.db = db
+    self.collection = collection
+    self.filters: List[Any] = []
+    self.order: Optional[Any] = None
+    self.count: Optional[int] = None
+
+  def where(self, field: str, op: str, value: Any) -> 'Query':
+    assert op == '=='
+    self.filters.append((field, value))
+    return self
+
+  def order_by(self, field: str, direction: str = 'ASCENDING') -> 'Query':
+    self.order = (field, direction == 'DESCENDING')
+    return self
+
+  def select(self, fields: List[str]) -> 'Query':
+    return self
+
+  def limit(self, count: int) -> 'Query':
+    self.count = count
+    return self
+
+  def stream(self):
+    docs = [(doc_id, data) for doc_id, data in self.db.data.get(self.collection, {}).items()
+      if all(data.get(field) == value for field, value in self.filters)]
+    if self.order is not None:
+      field, reverse = self.order
+      docs = sorted(docs, key=lambda doc: doc[1][field], reverse=reverse)
+    return [DocumentSnapshot(doc_id, data) for doc_id, data in docs[:self.count]]
+
+class CollectionReference(Query):
+  def document(self, doc_id: Optional[str] = None) -> DocumentReference:
+    return DocumentReference(self.db, self.collection, doc_id or uuid.uuid4().hex[:20])
+
+  def add(self, data: Dict[str, Any]):
+    ref = self.document()
+    ref.set(data)
+    return None, ref
+
+class Transaction:
+  def __init__(self, db: 'FakeFirestore'):
+    self.db = db
+    self.ops: List[Any] = []
+
+  def update(self, ref: DocumentReference, data: Dict[str, Any]):
+    self.ops.append((ref, data))
+
+  def commit(self):
+    for ref, data in self.ops:
+      ref.update(data)
+
+class FakeFirestore:
+  '''`firestore.Client` double keeping documents as `data[collection][doc_id]`, with a log of reads and writes.'''
+  def __init__(self):
+    self.data: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    self.reads: List[Any] = []
+    self.writes: List[Any] = []
+
+  def collection(self, name: str) -> CollectionReference:
+    return CollectionReference(self, name)
+
+  def transaction(self) -> Transaction:
+    return Transaction(self)
+
+def transactional(fn):
+  def run(transaction: Transaction):
+    result = fn(transaction)
+    transaction.commit()
+    return result
+  return run
+
+@pytest.fixture(scope='session')
+def server_modules():
+  '''Import `server.*` modules without `server/__init__.py` (which starts Celery) and with the Firestore double.'''
+  firestore = types.ModuleType('firebase_admin.firestore')
+  firestore.Increment = Increment
+  firestore.transactional = transactional
+  firestore.Query = types.SimpleNamespace(ASCENDING='ASCENDING', DESCENDING='DESCENDING')
+  firestore.Client = FakeFirestore
+  firebase_admin = types.ModuleType('firebase_admin')
+  firebase_admin.firestore = firestore
+  package = types.ModuleType('server')
+  package.__path__ = [SERVER_DIR]
+  saved = {name: sys.modules.get(name) for name in ['firebase_admin', 'firebase_admin.firestore', 'server']}
+  sys.modules.update({'firebase_admin': firebase_admin, 'firebase_admin.firestore': firestore, 'server': package})
+  sys.path.insert(0, AI_DIR)
+  yield types.SimpleNamespace(
+    schemas=importlib.import_module('server.schemas'),
+    views=importlib.import_module('server.views'),
+    crud=importlib.import_module('server.crud'),
+    deadlines=importlib.import_module('server.deadlines'),
+  )
+  sys.path.remove(AI_DIR)
+  for name, module in saved.items():
+    if module is None:
+      sys.modules.pop(name, None)
+    else:
+      sys.modules[name] = module
+
+@pytest.fixture
+def db() -> FakeFirestore:
+  return FakeFirestore()
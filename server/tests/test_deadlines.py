@@ -0,0 +1,36 @@
+'''Stage failures under `server.deadlines`, with the search stage of `process_click` against the Firestore double.'''
+import time
+import pytest
+
+def search_stage(server_modules, db, monkeypatch, fetch_lens_items):
+  '''Run the search stage like `process_click` does.
+  :return: items and degradations of the click
+  '''
+  crud, deadlines = server_modules.crud, server_modules.deadlines
+  monkeypatch.setattr(crud, 'fetch_lens_items', fetch_lens_items)
+  degradations = []
+  def degrade(stage: str, action: str):
+    degradations.append(f'{stage}:{action}')
+    deadlines.record_degradation(db, stage, action)
+  search = deadlines.submit_stage(crud.search_items_for_click, db, 'key', 'c1', 'https://example.com/c1.png', 1, limit=25)
+  items = deadlines.wait_stage_or_degrade(search, 'search', 5., degrade, [])
+  return items, degradations
+
+def test_failed_search_degrades(server_modules, db, monkeypatch):
+  def fetch_lens_items(*args, **kwargs):
+    raise RuntimeError('SerpAPI returned 503')
+  items, degradations = search_stage(server_modules, db, monkeypatch, fetch_lens_items)
+  assert items == []
+  assert degradations == ['search:error']
+  assert server_modules.deadlines.fetch_degradation_stats(db) == {'search_error': 1}
+
+def test_empty_search_does_not_degrade(server_modules, db, monkeypatch):
+  items, degradations = search_stage(server_modules, db, monkeypatch, lambda *args, **kwargs: [])
+  assert items == []
+  assert degradations == []
+
+def test_slow_stage_times_out(server_modules):
+  deadlines = server_modules.deadlines
+  future = deadlines.submit_stage(time.sleep, 0.5)
+  with pytest.raises(deadlines.StageTimeout):
+    deadlines.wait_stage_or_degrade(future, 'search', 0.01, lambda stage, action: None, [])
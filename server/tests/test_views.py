@@ -0,0 +1,177 @@
+'''Consistency of the denormalized views (`server.views`) against the in-memory Firestore double.'''
+from typing import Dict, Any
+
+def make_item(views, item_id: str, version: int = 1, is_favorite: bool = False, click_id: str = 'c1'):
+  return views.Item(
+    item_id=item_id,
+    click_id=click_id,
+    title=f'title {item_id}',
+    link=f'https://example.com/{item_id}',
+    source='store',
+    price_value=1.,
+    price_currency='USD',
+    in_stock=True,
+    is_favorite=is_favorite,
+    version=version,
+    created_at=0,
+    updated_at=0,
+  )
+
+def make_click(click_id: str = 'c1', user_id: str = 'u1', created_at: int = 100, **fields) -> Dict[str, Any]:
+  return {
+    'image_url': f'https://example.com/{click_id}.png',
+    'user_id': user_id,
+    'description': 'a chair',
+    'version': 1,
+    'is_processed': True,
+    'created_at': created_at,
+    'updated_at': created_at,
+    **fields,
+  }
+
+def add_click(db, click_id: str = 'c1', **fields):
+  db.collection('Clicks').document(click_id).set(make_click(click_id, **fields))
+
+def feed_entry(db, user_id: str, click_id: str) -> Dict[str, Any]:
+  return next(entry for entry in db.data['Feeds'][user_id]['clicks'] if entry['click_id'] == click_id)
+
+def test_replace_top_items_merges_same_version(server_modules):
+  views = server_modules.views
+  data = views.replace_top_items({}, 1, [make_item(views, 'a')])
+  data = views.replace_top_items(data, 1, [make_item(views, 'b'), make_item(views, 'a')])
+  assert [summary['item_id'] for summary in data['top_items']] == ['a', 'b']
+  assert data['top_items_version'] == 1
+
+def test_replace_top_items_newer_version_replaces(server_modules):
+  views = server_modules.views
+  data = views.replace_top_items({}, 1, [make_item(views, 'a')])
+  data = views.replace_top_items(data, 2, [make_item(views, 'b', version=2)])
+  assert [summary['item_id'] for summary in data['top_items']] == ['b']
+
+def test_replace_top_items_ignores_older_version(server_modules):
+  views = server_modules.views
+  data = views.replace_top_items({}, 2, [make_item(views, 'b', version=2)])
+  assert views.replace_top_items(data, 1, [make_item(views, 'a')]) is None
+
+def test_replace_top_items_keeps_favorites_first_and_limit(server_modules):
+  views = server_modules.views
+  items = [make_item(views, str(i)) for i in range(views.TOP_ITEMS_N + 2)] + [make_item(views, 'fav', is_favorite=True)]
+  data = views.replace_top_items({}, 1, items)
+  assert len(data['top_items']) == views.TOP_ITEMS_N
+  assert data['top_items'][0]['item_id'] == 'fav'
+
+def test_favorite_top_items_moves_new_favorite_to_front(server_modules):
+  views = server_modules.views
+  data = views.replace_top_items({}, 1, [make_item(views, 'a'), make_item(views, 'b')])
+  changes = views.favorite_top_items(data, [make_item(views, 'z')], True)
+  assert [summary['item_id'] for summary in changes['top_items']] == ['z', 'a', 'b']
+  assert changes['top_items'][0]['is_favorite']
+
+def test_favorite_top_items_unfavorite(server_modules):
+  views = server_modules.views
+  data = views.replace_top_items({}, 1, [make_item(views, 'a'), make_item(views, 'b', is_favorite=True)])
+  changes = views.favorite_top_items(data, [make_item(views, 'b')], False)
+  # An unfavorited item keeps its place
+  assert [(s['item_id'], s['is_favorite']) for s in changes['top_items']] == [('b', False), ('a', False)]
+
+def test_favorite_top_items_ignores_other_versions_and_no_ops(server_modules):
+  views = server_modules.views
+  data = views.replace_top_items({}, 2, [make_item(views, 'a', version=2, is_favorite=True)])
+  assert views.favorite_top_items(data, [make_item(views, 'old', version=1)], True) is None
+  assert views.favorite_top_items(data, [make_item(views, 'a', version=2)], True) is None
+
+def test_merge_feed_entry_replaces_and_orders(server_modules):
+  views = server_modules.views
+  entries = [{'click_id': 'c1', 'created_at': 1}, {'click_id': 'c2', 'created_at': 2}]
+  entries = views.merge_feed_entry(entries, {'click_id': 'c1', 'created_at': 1, 'description': 'new'})
+  assert [entry['click_id'] for entry in entries] == ['c2', 'c1']
+  assert entries[1]['description'] == 'new'
+  entries = views.merge_feed_entry(entries, {'click_id': 'c3', 'created_at': 3}, size=2)
+  assert [entry['click_id'] for entry in entries] == ['c3', 'c2']
+
+def test_set_top_items_updates_click_and_feed(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  add_click(db, 'c2', created_at=200)
+  views.rebuild_feed(db, 'u1')
+  views.set_top_items(db, 'c1', 1, [make_item(views, 'a'), make_item(views, 'b')])
+  click = db.data['Clicks']['c1']
+  assert [summary['item_id'] for summary in click['top_items']] == ['a', 'b']
+  assert click['top_items_version'] == 1
+  # The feed entry shows exactly what the click does
+  assert feed_entry(db, 'u1', 'c1')['top_items'] == click['top_items']
+  assert [entry['click_id'] for entry in db.data['Feeds']['u1']['clicks']] == ['c2', 'c1']
+
+def test_set_favorite_in_views_updates_feed(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  views.rebuild_feed(db, 'u1')
+  views.set_top_items(db, 'c1', 1, [make_item(views, 'a'), make_item(views, 'b')])
+  views.set_favorite_in_views(db, [make_item(views, 'b')], True)
+  assert [s['item_id'] for s in db.data['Clicks']['c1']['top_items']] == ['b', 'a']
+  assert feed_entry(db, 'u1', 'c1')['top_items'] == db.data['Clicks']['c1']['top_items']
+
+def test_update_click_views_follows_click_writes(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  views.rebuild_feed(db, 'u1')
+  db.collection('Clicks').document('c1').update({'description': 'a red chair'})
+  views.update_click_views(db, 'c1', fields=['description'])
+  assert feed_entry(db, 'u1', 'c1')['description'] == 'a red chair'
+
+def test_update_click_views_skips_unshown_fields(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  views.rebuild_feed(db, 'u1')
+  num_reads = len(db.reads)
+  views.update_click_views(db, 'c1', fields=['latest_chat_id'])
+  assert len(db.reads) == num_reads
+
+def test_update_click_views_skips_unchanged_feed(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  views.rebuild_feed(db, 'u1')
+  num_writes = len(db.writes)
+  views.update_click_views(db, 'c1', fields=['is_processed'])
+  assert len(db.writes) == num_writes
+
+def test_update_click_views_without_feed(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  views.set_top_items(db, 'c1', 1, [make_item(views, 'a')])
+  assert 'Feeds' not in db.data or 'u1' not in db.data['Feeds']
+  assert db.data['Clicks']['c1']['top_items_version'] == 1
+
+def test_update_click_views_counts_failures(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1')
+  views.rebuild_feed(db, 'u1')
+
+  def fail(data):
+    raise RuntimeError('update failed')
+
+  views.update_click_views(db, 'c1', fail)
+  assert views.fetch_view_stats(db) == {'failed': 1}
+  # Nothing from the failed transaction was applied
+  assert 'top_items' not in db.data['Clicks']['c1']
+
+def test_rebuild_feed_matches_incremental_updates(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1', created_at=100)
+  views.rebuild_feed(db, 'u1')
+  add_click(db, 'c2', created_at=200)
+  views.update_click_views(db, 'c2')
+  views.set_top_items(db, 'c2', 1, [make_item(views, 'a', click_id='c2')])
+  views.set_top_items(db, 'c1', 1, [make_item(views, 'b')])
+  incremental = db.data['Feeds']['u1']['clicks']
+  assert views.rebuild_feed(db, 'u1').model_dump()['clicks'] == incremental
+
+def test_refresh_feeds_only_existing(server_modules, db):
+  views = server_modules.views
+  add_click(db, 'c1', user_id='u1')
+  add_click(db, 'c2', user_id='u2')
+  views.rebuild_feed(db, 'u1')
+  db.data['Feeds']['u1']['clicks'] = []
+  views.refresh_feeds(db, ['u1', 'u2', 'u1'])
+  assert [entry['click_id'] for entry in db.data['Feeds']['u1']['clicks']] == ['c1']
+  assert 'u2' not in db.data['Feeds']